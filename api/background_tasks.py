@@ -1,9 +1,21 @@
 # pylint: disable=protected-access
 """Background tasks for the API."""
 
+import datetime
+
+import pytz
+from django.db.models import Q
+
+from api.image_captioning import generate_captions_batch, generate_places365_tags
 from api.models import Photos
+from api.models.job import Job
 from api.utils import logger
 
+# Photos sent to the tags service in one request.
+TAGS_BATCH_SIZE = 64
+# Photos sent to the captioning service in one request.
+CAPTIONS_BATCH_SIZE = 32
+
 
 def generate_captions(overwrite=False):
     """
@@ -27,6 +39,8 @@ def generate_captions(overwrite=False):
         - The function logs the number of photos to be processed for caption generation using the
           `logger` module.
         - The function logs the path of each photo before generating captions.
+        - Places365 tags are requested for batches of up to `TAGS_BATCH_SIZE` photos of one
+          owner.
         - The function calls the `_generate_captions` method on each photo object to generate
           captions.
         - The function saves each photo object after generating captions.
@@ -38,12 +52,127 @@ def generate_captions(overwrite=False):
     else:
         photos = Photos.objects.filter(search_captions=None)
     logger.info("%d photos to be processed for caption generation", photos.count())
+
+    # Photos are tagged in batches of one owner, who sets the confidence.
+    batch = []
+    for photo in photos.select_related("owner").order_by("owner").iterator():
+        if batch and (
+            len(batch) == TAGS_BATCH_SIZE or batch[0].owner_id != photo.owner_id
+        ):
+            _generate_captions_batch(batch)
+            batch = []
+        batch.append(photo)
+
+    if batch:
+        _generate_captions_batch(batch)
+
+
+def _generate_captions_batch(photos):
+    try:
+        tags = generate_places365_tags(
+            [photo.optimized_image.path for photo in photos],
+            photos[0].owner.confidence,
+        )
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("could not tag a batch of %d photos", len(photos))
+        tags = {}
+
     for photo in photos:
         logger.info("generating captions for %s", photo.original_image.path)
-        photo._generate_captions()
+        # Photos missing from the batch result are tagged one at a time.
+        photo._generate_captions(res_places365=tags.get(photo.optimized_image.path))
         photo.save()
 
 
+def generate_im2txt_captions(user, job_id, overwrite=False) -> bool:
+    """Captions the photos of `user` with the configured captioning model, in
+    batches. Photos that already have a caption are skipped unless `overwrite`
+    is set, and the service reuses the captions it cached for a photo and model,
+    so regenerating them over a library only runs the LLM step again."""
+
+    from constance import config as site_config
+
+    if Job.objects.filter(job_id=job_id).exists():
+        job = Job.objects.get(job_id=job_id)
+        job.started_at = datetime.datetime.now().replace(tzinfo=pytz.utc)
+    else:
+        job = Job.objects.create(
+            started_by=user,
+            job_id=job_id,
+            queued_at=datetime.datetime.now().replace(tzinfo=pytz.utc),
+            started_at=datetime.datetime.now().replace(tzinfo=pytz.utc),
+            job_type=Job.JOB_GENERATE_CAPTIONS,
+        )
+
+    job.result = {"progress": {"current": 0, "target": 0}}
+    job.save()
+
+    try:
+        image_hashes = []
+
+        if site_config.CAPTIONING_MODEL == "None":
+            logger.info("Generating captions is disabled")
+        else:
+            photos = Photos.visible.filter(Q(owner=user) & Q(video=False))
+
+            if not overwrite:
+                photos = photos.filter(
+                    Q(captions_json=None) | ~Q(captions_json__has_key="im2txt")
+                )
+
+            image_hashes = list(photos.values_list("image_hash", flat=True))
+
+        job.result = {"progress": {"current": 0, "target": len(image_hashes)}}
+        job.save()
+
+        for start in range(0, len(image_hashes), CAPTIONS_BATCH_SIZE):
+            photos = list(
+                Photos.objects.filter(
+                    image_hash__in=image_hashes[start : start + CAPTIONS_BATCH_SIZE]
+                ).select_related("owner")
+            )
+
+            try:
+                captions = generate_captions_batch(
+                    [
+                        (photo.image_hash, photo.optimized_image.path)
+                        for photo in photos
+                    ],
+                    site_config.CAPTIONING_MODEL,
+                    refresh=overwrite,
+                )
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("could not caption a batch of %d photos", len(photos))
+                captions = {}
+
+            for photo in photos:
+                # Photos missing from the batch result are captioned one at a time.
+                photo._generate_captions_im2txt(
+                    caption=captions.get(photo.optimized_image.path),
+                    refresh=overwrite,
+                )
+
+            job.result["progress"]["current"] = start + len(photos)
+            job.save()
+
+        job.finished = True
+        job.failed = False
+        job.finished_at = datetime.datetime.now().replace(tzinfo=pytz.utc)
+        job.save()
+
+        return True
+    except BaseException as e:  # pylint: disable=broad-except
+        logger.exception("An error occurred: ")
+        print(f"[ERR]: {e}.")
+
+        job.failed = True
+        job.finished = True
+        job.finished_at = datetime.datetime.now().replace(tzinfo=pytz.utc)
+        job.save()
+
+        return False
+
+
 def geolocate(overwrite=False):
     """
     Geolocates photos based on the given overwrite flag.
@@ -0,0 +1,148 @@
+"""Computes CLIP embeddings of photos with the clip_embeddings service."""
+
+import hashlib
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Q
+
+import api.models
+from api.embedding_store import clip_store, save_clip_embeddings
+from api.face_recognition import decode_array
+from api.image_similarity import index
+from api.services import post
+from api.utils import logger
+
+# Photos sent to the service in one request.
+BATCH_SIZE = 64
+
+# Photos returned by a semantic search, and how long encoded queries are cached.
+SEMANTIC_SEARCH_TOP_K = 100
+QUERY_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_image_embeddings(image_paths) -> tuple[list, np.ndarray]:
+    """Encodes many images in one request. Returns the paths that could be
+    encoded and an (N, 512) float32 matrix of their embeddings."""
+
+    response = post(
+        "http://localhost:8006/image-embeddings",
+        json={"sources": list(image_paths)},
+        timeout=600,
+    ).json()
+
+    for source, error in response["errors"].items():
+        logger.warning("Could not compute the CLIP embedding of %s: %s", source, error)
+
+    return response["sources"], decode_array(response["embeddings"])
+
+
+def get_text_embeddings(texts) -> np.ndarray:
+    """Encodes texts into the CLIP embedding space. Returns an (N, 512) float32
+    matrix."""
+
+    response = post(
+        "http://localhost:8006/text-embeddings",
+        json={"texts": list(texts)},
+        timeout=60,
+    ).json()
+
+    return decode_array(response["embeddings"])
+
+
+def get_query_embedding(query) -> np.ndarray:
+    """Returns the unit length CLIP embedding of a search query. Encoded queries
+    are cached, so repeated and paginated searches skip the service."""
+
+    key = "clip_query:" + hashlib.sha1(query.encode()).hexdigest()
+    cached = cache.get(key)
+
+    if cached is not None:
+        return np.frombuffer(cached, dtype=np.float32)
+
+    embedding = get_text_embeddings([query])[0]
+    embedding = embedding / max(np.linalg.norm(embedding), 1e-12)
+    cache.set(key, embedding.astype(np.float32).tobytes(), QUERY_CACHE_TIMEOUT)
+
+    return embedding
+
+
+def semantic_search(user, query, top_k=SEMANTIC_SEARCH_TOP_K) -> list:
+    """Returns the image hashes of the `top_k` photos of `user` whose embeddings
+    have the highest cosine similarity to a text query, from the similarity
+    index."""
+
+    # Only the ranking matters, so no threshold is applied.
+    return index.search_similar(
+        user.id, get_query_embedding(query), n=top_k, thres=None
+    )
+
+
+def calculate_embeddings(user, photos, persist=True) -> int:
+    """Computes and stores the CLIP embeddings of photos owned by `user`, and adds
+    the visible ones to the similarity index. Returns the number of embedded
+    photos.
+
+    With `persist` false the index is only updated in memory and has to be saved
+    by the caller.
+    """
+
+    # CLIP works at 224 pixels, so the thumbnails are enough and cheap to decode.
+    photos_by_path = {
+        photo.thumbnail.path: photo for photo in photos if photo.thumbnail.name
+    }
+
+    if not photos_by_path:
+        return 0
+
+    paths, embeddings = get_image_embeddings(photos_by_path.keys())
+    embedded = [photos_by_path[path] for path in paths]
+    image_hashes = [photo.image_hash for photo in embedded]
+    save_clip_embeddings(user.id, image_hashes, embeddings)
+
+    visible = [
+        row
+        for row, photo in enumerate(embedded)
+        if not photo.hidden and not photo.deleted
+    ]
+
+    if visible:
+        index.build_index_for_user(
+            user.id,
+            [image_hashes[row] for row in visible],
+            embeddings[visible],
+            persist=persist,
+        )
+
+    return len(embedded)
+
+
+def calculate_missing_embeddings(user) -> int:
+    """Computes the CLIP embeddings of every photo of `user` that has none yet."""
+
+    stored = {
+        image_hash.decode() for image_hash in clip_store(user.id).load()[0].tolist()
+    }
+    image_hashes = [
+        image_hash
+        for image_hash in api.models.Photos.objects.filter(
+            Q(owner=user) & Q(video=False)
+        ).values_list("image_hash", flat=True)
+        if image_hash not in stored
+    ]
+    embedded = 0
+
+    for start in range(0, len(image_hashes), BATCH_SIZE):
+        photos = api.models.Photos.objects.filter(
+            image_hash__in=image_hashes[start : start + BATCH_SIZE]
+        ).only("image_hash", "thumbnail", "hidden", "deleted")
+
+        try:
+            embedded += calculate_embeddings(user, list(photos), persist=False)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not compute CLIP embeddings of a batch of photos")
+
+    index.save(user.id)
+    logger.info("Calculated CLIP embeddings for %d photos of user %s", embedded, user)
+
+    return embedded
@@ -0,0 +1,179 @@
+"""Batch color analysis for photo renditions."""
+
+import os
+
+import numpy as np
+import PIL
+from django.db.models import Q
+from pillow_heif import register_heif_opener
+
+import api.models
+from api.utils import logger
+
+# Images are resampled to a fixed size so a whole batch can be stacked into one array.
+ANALYSIS_SIZE = 64
+
+# Quantization levels per channel. 4 levels give a 64 bin RGB histogram.
+PALETTE_LEVELS = 4
+PALETTE_BINS = PALETTE_LEVELS**3
+PALETTE_SIZE = 5
+
+COLOR_FIELDS = ["dominant_color", "color_palette", "color_signature"]
+BATCH_SIZE = 500
+
+
+def _stack_pixels(images) -> np.ndarray:
+    """Stack PIL images into a single (N, pixels, 3) uint8 array."""
+
+    pixels = [
+        np.asarray(
+            img.convert("RGB").resize(
+                (ANALYSIS_SIZE, ANALYSIS_SIZE), PIL.Image.Resampling.BILINEAR
+            )
+        )
+        for img in images
+    ]
+
+    return np.stack(pixels).reshape(len(images), -1, 3)
+
+
+def analyze_colors(images):
+    """Computes dominant color, palette histogram and mean bin colors for a batch
+    of images in one pass.
+
+    Returns:
+        tuple: (dominant colors (N, 3) uint8, normalized histograms (N, PALETTE_BINS)
+        float32, mean color of every bin (N, PALETTE_BINS, 3) float64)
+    """
+
+    pixels = _stack_pixels(images)
+    count, pixel_count, _ = pixels.shape
+    shift = 8 - int(np.log2(PALETTE_LEVELS))
+
+    quantized = (pixels >> shift).astype(np.int64)
+    bins = (
+        quantized[..., 0] * PALETTE_LEVELS + quantized[..., 1]
+    ) * PALETTE_LEVELS + quantized[..., 2]
+
+    # Offset every image into its own bin range so one bincount covers the batch.
+    offsets = (bins + np.arange(count)[:, None] * PALETTE_BINS).ravel()
+    counts = np.bincount(offsets, minlength=count * PALETTE_BINS).reshape(
+        count, PALETTE_BINS
+    )
+    sums = np.stack(
+        [
+            np.bincount(
+                offsets, weights=pixels[..., c].ravel(), minlength=count * PALETTE_BINS
+            )
+            for c in range(3)
+        ],
+        axis=-1,
+    ).reshape(count, PALETTE_BINS, 3)
+
+    bin_colors = sums / np.maximum(counts, 1)[..., None]
+    histograms = (counts / pixel_count).astype(np.float32)
+    top_bins = np.argmax(counts, axis=1)
+    dominant = np.rint(bin_colors[np.arange(count), top_bins]).astype(np.uint8)
+
+    return dominant, histograms, bin_colors
+
+
+def encode_signature(histogram: np.ndarray) -> str:
+    """Encodes a normalized histogram as a compact hex color signature."""
+
+    return np.rint(histogram * 255).astype(np.uint8).tobytes().hex()
+
+
+def decode_signature(signature: str) -> np.ndarray:
+    """Decodes a color signature back into a normalized histogram."""
+
+    return np.frombuffer(bytes.fromhex(signature), dtype=np.uint8) / 255.0
+
+
+def _palette(histogram: np.ndarray, bin_colors: np.ndarray) -> list:
+    top_bins = np.argsort(histogram)[::-1][:PALETTE_SIZE]
+
+    return [
+        [
+            "#%02x%02x%02x" % tuple(np.rint(bin_colors[idx]).astype(int)),
+            round(float(histogram[idx]), 3),
+        ]
+        for idx in top_bins
+        if histogram[idx] > 0
+    ]
+
+
+def load_thumbnail(photo):
+    """Loads the small thumbnail rendition of a photo from disk."""
+
+    register_heif_opener()
+
+    # Video thumbnails are extracted as a single webp frame next to the mp4 name.
+    path = os.path.splitext(photo.thumbnail.path)[0] + ".webp"
+
+    return PIL.Image.open(path)
+
+
+def calculate_colors(photos, images=None):
+    """Analyses the colors of `photos` in one batch and persists them with a single
+    bulk update.
+
+    Args:
+        photos (list[Photos]): Photos to analyse.
+        images (list[PIL.Image], optional): Already decoded thumbnails, in the same
+            order as `photos`. Missing entries are loaded from disk.
+
+    Returns:
+        int: The number of photos that were updated.
+    """
+
+    if images is None:
+        images = [None] * len(photos)
+
+    analysed_photos = []
+    analysed_images = []
+
+    for photo, img in zip(photos, images):
+        try:
+            analysed_images.append(img if img is not None else load_thumbnail(photo))
+            analysed_photos.append(photo)
+        except (OSError, ValueError):
+            logger.info("Cannot calculate dominant color %s object", photo)
+
+    if not analysed_photos:
+        return 0
+
+    dominant, histograms, bin_colors = analyze_colors(analysed_images)
+
+    for idx, photo in enumerate(analysed_photos):
+        photo.dominant_color = str(dominant[idx].tolist())
+        photo.color_palette = _palette(histograms[idx], bin_colors[idx])
+        photo.color_signature = encode_signature(histograms[idx])
+
+    api.models.Photos.objects.bulk_update(
+        analysed_photos, COLOR_FIELDS, batch_size=BATCH_SIZE
+    )
+
+    return len(analysed_photos)
+
+
+def calculate_missing_colors(user):
+    """Runs the color analysis over every photo of `user` that has no color
+    signature yet."""
+
+    image_hashes = list(
+        api.models.Photos.objects.filter(
+            Q(owner=user) & Q(color_signature=None)
+        ).values_list("image_hash", flat=True)
+    )
+    updated = 0
+
+    for start in range(0, len(image_hashes), BATCH_SIZE):
+        photos = api.models.Photos.objects.filter(
+            image_hash__in=image_hashes[start : start + BATCH_SIZE]
+        ).only("image_hash", "thumbnail")
+        updated += calculate_colors(list(photos))
+
+    logger.info("Calculated colors for %d photos of user %s", updated, user)
+
+    return updated
@@ -16,6 +16,8 @@ from django.core.paginator import Paginator
 from django.db.models import Q, QuerySet
 from django_q.tasks import AsyncTask
 
+from api.clip_embeddings import calculate_missing_embeddings
+from api.color_analysis import calculate_colors, calculate_missing_colors
 from api.face_classify import cluster_all_faces
 from api.models import Job, Photos
 from api.models.file import File
@@ -146,8 +148,17 @@ def create_new_image(user, path) -> Optional[Photos]:
         return None
 
 
-def handle_new_image(user, path, job_id, photo=None):
-    """Handles the creation and all the processing of the photo."""
+# Photos handled by one scan task, their colors are analysed together.
+SCAN_BATCH_SIZE = 16
+
+
+def handle_new_image(user, path, job_id, photo=None, colors=True):
+    """Handles the creation and all the processing of the photo. Returns the
+    photo, if one was created.
+
+    Scan batches pass `colors` false and analyse the colors of all their photos
+    at once, see `handle_new_images`.
+    """
 
     update_scan_counter(job_id)
     try:
@@ -210,11 +221,17 @@ def handle_new_image(user, path, job_id, photo=None):
             photo._extract_faces()
             elapsed = (datetime.datetime.now() - start).total_seconds()
             logger.info("job %s: extract faces: %s, elapsed: %s", job_id, path, elapsed)
-            photo._get_dominant_color()
-            elapsed = (datetime.datetime.now() - start).total_seconds()
-            logger.info(
-                "job %s: get dominant color: %s, elapsed: %s", job_id, path, elapsed
-            )
+            # Runs before the color analysis, which releases the decoded thumbnail.
+            photo._calculate_perceptual_hash()
+            if colors:
+                photo._get_dominant_color()
+                elapsed = (datetime.datetime.now() - start).total_seconds()
+                logger.info(
+                    "job %s: get dominant color: %s, elapsed: %s",
+                    job_id,
+                    path,
+                    elapsed,
+                )
             photo._recreate_search_captions()
             elapsed = (datetime.datetime.now() - start).total_seconds()
             logger.info(
@@ -224,6 +241,7 @@ def handle_new_image(user, path, job_id, photo=None):
                 elapsed,
             )
 
+        return photo
     except OSError as e:
         try:
             logger.exception(
@@ -232,9 +250,11 @@ def handle_new_image(user, path, job_id, photo=None):
         except Exception:  # pylint: disable=broad-except
             logger.exception("job %s: could not load image %s", job_id, path)
 
+    return None
+
 
-def rescan_image(user, path, job_id):  # pylint: disable=unused-argument
-    """Rescans the given image based on path location."""
+def rescan_image(user, path, job_id, colors=True):  # pylint: disable=unused-argument
+    """Rescans the given image based on path location. Returns the photo."""
 
     update_scan_counter(job_id)
 
@@ -248,9 +268,12 @@ def rescan_image(user, path, job_id):  # pylint: disable=unused-argument
             photo._extract_exif_data(True)
             photo._extract_date_time_from_exif(True)
             photo._add_location_to_album_dates()
-            photo._get_dominant_color()
+            photo._calculate_perceptual_hash()
+            if colors:
+                photo._get_dominant_color()
             photo._recreate_search_captions()
 
+            return photo
     except OSError as e:
         try:
             logger.exception(
@@ -259,6 +282,49 @@ def rescan_image(user, path, job_id):  # pylint: disable=unused-argument
         except Exception:  # pylint: disable=broad-except
             logger.exception("job %s: could not load image %s", job_id, path)
 
+    return None
+
+
+def _handle_batch(handler, user, paths, job_id):
+    photos = []
+
+    for path in paths:
+        # A failing photo does not stop the rest of its batch.
+        try:
+            photo = handler(user, path, job_id, colors=False)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("job %s: could not handle image %s", job_id, path)
+            continue
+
+        if photo:
+            photos.append(photo)
+
+    # The thumbnails decoded while handling the photos are analysed in one pass.
+    pending = [
+        photo
+        for photo in photos
+        if not (photo.dominant_color and photo.color_signature)
+    ]
+
+    try:
+        if pending:
+            calculate_colors(pending, [photo._thumbnail_image for photo in pending])
+    finally:
+        for photo in photos:
+            photo._thumbnail_image = None
+
+
+def handle_new_images(user, paths, job_id):
+    """Handles a batch of new photos, see `handle_new_image`."""
+
+    _handle_batch(handle_new_image, user, paths, job_id)
+
+
+def rescan_images(user, paths, job_id):
+    """Rescans a batch of photos, see `rescan_image`."""
+
+    _handle_batch(rescan_image, user, paths, job_id)
+
 
 def walk_directory(directory, callback):
     """Opens any directories available in the given directory and directories inside them."""
@@ -294,8 +360,9 @@ def _file_was_modified_after(filepath, time):
     return datetime.datetime.fromtimestamp(modified).replace(tzinfo=pytz.utc) > time
 
 
-def photo_scanner(user, last_scan, full_scan, path, job_id):
-    """Scans the given path for new photos."""
+def photo_scanner(user, last_scan, full_scan, path, job_id, new_paths, rescan_paths):
+    """Scans the given path for new photos. New photos are added to `new_paths`
+    and changed ones to `rescan_paths`, to be handled in batches."""
 
     if Photos.objects.filter(files__path=path).exists():
         files_to_check = [path]
@@ -311,7 +378,7 @@ def photo_scanner(user, last_scan, full_scan, path, job_id):
                 ]
             )
         ):
-            AsyncTask(rescan_image, user, path, job_id).run()
+            rescan_paths.append(path)
         else:
             update_scan_counter(job_id)
     else:
@@ -323,7 +390,7 @@ def photo_scanner(user, last_scan, full_scan, path, job_id):
         )
         shutil.copy(old_path, new_path)
 
-        AsyncTask(handle_new_image, user, new_path, job_id).run()
+        new_paths.append(new_path)
 
 
 def scan_directory(
@@ -443,8 +510,26 @@ def scan_photos(
         lrj.save()
         db.connections.close_all()
 
+        new_paths = []
+        rescan_paths = []
+
         for photo in all_photos:
-            photo_scanner(*photo)
+            photo_scanner(*photo, new_paths, rescan_paths)
+
+            for task, paths in (
+                (handle_new_images, new_paths),
+                (rescan_images, rescan_paths),
+            ):
+                if len(paths) == SCAN_BATCH_SIZE:
+                    AsyncTask(task, user, list(paths), job_id).run()
+                    paths.clear()
+
+        for task, paths in (
+            (handle_new_images, new_paths),
+            (rescan_images, rescan_paths),
+        ):
+            if paths:
+                AsyncTask(task, user, paths, job_id).run()
 
         print("Scanned", files_found, "files in:", scan_directory)
 
@@ -463,6 +548,11 @@ def scan_photos(
     added_photo_count = Photos.objects.count() - photo_count_before
     print("Added", added_photo_count, "photos")
 
+    # Backfill colors for photos that were not analysed during their own scan.
+    AsyncTask(calculate_missing_colors, user).run()
+    # Embeds new photos and adds them to the similarity index.
+    AsyncTask(calculate_missing_embeddings, user).run()
+
     cluster_job_id = uuid.uuid4()
     print("Starting cluster_all_faces")
     AsyncTask(cluster_all_faces, user, cluster_job_id).run()
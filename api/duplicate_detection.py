@@ -0,0 +1,416 @@
+"""Detects near-duplicates and bursts among the photos of a user.
+
+Every photo gets a 64 bit difference hash (dHash) of its thumbnail. Re-encoded
+copies, resized exports and light edits keep most of their hash bits, so near
+duplicates are photos whose hashes differ in at most DUPLICATE_DISTANCE bits.
+
+Comparing every pair of hashes does not scale to millions of photos. The hashes
+are instead split into HASH_CHUNKS chunks of 16 bits (multi-index hashing). Two
+hashes within DUPLICATE_DISTANCE bits differ in at most
+DUPLICATE_DISTANCE // HASH_CHUNKS bits in at least one of their chunks, so every
+pair is found by looking up each chunk, and its one bit variations, in a sorted
+table of that chunk. Candidates are then checked on the full hash and, where
+both photos have one, on their CLIP embedding.
+
+Bursts are photos taken within BURST_INTERVAL of each other that look alike, so
+only photos that are adjacent in time are compared.
+"""
+
+import datetime
+
+import numpy as np
+import PIL
+import pytz
+from django.db import transaction
+from django.db.models import Q
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import api.models
+from api.color_analysis import load_thumbnail
+from api.embedding_store import load_clip_embeddings
+from api.models.job import Job
+from api.utils import logger
+
+# dHash compares HASH_SIZE + 1 columns of HASH_SIZE rows, giving 64 bits.
+HASH_SIZE = 8
+HASH_CHUNKS = 4
+CHUNK_BITS = 64 // HASH_CHUNKS
+
+# Largest number of differing hash bits for two photos to be near-duplicates.
+DUPLICATE_DISTANCE = 6
+# Smallest cosine similarity of the CLIP embeddings of near-duplicates. Guards
+# against hash collisions of unrelated, mostly flat images.
+DUPLICATE_SIMILARITY = 0.9
+
+# Photos of a burst are taken at most this far apart and are compared with looser
+# thresholds, as the subject moves between shots.
+BURST_INTERVAL = datetime.timedelta(seconds=2)
+BURST_DISTANCE = 16
+BURST_SIMILARITY = 0.85
+
+# Chunk values shared by more photos than this are skipped. They come from blank
+# or uniform images and would otherwise produce a quadratic number of candidates.
+MAX_BUCKET_SIZE = 1000
+# Photos whose candidates are generated at once, bounds the temporary arrays.
+QUERY_BLOCK_SIZE = 100000
+
+BATCH_SIZE = 500
+
+# Bit masks of the parallel bit count.
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+H01 = np.uint64(0x0101010101010101)
+
+
+def dhash(image) -> int:
+    """Returns the 64 bit difference hash of a PIL image. Every bit tells whether
+    a pixel of a small grayscale version is brighter than its right neighbour."""
+
+    pixels = np.asarray(
+        image.convert("L").resize(
+            (HASH_SIZE + 1, HASH_SIZE), PIL.Image.Resampling.BILINEAR
+        ),
+        dtype=np.int16,
+    )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def encode_hash(value: int) -> str:
+    return f"{value:016x}"
+
+
+def decode_hashes(hashes) -> np.ndarray:
+    """Decodes hex perceptual hashes into a uint64 array."""
+
+    return np.array([int(value, 16) for value in hashes], dtype=np.uint64)
+
+
+def hamming_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Returns the number of differing bits of two uint64 arrays, element-wise."""
+
+    # Counts the bits of every 2, 4 and 8 bit field in parallel, then sums the
+    # bytes into the top byte with a multiplication.
+    x = np.bitwise_xor(a, b)
+    x = x - ((x >> np.uint64(1)) & M1)
+    x = (x & M2) + ((x >> np.uint64(2)) & M2)
+    x = (x + (x >> np.uint64(4))) & M4
+
+    return ((x * H01) >> np.uint64(56)).astype(np.int64)
+
+
+def _chunk_candidates(chunks: np.ndarray, radius: int):
+    """Yields (query, candidate) row pairs whose chunk values differ in at most
+    `radius` bits, with query < candidate."""
+
+    masks = [0]
+
+    if radius >= 1:
+        masks += [1 << bit for bit in range(CHUNK_BITS)]
+
+    if radius >= 2:
+        masks += [
+            (1 << i) | (1 << j)
+            for i in range(CHUNK_BITS)
+            for j in range(i + 1, CHUNK_BITS)
+        ]
+
+    masks = np.array(masks, dtype=chunks.dtype)
+    # Rows sorted by chunk value, with the start and size of the bucket of every
+    # possible value, so a probe is a direct lookup.
+    order = np.argsort(chunks, kind="stable")
+    sizes = np.bincount(chunks, minlength=1 << CHUNK_BITS)
+    starts = np.cumsum(sizes) - sizes
+    sizes[sizes > MAX_BUCKET_SIZE] = 0
+
+    for start in range(0, len(chunks), QUERY_BLOCK_SIZE):
+        rows = np.arange(start, min(start + QUERY_BLOCK_SIZE, len(chunks)))
+        probes = (chunks[rows, None] ^ masks[None, :]).ravel()
+        left = starts[probes]
+        counts = sizes[probes]
+
+        # Expands every probe into the table positions of its bucket.
+        total = int(counts.sum())
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = order[np.repeat(left, counts) + offsets]
+        queries = np.repeat(np.repeat(rows, len(masks)), counts)
+        keep = queries < candidates
+
+        yield queries[keep], candidates[keep]
+
+
+def find_similar_pairs(hashes: np.ndarray, max_distance: int) -> np.ndarray:
+    """Returns the unique (i, j) row pairs, i < j, of uint64 hashes that differ in
+    at most `max_distance` bits, as an (M, 2) array."""
+
+    count = len(hashes)
+    chunks = np.ascontiguousarray(hashes).view(np.uint16).reshape(count, HASH_CHUNKS)
+    radius = max_distance // HASH_CHUNKS
+    keys = []
+
+    for chunk in range(HASH_CHUNKS):
+        for queries, candidates in _chunk_candidates(
+            np.ascontiguousarray(chunks[:, chunk]), radius
+        ):
+            close = (
+                hamming_distances(hashes[queries], hashes[candidates]) <= max_distance
+            )
+            keys.append(queries[close] * count + candidates[close])
+
+    if not keys:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # A pair is found once per chunk it shares.
+    keys = np.unique(np.concatenate(keys))
+
+    return np.stack([keys // count, keys % count], axis=1)
+
+
+def _cosine_similarities(embeddings, rows, pairs) -> np.ndarray:
+    """Returns the cosine similarity of the CLIP embeddings of every pair, and NaN
+    where a photo has no embedding. `rows` maps photos to embedding rows or -1."""
+
+    similarities = np.full(len(pairs), np.nan, dtype=np.float32)
+    a, b = rows[pairs[:, 0]], rows[pairs[:, 1]]
+    known = np.flatnonzero((a >= 0) & (b >= 0))
+
+    for start in range(0, len(known), BATCH_SIZE):
+        block = known[start : start + BATCH_SIZE]
+        similarities[block] = np.einsum(
+            "ij,ij->i", embeddings[a[block]], embeddings[b[block]]
+        )
+
+    return similarities
+
+
+def _link(pairs, similarities, min_similarity) -> np.ndarray:
+    """Keeps the pairs whose embeddings are similar enough, or unknown."""
+
+    return pairs[~(similarities < min_similarity)]
+
+
+def _burst_pairs(timestamps, hashes, embeddings, rows) -> np.ndarray:
+    """Returns the pairs of photos taken one after another within BURST_INTERVAL
+    that look alike."""
+
+    taken = np.flatnonzero(~np.isnat(timestamps))
+    taken = taken[np.argsort(timestamps[taken], kind="stable")]
+    gaps = np.diff(timestamps[taken])
+    adjacent = np.flatnonzero(gaps <= np.timedelta64(BURST_INTERVAL))
+    pairs = np.stack([taken[adjacent], taken[adjacent + 1]], axis=1)
+
+    if not len(pairs):
+        return pairs
+
+    similarities = _cosine_similarities(embeddings, rows, pairs)
+    distances = hamming_distances(hashes[pairs[:, 0]], hashes[pairs[:, 1]])
+    alike = np.where(
+        np.isnan(similarities),
+        distances <= BURST_DISTANCE,
+        similarities >= BURST_SIMILARITY,
+    )
+
+    return pairs[alike]
+
+
+def _components(count, pairs) -> list:
+    """Returns the groups of connected rows with at least two members."""
+
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+        shape=(count, count),
+    )
+    _, labels = connected_components(graph, directed=False)
+    sizes = np.bincount(labels)
+    grouped = np.flatnonzero(sizes[labels] >= 2)
+    order = grouped[np.argsort(labels[grouped], kind="stable")]
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+
+    return np.split(order, boundaries) if len(order) else []
+
+
+def group_photos(image_hashes, perceptual_hashes, timestamps, user_id=None) -> dict:
+    """Groups photos into near-duplicates and bursts.
+
+    Args:
+        image_hashes (list[str]): Photos to group.
+        perceptual_hashes (list[str]): Their hex dHash values.
+        timestamps (list[datetime]): Their capture times, or None.
+        user_id (int, optional): Owner whose CLIP embeddings confirm matches.
+
+    Returns:
+        dict: Lists of image hash groups for PhotoGroup.KIND_DUPLICATE and
+        PhotoGroup.KIND_BURST. A photo is in at most one group of each kind.
+    """
+
+    count = len(image_hashes)
+    hashes = decode_hashes(perceptual_hashes)
+    timestamps = np.array(
+        [
+            np.datetime64(value.replace(tzinfo=None), "ms") if value else "NaT"
+            for value in timestamps
+        ],
+        dtype="datetime64[ms]",
+    )
+    rows = np.full(count, -1, dtype=np.int64)
+    embeddings = np.empty((0, 0), dtype=np.float32)
+
+    if user_id is not None:
+        embedded, embeddings = load_clip_embeddings(user_id, image_hashes)
+        embeddings /= np.maximum(
+            np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+        )
+        positions = {image_hash: row for row, image_hash in enumerate(image_hashes)}
+        rows[[positions[image_hash] for image_hash in embedded]] = np.arange(
+            len(embedded)
+        )
+
+    duplicates = find_similar_pairs(hashes, DUPLICATE_DISTANCE)
+    duplicates = _link(
+        duplicates,
+        _cosine_similarities(embeddings, rows, duplicates),
+        DUPLICATE_SIMILARITY,
+    )
+    bursts = _burst_pairs(timestamps, hashes, embeddings, rows)
+
+    groups = {}
+
+    for kind, pairs in (
+        (api.models.PhotoGroup.KIND_DUPLICATE, duplicates),
+        (api.models.PhotoGroup.KIND_BURST, bursts),
+    ):
+        groups[kind] = [
+            [image_hashes[row] for row in component]
+            for component in _components(count, pairs)
+        ]
+
+    return groups
+
+
+def calculate_perceptual_hashes(photos, images=None) -> int:
+    """Hashes the thumbnails of `photos` and persists the hashes with a single
+    bulk update. `images` are already decoded thumbnails in the same order."""
+
+    if images is None:
+        images = [None] * len(photos)
+
+    hashed = []
+
+    for photo, img in zip(photos, images):
+        try:
+            photo.perceptual_hash = encode_hash(
+                dhash(img if img is not None else load_thumbnail(photo))
+            )
+            hashed.append(photo)
+        except (OSError, ValueError):
+            logger.info("Cannot calculate perceptual hash of %s", photo)
+
+    api.models.Photos.objects.bulk_update(
+        hashed, ["perceptual_hash"], batch_size=BATCH_SIZE
+    )
+
+    return len(hashed)
+
+
+def calculate_missing_perceptual_hashes(user) -> int:
+    """Hashes every photo of `user` that has no perceptual hash yet."""
+
+    image_hashes = list(
+        api.models.Photos.objects.filter(
+            Q(owner=user) & Q(perceptual_hash=None)
+        ).values_list("image_hash", flat=True)
+    )
+    updated = 0
+
+    for start in range(0, len(image_hashes), BATCH_SIZE):
+        photos = api.models.Photos.objects.filter(
+            image_hash__in=image_hashes[start : start + BATCH_SIZE]
+        ).only("image_hash", "thumbnail")
+        updated += calculate_perceptual_hashes(list(photos))
+
+    logger.info("Calculated perceptual hashes for %d photos of user %s", updated, user)
+
+    return updated
+
+
+def save_groups(user, groups):
+    """Replaces the duplicate and burst groups of `user`."""
+
+    membership = api.models.PhotoGroup.photos.through
+
+    with transaction.atomic():
+        api.models.PhotoGroup.objects.filter(owner=user).delete()
+
+        for kind, members in groups.items():
+            created = api.models.PhotoGroup.objects.bulk_create(
+                [api.models.PhotoGroup(owner=user, kind=kind) for _ in members]
+            )
+            membership.objects.bulk_create(
+                [
+                    membership(photogroup_id=group.id, photos_id=image_hash)
+                    for group, image_hashes in zip(created, members)
+                    for image_hash in image_hashes
+                ],
+                batch_size=BATCH_SIZE,
+            )
+
+
+def detect_duplicates(user, job_id) -> bool:
+    """Hashes the photos of `user` that have no perceptual hash yet and replaces
+    their duplicate and burst groups."""
+
+    if Job.objects.filter(job_id=job_id).exists():
+        job = Job.objects.get(job_id=job_id)
+        job.started_at = datetime.datetime.now().replace(tzinfo=pytz.utc)
+    else:
+        job = Job.objects.create(
+            started_by=user,
+            job_id=job_id,
+            queued_at=datetime.datetime.now().replace(tzinfo=pytz.utc),
+            started_at=datetime.datetime.now().replace(tzinfo=pytz.utc),
+            job_type=Job.JOB_DETECT_DUPLICATES,
+        )
+
+    job.result = {"progress": {"current": 0, "target": 1}}
+    job.save()
+
+    try:
+        calculate_missing_perceptual_hashes(user)
+
+        image_hashes, perceptual_hashes, timestamps = [], [], []
+
+        for image_hash, perceptual_hash, timestamp in (
+            api.models.Photos.visible.filter(
+                Q(owner=user) & Q(video=False) & ~Q(perceptual_hash=None)
+            )
+            .values_list("image_hash", "perceptual_hash", "exif_timestamp")
+            .iterator()
+        ):
+            image_hashes.append(image_hash)
+            perceptual_hashes.append(perceptual_hash)
+            timestamps.append(timestamp)
+
+        groups = group_photos(image_hashes, perceptual_hashes, timestamps, user.id)
+        save_groups(user, groups)
+        target_count = sum(len(members) for members in groups.values())
+
+        job.finished = True
+        job.failed = False
+        job.finished_at = datetime.datetime.now().replace(tzinfo=pytz.utc)
+        job.result = {"progress": {"current": target_count, "target": target_count}}
+        job.save()
+
+        return True
+    except BaseException as e:  # pylint: disable=broad-except
+        logger.exception("An error occurred: ")
+        print(f"[ERR]: {e}.")
+
+        job.failed = True
+        job.finished = True
+        job.finished_at = datetime.datetime.now().replace(tzinfo=pytz.utc)
+        job.save()
+
+        return False
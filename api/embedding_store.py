@@ -0,0 +1,386 @@
+"""Per-user, memory-mapped embedding matrices.
+
+Every store is a directory below `EMBEDDINGS_ROOT/<kind>/<user id>/` with a raw
+vector file, an id file, a liveness mask and a small json header. Rows are only
+ever appended, removed rows are tombstoned in the mask, and the files are
+rewritten once too many rows are dead. Readers map the files directly, so loading
+a matrix of a million faces does not touch the database.
+"""
+
+import json
+import os
+import threading
+import weakref
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from filelock import FileLock
+
+import api.models
+from api.face_encoding import ENCODING_DTYPE, ENCODING_SIZE, unpack_encodings
+from api.utils import logger
+
+FACES = "faces"
+CLIP = "clip"
+
+# CLIP image embeddings are stored at half precision, keyed by image hash.
+CLIP_EMBEDDING_SIZE = 512
+CLIP_DTYPE = "<f2"
+IMAGE_HASH_DTYPE = "S64"
+
+# Fraction of dead rows after which a store is compacted.
+COMPACT_RATIO = 0.25
+
+
+class EmbeddingStore:
+    """Append-only embedding matrix with an id map, stored on disk."""
+
+    def __init__(self, kind, user_id, dim, dtype, id_dtype="<i8"):
+        self.directory = os.path.join(settings.EMBEDDINGS_ROOT, kind, str(user_id))
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.id_dtype = np.dtype(id_dtype)
+        self.lock = FileLock(os.path.join(self.directory, ".lock"))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_header(self):
+        try:
+            with open(self._path("header.json")) as f:
+                header = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if (
+            header.get("dim") != self.dim
+            or header.get("dtype") != self.dtype.str
+            or header.get("id_dtype") != self.id_dtype.str
+        ):
+            return None
+
+        return header
+
+    def _write_header(self, count, dead):
+        header = {
+            "count": count,
+            "dead": dead,
+            "dim": self.dim,
+            "dtype": self.dtype.str,
+            "id_dtype": self.id_dtype.str,
+        }
+        tmp_path = self._path("header.json.tmp")
+
+        with open(tmp_path, "w") as f:
+            json.dump(header, f)
+
+        os.replace(tmp_path, self._path("header.json"))
+
+    def _map(self, name, dtype, count, shape=None, mode="r"):
+        if count == 0:
+            return np.empty(shape or (0,), dtype=dtype)
+
+        return np.memmap(self._path(name), dtype=dtype, mode=mode, shape=shape)
+
+    def _read(self, header):
+        count = header["count"]
+        ids = self._map("ids.bin", self.id_dtype, count, (count,))
+        vectors = self._map("vectors.bin", self.dtype, count, (count, self.dim))
+        alive = self._map("alive.bin", np.bool_, count, (count,))
+
+        return ids, vectors, alive
+
+    def exists(self):
+        """Checks if the store has been written and matches the expected layout."""
+
+        return self._read_header() is not None
+
+    def __len__(self):
+        header = self._read_header()
+
+        return header["count"] - header["dead"] if header else 0
+
+    def load(self):
+        """Returns the ids and an (N, dim) matrix of all live rows.
+
+        Without tombstones the arrays are read only memory maps of the files,
+        otherwise the live rows are copied out.
+        """
+
+        empty = (
+            np.empty((0,), dtype=self.id_dtype),
+            np.empty((0, self.dim), dtype=self.dtype),
+        )
+
+        if not os.path.isdir(self.directory):
+            return empty
+
+        with self.lock:
+            header = self._read_header()
+
+            if header is None:
+                return empty
+
+            ids, vectors, alive = self._read(header)
+
+        if header["dead"] == 0:
+            return ids, vectors
+
+        return ids[alive], vectors[alive]
+
+    def rebuild(self, ids, vectors):
+        """Replaces the whole store with the given rows."""
+
+        ids = np.ascontiguousarray(ids, dtype=self.id_dtype)
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+        os.makedirs(self.directory, exist_ok=True)
+
+        with self.lock:
+            for name, array in (
+                ("ids.bin", ids),
+                ("vectors.bin", vectors),
+                ("alive.bin", np.ones(len(ids), dtype=np.bool_)),
+            ):
+                tmp_path = self._path(name + ".tmp")
+                array.tofile(tmp_path)
+                os.replace(tmp_path, self._path(name))
+
+            self._write_header(len(ids), 0)
+
+    def append(self, ids, vectors):
+        """Appends rows to the store. Does nothing if the store was never built,
+        the next reader rebuilds it from scratch anyway."""
+
+        ids = np.ascontiguousarray(ids, dtype=self.id_dtype)
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+
+        if len(ids) == 0 or not os.path.isdir(self.directory):
+            return
+
+        with self.lock:
+            header = self._read_header()
+
+            if header is None:
+                return
+
+            # Truncate leftovers of an interrupted append before writing.
+            count = header["count"]
+
+            for name, array, row_size in (
+                ("ids.bin", ids, self.id_dtype.itemsize),
+                ("vectors.bin", vectors, self.dtype.itemsize * self.dim),
+                ("alive.bin", np.ones(len(ids), dtype=np.bool_), 1),
+            ):
+                with open(self._path(name), "r+b") as f:
+                    f.truncate(count * row_size)
+                    f.seek(0, os.SEEK_END)
+                    f.write(array.tobytes())
+
+            self._write_header(count + len(ids), header["dead"])
+
+    def remove(self, ids):
+        """Tombstones the rows of the given ids and compacts the store once too
+        many rows are dead."""
+
+        if not os.path.isdir(self.directory):
+            return
+
+        with self.lock:
+            header = self._read_header()
+
+            if header is None or header["count"] == 0:
+                return
+
+            count = header["count"]
+            stored_ids = self._map("ids.bin", self.id_dtype, count, (count,))
+            alive = self._map("alive.bin", np.bool_, count, (count,), mode="r+")
+            rows = np.flatnonzero(
+                np.isin(stored_ids, np.asarray(ids, dtype=self.id_dtype)) & alive
+            )
+
+            if len(rows) == 0:
+                return
+
+            alive[rows] = False
+            alive.flush()
+            dead = header["dead"] + len(rows)
+            self._write_header(count, dead)
+
+        if dead > count * COMPACT_RATIO:
+            self.compact()
+
+    def compact(self):
+        """Rewrites the store without its dead rows."""
+
+        ids, vectors = self.load()
+        self.rebuild(np.array(ids), np.array(vectors))
+
+
+class CommitBatch:
+    """Items collected by key in one savepoint, passed to `flush` as a dict of
+    lists once the transaction commits. `cache` holds lookups shared by the
+    items of the batch."""
+
+    def __init__(self, flush, immediate=False):
+        self.flush = flush
+        self.immediate = immediate
+        self.items = {}
+        self.cache = {}
+
+    def add(self, key, item):
+        if self.immediate:
+            self.flush({key: [item]})
+        else:
+            self.items.setdefault(key, []).append(item)
+
+    def __call__(self):
+        self.flush(self.items)
+
+
+# Per thread, a weak reference to the batch of every savepoint seen. Django
+# drops the callbacks of rolled back savepoints and transactions, and those of
+# committed ones once they ran, which frees their batches.
+_commit_batches = threading.local()
+
+
+def commit_batch(flush) -> CommitBatch:
+    """Returns the batch of `flush` for the current savepoint, registering it to
+    run when the transaction commits.
+
+    The items of a savepoint that is rolled back are dropped with it. Outside a
+    transaction, items are flushed as they are added.
+    """
+
+    connection = transaction.get_connection()
+
+    if not connection.in_atomic_block:
+        return CommitBatch(flush, immediate=True)
+
+    batches = _commit_batches.__dict__.setdefault("batches", {})
+    savepoint = (flush, tuple(connection.savepoint_ids))
+    batch = batches[savepoint]() if savepoint in batches else None
+
+    if batch is None:
+        for other in [other for other, ref in batches.items() if ref() is None]:
+            del batches[other]
+
+        batch = CommitBatch(flush)
+        transaction.on_commit(batch)
+        batches[savepoint] = weakref.ref(batch)
+
+    return batch
+
+
+def select(ids, vectors, wanted_ids):
+    """Returns the rows of `vectors` for `wanted_ids`, in that order."""
+
+    wanted_ids = np.asarray(wanted_ids, dtype=ids.dtype)
+
+    if len(wanted_ids) == 0:
+        return vectors[:0]
+
+    if len(ids) == 0:
+        raise KeyError("The embedding store is empty")
+
+    sorter = np.argsort(ids)
+    positions = sorter[np.searchsorted(ids, wanted_ids, sorter=sorter) % len(ids)]
+
+    if not np.array_equal(ids[positions], wanted_ids):
+        raise KeyError("Some ids are missing from the embedding store")
+
+    return vectors[positions]
+
+
+def face_model_path(user_id, filename) -> str:
+    """Returns the path of a model file kept next to the face store of a user."""
+
+    return os.path.join(settings.EMBEDDINGS_ROOT, FACES, str(user_id), filename)
+
+
+def face_store(user_id) -> EmbeddingStore:
+    """Returns the face encoding store of a user."""
+
+    return EmbeddingStore(FACES, user_id, ENCODING_SIZE, ENCODING_DTYPE)
+
+
+def rebuild_face_store(user_id) -> EmbeddingStore:
+    """Rebuilds the face encoding store of a user from the database."""
+
+    store = face_store(user_id)
+    rows = list(
+        api.models.Face.objects.filter(photo__owner_id=user_id)
+        .order_by("id")
+        .values_list("id", "encoding")
+    )
+    ids = [row[0] for row in rows]
+    store.rebuild(ids, unpack_encodings([row[1] for row in rows]))
+    logger.info(
+        "Rebuilt face encoding store of user %s with %d faces", user_id, len(ids)
+    )
+
+    return store
+
+
+def load_face_encodings(user) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the face ids and an (N, 128) encoding matrix of a user.
+
+    The store is rebuilt from the database if it is missing or its ids do not
+    match the faces anymore, e.g. after a crash between a database write and the
+    store update. The ids are compared by their count and sum, which also tells
+    apart a store that missed as many removals as appends.
+    """
+
+    store = face_store(user.id)
+    faces = api.models.Face.objects.filter(photo__owner=user).aggregate(
+        count=Count("id"), total=Sum("id")
+    )
+
+    if store.exists():
+        ids, encodings = store.load()
+
+        if len(ids) == faces["count"] and int(ids.sum()) == (faces["total"] or 0):
+            return ids, encodings
+
+    return rebuild_face_store(user.id).load()
+
+
+def clip_store(user_id) -> EmbeddingStore:
+    """Returns the CLIP image embedding store of a user."""
+
+    return EmbeddingStore(
+        CLIP, user_id, CLIP_EMBEDDING_SIZE, CLIP_DTYPE, IMAGE_HASH_DTYPE
+    )
+
+
+def save_clip_embeddings(user_id, image_hashes, embeddings):
+    """Stores the CLIP embeddings of photos, replacing earlier ones.
+
+    Unlike face encodings, CLIP embeddings only live in the store, so it is
+    created on first use.
+    """
+
+    store = clip_store(user_id)
+
+    if not store.exists():
+        store.rebuild([], [])
+
+    store.remove(image_hashes)
+    store.append(image_hashes, embeddings)
+
+
+def load_clip_embeddings(user_id, image_hashes=None) -> tuple[list, np.ndarray]:
+    """Returns image hashes and an (N, 512) float32 matrix of the stored CLIP
+    embeddings of a user, restricted to `image_hashes` if given. Photos without
+    an embedding are left out."""
+
+    ids, vectors = clip_store(user_id).load()
+
+    if image_hashes is not None:
+        wanted = np.isin(ids, np.asarray(image_hashes, dtype=ids.dtype))
+        ids, vectors = ids[wanted], vectors[wanted]
+
+    return [image_hash.decode() for image_hash in ids.tolist()], np.asarray(
+        vectors, dtype=np.float32
+    )
@@ -0,0 +1,112 @@
+"""Classifiers that label unknown faces with the persons of labelled faces."""
+
+import os
+
+import joblib
+import numpy as np
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.neural_network import MLPClassifier
+
+from api.embedding_store import face_model_path
+from api.utils import logger
+
+MLP = "MLP"
+KNN = "KNN"
+
+# Iterations for a fit from scratch, and for continuing a persisted model.
+MLP_MAX_ITER = 1000
+MLP_WARM_START_MAX_ITER = 200
+KNN_NEIGHBORS = 5
+
+# Rows per predict_proba call, bounds the (rows, persons) probability matrix.
+PREDICT_BATCH_SIZE = 10000
+
+
+def _model_path(user_id):
+    return face_model_path(user_id, "classifier.joblib")
+
+
+def _load_mlp(user_id, classes):
+    """Loads the persisted MLP of a user if it was trained on the same persons."""
+
+    try:
+        clf = joblib.load(_model_path(user_id))
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+    if not isinstance(clf, MLPClassifier) or not np.array_equal(clf.classes_, classes):
+        return None
+
+    return clf
+
+
+def _fit_mlp(user_id, encodings, labels):
+    clf = _load_mlp(user_id, np.unique(labels))
+
+    if clf is not None:
+        # Only a few labels change between runs, so continuing from the previous
+        # weights converges much faster than starting over.
+        logger.info("Continuing face classifier of user %s", user_id)
+        clf.set_params(warm_start=True, max_iter=MLP_WARM_START_MAX_ITER)
+
+    else:
+        clf = MLPClassifier(
+            solver="adam", alpha=1e-5, random_state=1, max_iter=MLP_MAX_ITER
+        )
+
+    clf.fit(encodings, labels)
+
+    try:
+        os.makedirs(os.path.dirname(_model_path(user_id)), exist_ok=True)
+        joblib.dump(clf, _model_path(user_id))
+    except OSError:
+        logger.exception("Could not store face classifier of user %s", user_id)
+
+    return clf
+
+
+def _fit_knn(encodings, labels):
+    return KNeighborsClassifier(
+        n_neighbors=min(KNN_NEIGHBORS, len(labels)), weights="distance"
+    ).fit(encodings, labels)
+
+
+def fit_classifier(user, encodings: np.ndarray, labels: np.ndarray):
+    """Fits the face classifier selected by the user on labelled encodings."""
+
+    if user.face_classifier == KNN:
+        return _fit_knn(encodings, labels)
+
+    return _fit_mlp(user.id, encodings, labels)
+
+
+def predict(
+    clf, encodings: np.ndarray, current_labels: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Predicts the persons of many encodings.
+
+    Returns the most likely person per row, its probability, and the probability
+    of the person in `current_labels`, which is 0 if the classifier does not know
+    that person.
+    """
+
+    count = len(encodings)
+    best_labels = np.empty(count, dtype=clf.classes_.dtype)
+    best_probabilities = np.empty(count, dtype=np.float64)
+    current_probabilities = np.zeros(count, dtype=np.float64)
+
+    for start in range(0, count, PREDICT_BATCH_SIZE):
+        end = min(start + PREDICT_BATCH_SIZE, count)
+        probabilities = clf.predict_proba(encodings[start:end])
+        rows = np.arange(end - start)
+        best = np.argmax(probabilities, axis=1)
+        best_labels[start:end] = clf.classes_[best]
+        best_probabilities[start:end] = probabilities[rows, best]
+
+        # classes_ is sorted, so the column of each current label can be looked up.
+        columns = np.searchsorted(clf.classes_, current_labels[start:end])
+        columns = np.minimum(columns, len(clf.classes_) - 1)
+        known = clf.classes_[columns] == current_labels[start:end]
+        current_probabilities[start:end][known] = probabilities[rows, columns][known]
+
+    return best_labels, best_probabilities, current_probabilities
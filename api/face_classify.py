@@ -1,20 +1,23 @@
 """Classify faces and cluster."""
 
 import datetime
+import os
 import uuid
+import joblib
 import numpy as np
 import pytz
 import seaborn as sns
-from bulk_update.helper import bulk_update
-from hdbscan import HDBSCAN
 from sklearn.decomposition import PCA
-from sklearn.neural_network import MLPClassifier
 
-from django.core.paginator import Paginator
-from django.db.models import Q
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max, Q
 from django_q.tasks import AsyncTask
 
-from api.face_cluster_manager import ClusterManager
+from api.embedding_store import face_model_path, load_face_encodings, select
+from api.face_cluster_manager import ClusterManager, nearest_centroids
+from api.face_clustering import cluster_encodings
+from api.face_classifier import fit_classifier, predict
+from api.face_encoding import pack_encoding, unpack_encoding
 from api.models import Face, Job, Person
 from api.models.cluster import Cluster, UNKNOWN_CLUSTER_ID
 from api.models.person import get_unknown_person
@@ -22,51 +25,173 @@ from api.models.user import User, get_deleted_user
 from api.utils import logger
 
 FACE_CLASSIFY_COLUMNS = [
-    "id",
-    "cluster",
     "person",
     "person_label_is_inferred",
     "person_label_probability",
 ]
+FACE_CLASSIFY_BATCH_SIZE = 1000
 
+PROJECTION_FIELDS = ["projection_x", "projection_y", "projection_z"]
+PROJECTION_BATCH_SIZE = 1000
+FACE_MAP_FIELDS = [
+    "person_id",
+    "person__name",
+    "person_label_is_inferred",
+    "image",
+    *PROJECTION_FIELDS,
+]
+# The PCA of the face map is fitted on at most this many faces.
+PROJECTION_SAMPLE_SIZE = 50000
+
+# Record layout of the packed face map: face id, person id, x, y, size and the
+# inferred flag, 29 bytes per face.
+FACE_MAP_DTYPE = np.dtype(
+    [
+        ("id", "<i8"),
+        ("person_id", "<i8"),
+        ("x", "<f4"),
+        ("y", "<f4"),
+        ("size", "<f4"),
+        ("person_label_is_inferred", "u1"),
+    ]
+)
+
+
+def _load_projection(user_id):
+    try:
+        pca = joblib.load(face_model_path(user_id, "projection.joblib"))
+    except Exception:  # pylint: disable=broad-except
+        return None
 
-def cluster_faces(user, inferred=True):
-    """Clusters faces for a given user."""
-
-    persons = [p.id for p in Person.objects.filter(faces__photo__owner=user).distinct()]
-    p2c = dict(zip(persons, sns.color_palette(n_colors=len(persons)).as_hex()))
-
-    face_encoding = []
-    faces = Face.objects.filter(photo__owner=user)
-    paginator = Paginator(faces, 5000)
-
-    for page in range(1, paginator.num_pages + 1):
-        for face in paginator.page(page).object_list:
-            if ((not face.person_label_is_inferred) or inferred) and face.encoding:
-                face_encoding.append(face.get_encoding_array())
-
-    pca = PCA(n_components=3)
-    vis_all = pca.fit_transform(face_encoding)
-
-    res = []
-
-    for face, vis in zip(faces, vis_all):
-        res.append(
-            {
-                "person_id": face.person.id,
-                "person_name": face.person.name,
-                "person_label_is_inferred": face.person_label_is_inferred,
-                "color": p2c[face.person.id],
-                "face_url": face.image.url,
-                "value": {"x": vis[0], "y": vis[1], "size": vis[2]},
-            }
+    return pca if isinstance(pca, PCA) else None
+
+
+def _fit_projection(user_id, encodings):
+    if len(encodings) > PROJECTION_SAMPLE_SIZE:
+        rows = np.random.default_rng(0).choice(
+            len(encodings), PROJECTION_SAMPLE_SIZE, replace=False
+        )
+        encodings = encodings[np.sort(rows)]
+
+    pca = PCA(n_components=3).fit(encodings)
+    path = face_model_path(user_id, "projection.joblib")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    joblib.dump(pca, path)
+
+    return pca
+
+
+def update_face_projections(user, full=False) -> int:
+    """Stores the position of faces on the face map.
+
+    The PCA is refitted with `full` or when none was stored yet, and then all
+    faces are projected again. Otherwise only faces without a position are
+    projected with the stored PCA.
+    """
+
+    face_ids, encodings = load_face_encodings(user)
+
+    if len(face_ids) < 3:
+        return 0
+
+    pca = None if full else _load_projection(user.id)
+
+    if pca is None:
+        pca = _fit_projection(user.id, encodings)
+        target_ids = face_ids
+
+    else:
+        target_ids = list(
+            Face.objects.filter(photo__owner=user, projection_x=None)
+            .order_by("id")
+            .values_list("id", flat=True)
         )
 
-    return res
+    if len(target_ids) == 0:
+        return 0
+
+    projections = pca.transform(select(face_ids, encodings, target_ids))
+    Face.objects.bulk_update(
+        [
+            Face(
+                id=int(face_id),
+                projection_x=float(x),
+                projection_y=float(y),
+                projection_z=float(z),
+            )
+            for face_id, (x, y, z) in zip(target_ids, projections)
+        ],
+        PROJECTION_FIELDS,
+        batch_size=PROJECTION_BATCH_SIZE,
+    )
+    logger.info("Updated face map positions of %d faces", len(target_ids))
+
+    return len(target_ids)
+
+
+def person_colors(user) -> dict[int, str]:
+    """Returns a stable face map color per person of the user."""
+
+    persons = list(
+        Person.objects.filter(faces__photo__owner=user)
+        .distinct()
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+
+    return dict(zip(persons, sns.color_palette(n_colors=len(persons)).as_hex()))
+
+
+def cluster_faces(user, inferred=True):
+    """Returns the face map of a user, the stored positions of all faces, ordered
+    by face id."""
+
+    faces = (
+        Face.objects.filter(photo__owner=user).exclude(projection_x=None).order_by("id")
+    )
+
+    if not inferred:
+        faces = faces.filter(person_label_is_inferred=False)
 
+    return faces
 
-def cluster_all_faces(user, job_id) -> bool:
-    """Clusters all faces for a given user."""
+
+def face_map_rows(rows, colors: dict[int, str]) -> list[dict]:
+    """Serializes `FACE_MAP_FIELDS` rows in the format of the face map endpoint."""
+
+    return [
+        {
+            "person_id": person_id,
+            "person_name": person_name,
+            "person_label_is_inferred": person_label_is_inferred,
+            "color": colors.get(person_id),
+            "face_url": default_storage.url(image),
+            "value": {"x": x, "y": y, "size": z},
+        }
+        for person_id, person_name, person_label_is_inferred, image, x, y, z in rows
+    ]
+
+
+def pack_face_map(faces) -> bytes:
+    """Packs face map entries into `FACE_MAP_DTYPE` records."""
+
+    return np.array(
+        list(
+            faces.values_list(
+                "id", "person_id", *PROJECTION_FIELDS, "person_label_is_inferred"
+            )
+        ),
+        dtype=FACE_MAP_DTYPE,
+    ).tobytes()
+
+
+def cluster_all_faces(user, job_id, full=False) -> bool:
+    """Clusters all faces for a given user.
+
+    By default only faces that have not been clustered yet are processed, see
+    `cluster_new_faces`. With `full`, all clusters are deleted and every face is
+    clustered again.
+    """
 
     if Job.objects.filter(job_id=job_id).exists():
         job = Job.objects.get(job_id=job_id)
@@ -85,10 +210,16 @@ def cluster_all_faces(user, job_id) -> bool:
     job.save()
 
     try:
-        delete_clustered_people(user)
-        delete_clusters(user)
-        delete_persons_without_faces()
-        target_count: int = create_all_clusters(user, job)
+        if full or not has_clusters(user):
+            delete_clustered_people(user)
+            delete_clusters(user)
+            delete_persons_without_faces()
+            target_count: int = create_all_clusters(user, job)
+            update_face_projections(user, full=True)
+
+        else:
+            target_count: int = cluster_new_faces(user, job)
+            update_face_projections(user)
 
         job.finished = True
         job.failed = False
@@ -112,25 +243,20 @@ def cluster_all_faces(user, job_id) -> bool:
         return False
 
 
-def create_all_clusters(user: User, job: Job = None) -> int:
-    """Creates all clusters for a given user."""
-
-    all_clusters: list[Cluster] = []
-    face: Face
-    logger.info("Creating clusters")
+def has_clusters(user: User) -> bool:
+    """Checks if the faces of a user have been clustered before."""
 
-    data = {
-        "all": {"encoding": [], "id": [], "person_id": [], "person_labeled": []},
-    }
-
-    for face in Face.objects.filter(photo__owner=user).prefetch_related("person"):
-        data["all"]["encoding"].append(face.get_encoding_array())
-        data["all"]["id"].append(face.id)
+    return (
+        Cluster.objects.filter(owner=user)
+        .exclude(cluster_id=UNKNOWN_CLUSTER_ID)
+        .exists()
+    )
 
-    target_count = len(data["all"]["id"])
 
-    if target_count == 0:
-        return target_count
+def fit_clusters(user: User, encodings: np.ndarray, face_count: int) -> np.ndarray:
+    """Runs the clustering backend of the user over the given encodings and
+    returns a label per row. The minimum cluster size is derived from
+    `face_count` unless the user set it."""
 
     min_cluster_size = 2
 
@@ -139,11 +265,11 @@ def create_all_clusters(user: User, job: Job = None) -> int:
         or user.min_cluster_size == 1
         or user.min_cluster_size is None
     ):
-        if target_count > 1000:
+        if face_count > 1000:
             min_cluster_size = 4
-        if target_count > 10000:
+        if face_count > 10000:
             min_cluster_size = 8
-        if target_count > 100000:
+        if face_count > 100000:
             min_cluster_size = 16
     else:
         min_cluster_size = user.min_cluster_size
@@ -153,30 +279,49 @@ def create_all_clusters(user: User, job: Job = None) -> int:
     if user.min_samples > 0:
         min_samples = user.min_samples
 
-    clt = HDBSCAN(
+    if len(encodings) < max(min_cluster_size, 2):
+        return np.full(len(encodings), UNKNOWN_CLUSTER_ID)
+
+    logger.info("Before finding clusters with %s", user.face_clustering_backend)
+
+    labels = cluster_encodings(
+        encodings,
+        user.face_clustering_backend,
         min_cluster_size=min_cluster_size,
         min_samples=min_samples,
         cluster_selection_epsilon=user.cluster_selection_epsilon,
-        metric="euclidean",
+        threshold=user.face_clustering_threshold,
     )
 
-    logger.info("Before finding clusters")
+    logger.info("After finding clusters")
 
-    clt.fit(np.array(data["all"]["encoding"]))
+    return labels
 
-    logger.info("After finding clusters")
 
-    label_ids = np.unique(clt.labels_)
+def add_clusters(
+    user: User,
+    face_ids: np.ndarray,
+    encodings: np.ndarray,
+    labels: np.ndarray,
+    job: Job = None,
+    first_cluster_id: int = 0,
+) -> list[Cluster]:
+    """Stores the clusters found by `fit_clusters`. Cluster ids are numbered by
+    size, starting after `first_cluster_id`."""
+
+    all_clusters: list[Cluster] = []
+    label_ids = np.unique(labels)
     label_id: np.intp
     commit_time = datetime.datetime.now() + datetime.timedelta(seconds=5)
     count: int = 0
-    max_len: int = len(str(np.size(label_ids)))
+    target_count = len(face_ids)
+    max_len: int = len(str(first_cluster_id + np.size(label_ids)))
     sorted_indexes: dict[int, np.ndarray] = dict()
-    cluster_count: int = 0
+    cluster_count: int = first_cluster_id
     cluster_id: int
 
     for label_id in label_ids:
-        idxs = np.where(clt.labels_ == label_id)[0]
+        idxs = np.where(labels == label_id)[0]
         sorted_indexes[label_id] = idxs
 
     logger.info("Found %d clusters.", len(sorted_indexes))
@@ -191,17 +336,10 @@ def create_all_clusters(user: User, job: Job = None) -> int:
         else:
             cluster_id = label_id
 
-        face_array: list[Face] = []
-        face_id_list: list[int] = []
-
-        for i in sorted_indexes[label_id]:
-            count = count + 1
-            face_id = data["all"]["id"][i]
-            face_id_list.append(face_id)
-
-        face_array = Face.objects.filter(pk__in=face_id_list)
+        idxs = sorted_indexes[label_id]
+        count = count + len(idxs)
         new_clusters: list[Cluster] = ClusterManager.try_add_cluster(
-            user, cluster_id, face_array, max_len
+            user, cluster_id, face_ids[idxs], encodings[idxs], max_len
         )
 
         if commit_time < datetime.datetime.now() and job is not None:
@@ -211,8 +349,142 @@ def create_all_clusters(user: User, job: Job = None) -> int:
 
         all_clusters.extend(new_clusters)
 
+    return all_clusters
+
+
+def create_all_clusters(user: User, job: Job = None) -> int:
+    """Creates all clusters for a given user."""
+
+    logger.info("Creating clusters")
+
+    face_ids, encodings = load_face_encodings(user)
+    target_count = len(face_ids)
+
+    if target_count == 0:
+        return target_count
+
+    labels = fit_clusters(user, encodings, target_count)
+    all_clusters = add_clusters(user, face_ids, encodings, labels, job)
+
     print(f"Created {len(all_clusters)} clusters.")
 
+    return target_count
+
+
+def assign_to_clusters(
+    user: User, face_ids: list[int], encodings: np.ndarray
+) -> np.ndarray:
+    """Assigns faces to the existing cluster with the nearest mean encoding, if it
+    is closer than the face clustering threshold of the user. Returns a mask of
+    the assigned faces."""
+
+    clusters = list(
+        Cluster.objects.filter(owner=user)
+        .exclude(cluster_id=UNKNOWN_CLUSTER_ID)
+        .exclude(mean_face_encoding=None)
+        .exclude(person=None)
+        .select_related("person")
+        .annotate(face_count=Count("faces"))
+    )
+
+    if not clusters or len(face_ids) == 0:
+        return np.zeros(len(face_ids), dtype=bool)
+
+    centroids = np.stack(
+        [cluster.get_mean_encoding_array() for cluster in clusters]
+    ).astype(np.float32)
+    nearest, distances = nearest_centroids(encodings, centroids)
+    assigned = distances < user.face_clustering_threshold
+    unknown_person: Person = get_unknown_person(owner=user)
+    face_ids = np.asarray(face_ids)
+
+    for idx in np.unique(nearest[assigned]):
+        cluster = clusters[idx]
+        members = assigned & (nearest == idx)
+        member_ids = face_ids[members].tolist()
+
+        # Faces that already carry a name keep it, the rest join the person of
+        # the cluster. Matches of user labelled persons are marked as inferred.
+        Face.objects.filter(id__in=member_ids).exclude(person=unknown_person).update(
+            cluster=cluster
+        )
+        Face.objects.filter(id__in=member_ids, person=unknown_person).update(
+            cluster=cluster,
+            person=cluster.person,
+            person_label_is_inferred=cluster.person.kind != Person.KIND_CLUSTER,
+        )
+
+        count = cluster.face_count
+        cluster.mean_face_encoding = pack_encoding(
+            (centroids[idx] * count + encodings[members].sum(axis=0))
+            / (count + len(member_ids))
+        )
+
+    Cluster.objects.bulk_update(clusters, ["mean_face_encoding"])
+
+    return assigned
+
+
+def cluster_new_faces(user: User, job: Job = None) -> int:
+    """Clusters only the faces that were added since the last run.
+
+    New faces are first matched against the mean encodings of existing clusters.
+    The faces that match no cluster are clustered again together with the faces
+    of the unknown cluster, so that enough new faces of a person form a cluster
+    of their own. The work depends on the number of new and unclustered faces,
+    not on the size of the library.
+    """
+
+    new_face_ids = list(
+        Face.objects.filter(photo__owner=user, cluster=None)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+    target_count = len(new_face_ids)
+    logger.info("Clustering %d new faces", target_count)
+
+    if target_count == 0:
+        return target_count
+
+    face_ids, encodings = load_face_encodings(user)
+    new_encodings = np.asarray(select(face_ids, encodings, new_face_ids))
+    assigned = assign_to_clusters(user, new_face_ids, new_encodings)
+    logger.info(
+        "Assigned %d new faces to existing clusters", np.count_nonzero(assigned)
+    )
+
+    unknown_face_ids = list(
+        Face.objects.filter(photo__owner=user, cluster__cluster_id=UNKNOWN_CLUSTER_ID)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+    residue_ids = np.concatenate(
+        [np.asarray(new_face_ids)[~assigned], np.asarray(unknown_face_ids)]
+    ).astype(np.int64)
+    residue_encodings = np.concatenate(
+        [new_encodings[~assigned], select(face_ids, encodings, unknown_face_ids)]
+    )
+
+    if len(residue_ids) != 0:
+        labels = fit_clusters(user, residue_encodings, len(residue_ids))
+        last_cluster_id = (
+            Cluster.objects.filter(owner=user).aggregate(Max("cluster_id"))[
+                "cluster_id__max"
+            ]
+            or 0
+        )
+        all_clusters = add_clusters(
+            user,
+            residue_ids,
+            residue_encodings,
+            labels,
+            job,
+            max(last_cluster_id, 0),
+        )
+        print(f"Created {len(all_clusters)} clusters.")
+
+    return target_count
+
 
 def delete_persons_without_faces():
     """Delete all existing Person records that have no associated Face records"""
@@ -262,36 +534,58 @@ def train_faces(user: User, job_id) -> bool:
     unknown_person: Person = get_unknown_person(owner=user)
 
     try:
-        data_known = {"encoding": [], "id": []}
-        data_unknown = {"encoding": [], "id": []}
-        face: Face
-
-        for face in Face.objects.filter(Q(photo__owner=user)).prefetch_related(
-            "person"
+        face_ids, encodings = load_face_encodings(user)
+        known_face_ids = []
+        known_labels = []
+        unknown_faces = []
+
+        for (
+            face_id,
+            person_id,
+            person_label_is_inferred,
+            person_label_probability,
+            person_kind,
+        ) in (
+            Face.objects.filter(Q(photo__owner=user))
+            .order_by("id")
+            .values_list(
+                "id",
+                "person_id",
+                "person_label_is_inferred",
+                "person_label_probability",
+                "person__kind",
+            )
         ):
-            person: Person = face.person
             unknown = (
-                face.person_label_is_inferred is not False
-                or person.kind == Person.KIND_CLUSTER
-                or person.kind == Person.KIND_UNKNOWN
+                person_label_is_inferred is not False
+                or person_kind == Person.KIND_CLUSTER
+                or person_kind == Person.KIND_UNKNOWN
             )
 
             if unknown:
-                data_unknown["encoding"].append(face.get_encoding_array())
-                data_unknown["id"].append(face.id if unknown else face.person.id)
+                unknown_faces.append(
+                    (
+                        face_id,
+                        person_id,
+                        person_label_is_inferred,
+                        person_label_probability,
+                    )
+                )
 
             else:
-                data_known["encoding"].append(face.get_encoding_array())
-                data_known["id"].append(face.id if unknown else face.person.id)
+                known_face_ids.append(face_id)
+                known_labels.append(person_id)
 
-        cluster: Cluster
+        known_encodings = [select(face_ids, encodings, known_face_ids)]
 
-        for cluster in Cluster.objects.filter(owner=user):
-            if cluster.person.kind == Person.KIND_CLUSTER:
-                data_known["encoding"].append(cluster.get_mean_encoding_array())
-                data_known["id"].append(cluster.person.id)
+        for person_id, mean_face_encoding in Cluster.objects.filter(
+            owner=user, person__kind=Person.KIND_CLUSTER
+        ).values_list("person_id", "mean_face_encoding"):
+            if mean_face_encoding:
+                known_encodings.append(unpack_encoding(mean_face_encoding)[None, :])
+                known_labels.append(person_id)
 
-        if len(data_known["id"]) == 0:
+        if len(known_labels) == 0:
             logger.info("No labeled faces found.")
             job.finished = True
             job.failed = False
@@ -301,93 +595,65 @@ def train_faces(user: User, job_id) -> bool:
 
         else:
             logger.info("Before fitting")
-            clf = MLPClassifier(
-                solver="adam", alpha=1e-5, random_state=1, max_iter=1000
-            ).fit(np.array(data_known["encoding"]), np.array(data_known["id"]))
+            clf = fit_classifier(
+                user, np.concatenate(known_encodings), np.array(known_labels)
+            )
             logger.info("After fitting")
 
-            target_count = len(data_unknown["id"])
+            target_count = len(unknown_faces)
             logger.info("Number of Cluster: %d.", target_count)
 
             if target_count != 0:
-                pages_encoding = [
-                    data_unknown["encoding"][i : i + 100]
-                    for i in range(0, len(data_unknown["encoding"]), 100)
-                ]
-                pages_id = [
-                    data_unknown["id"][i : i + 100]
-                    for i in range(0, len(data_unknown["encoding"]), 100)
-                ]
-
-                for idx, page in enumerate(pages_encoding):
-                    page_id = pages_id[idx]
-                    pages_of_faces = Face.objects.filter(id__in=page_id).all()
-                    pages_of_faces = sorted(
-                        pages_of_faces,
-                        key=lambda x: page_id.index(  # pylint: disable=cell-var-from-loop
-                            x.id
-                        ),
+                unknown_ids, current_person_ids, current_inferred, current_prob = zip(
+                    *unknown_faces
+                )
+                best_person_ids, best_probabilities, probabilities = predict(
+                    clf,
+                    select(face_ids, encodings, unknown_ids),
+                    np.array(current_person_ids),
+                )
+                confident = (
+                    (probabilities > user.confidence_unknown_face)
+                    | (user.confidence_unknown_face == 0)
+                ) & (best_person_ids != unknown_person.id)
+                label_probabilities = np.where(
+                    confident, best_probabilities, probabilities
+                )
+
+                # Only faces whose label actually changes are written back.
+                changed_faces = [
+                    Face(
+                        id=face_id,
+                        person_id=int(person_id),
+                        person_label_is_inferred=bool(inferred),
+                        person_label_probability=float(probability),
                     )
-                    face_encodings_unknown_np = np.array(page)
-                    probs = clf.predict_proba(face_encodings_unknown_np)
-                    commit_time = datetime.datetime.now() + datetime.timedelta(
-                        seconds=5
+                    for (
+                        face_id,
+                        person_id,
+                        inferred,
+                        probability,
+                        old_person_id,
+                        old_inferred,
+                        old_probability,
+                    ) in zip(
+                        unknown_ids,
+                        best_person_ids,
+                        confident,
+                        label_probabilities,
+                        current_person_ids,
+                        current_inferred,
+                        current_prob,
                     )
-                    face_stack == []  # pylint: disable=pointless-statement
-
-                    for idx, (face, probability_array) in enumerate(
-                        zip(pages_of_faces, probs)
-                    ):
-                        if (
-                            face.person is unknown_person
-                            or face.person.kind == Person.KIND_UNKNOWN
-                        ):
-                            face.person_label_is_inferred = False
-
-                        else:
-                            face.person_label_is_inferred = True
-
-                        probability: np.float64 = 0
-
-                        highest_probability = max(probability_array)
-                        highest_probability_person = 0
-
-                        for i, target in enumerate(clf.classes_):
-                            if highest_probability == probability_array[i]:
-                                highest_probability_person = target
-
-                            if target == face.person.id:
-                                probability = probability_array[i]
-
-                        face.person = Person.objects.get(id=highest_probability_person)
-
-                        if (
-                            probability > user.confidence_unknown_face
-                            or user.confidence_unknown_face == 0
-                        ) and face.person.id != unknown_person.id:
-                            face.person_label_is_inferred = True
-                            face.person_label_probability = highest_probability
-
-                        else:
-                            face.person_label_is_inferred = False
-                            face.person_label_probability = probability
-
-                        face_stack.append(face)
-
-                        if commit_time < datetime.datetime.now():
-                            job.result = {
-                                "progress": {"current": idx + 1, "target": target_count}
-                            }
-                            job.save()
-                            commit_time = datetime.datetime.now() + datetime.timedelta(
-                                seconds=5
-                            )
-
-                        if len(face_stack) > 200:
-                            bulk_update(face_stack, update_fields=FACE_CLASSIFY_COLUMNS)
-                            face_stack = []
-
-                    bulk_update(face_stack, update_fields=FACE_CLASSIFY_COLUMNS)
+                    if (person_id, inferred, probability)
+                    != (old_person_id, old_inferred, old_probability)
+                ]
+                logger.info("Updating labels of %d faces.", len(changed_faces))
+                Face.objects.bulk_update(
+                    changed_faces,
+                    FACE_CLASSIFY_COLUMNS,
+                    batch_size=FACE_CLASSIFY_BATCH_SIZE,
+                )
 
             job.finished = True
             job.failed = False
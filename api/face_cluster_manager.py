@@ -1,7 +1,5 @@
-# pylint: disable=consider-iterating-dictionary
 """Manager for clusters."""
 
-import math
 import numpy as np
 
 from api.models.cluster import Cluster, get_unknown_cluster, UNKNOWN_CLUSTER_ID
@@ -10,155 +8,160 @@ from api.models.person import Person, get_or_create_person, get_unknown_person
 from api.models.user import User
 from api.utils import logger
 
+ASSIGN_BATCH_SIZE = 4096
+
+
+def nearest_centroids(
+    encodings: np.ndarray, centroids: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the index of and the euclidean distance to the nearest centroid for
+    every encoding."""
+
+    nearest = np.empty(len(encodings), dtype=np.intp)
+    distances = np.empty(len(encodings), dtype=np.float32)
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+
+    for start in range(0, len(encodings), ASSIGN_BATCH_SIZE):
+        batch = encodings[start : start + ASSIGN_BATCH_SIZE]
+        squared = (
+            np.einsum("ij,ij->i", batch, batch)[:, None]
+            - 2 * batch @ centroids.T
+            + centroid_norms[None, :]
+        )
+        idx = np.argmin(squared, axis=1)
+        nearest[start : start + len(batch)] = idx
+        distances[start : start + len(batch)] = np.sqrt(
+            np.maximum(squared[np.arange(len(batch)), idx], 0)
+        )
+
+    return nearest, distances
+
 
 class ClusterManager:
     """Cluster manager."""
 
     @staticmethod
     def try_add_cluster(
-        user: User, cluster_id: int, faces: list[Face], pad_len: int = 1
+        user: User,
+        cluster_id: int,
+        face_ids: list[int],
+        encodings: np.ndarray,
+        pad_len: int = 1,
     ) -> list[Cluster]:
         """Adds a cluster of faces to the database. The cluster is identified by a unique ID
-        and can be either a known cluster or an unknown cluster."""
+        and can be either a known cluster or an unknown cluster.
 
-        added_clusters: list[Cluster] = []
-        known_faces: list[Face] = []
-        face_ids_by_cluster: dict[int, list[int]] = dict()
-        unknown_faces: list[Face] = []
-        unknown_ids: list[int] = []
-        encoding_by_person: dict[int, list[np.ndarray]] = dict()
+        `encodings` holds the encodings of `face_ids`, in the same order.
+        """
 
-        face: Face
+        added_clusters: list[Cluster] = []
         new_cluster: Cluster
         unknown_cluster: Cluster = get_unknown_cluster(user=user)
         unknown_person: Person = get_unknown_person(owner=user)
         label_str = str(cluster_id).zfill(pad_len)
 
-        for face in faces:
-            if (
-                face.person.name == "unknown"
-                or face.person.name == Person.UNKNOWN_PERSON_NAME
-                or face.person_label_is_inferred is True
-            ):
-                unknown_faces.append(face)
-                unknown_ids.append(face.id)
-
-            else:
-                known_faces.append(face)
+        face_ids = [int(face_id) for face_id in face_ids]
+        rows = dict(
+            (face_id, (person_id, person_name, person_label_is_inferred))
+            for face_id, person_id, person_name, person_label_is_inferred in (
+                Face.objects.filter(id__in=face_ids).values_list(
+                    "id", "person_id", "person__name", "person_label_is_inferred"
+                )
+            )
+        )
+        present = [i for i, face_id in enumerate(face_ids) if face_id in rows]
+        face_ids = np.asarray(face_ids, dtype=np.int64)[present]
+        encodings = np.asarray(encodings)[present]
+        person_ids = np.asarray([rows[face_id][0] for face_id in face_ids.tolist()])
+        unknown = np.asarray(
+            [
+                rows[face_id][1] == "unknown"
+                or rows[face_id][1] == Person.UNKNOWN_PERSON_NAME
+                or rows[face_id][2] is True
+                for face_id in face_ids.tolist()
+            ],
+            dtype=bool,
+        )
+        unknown_ids = face_ids[unknown].tolist()
+        known_ids = face_ids[~unknown].tolist()
 
         if cluster_id == UNKNOWN_CLUSTER_ID:
             logger.info("Adding unknown cluster")
-            logger.info(
-                "Adding unknown %d faces to unknown cluster", len(unknown_faces)
-            )
-            logger.info("Adding known %d faces to unknown cluster", len(known_faces))
-
-            for face in unknown_faces:
-                face.cluster = unknown_cluster
-                face.person = unknown_person
-                face.person_label_is_inferred = False
-                face.save()
+            logger.info("Adding unknown %d faces to unknown cluster", len(unknown_ids))
+            logger.info("Adding known %d faces to unknown cluster", len(known_ids))
 
-            for face in known_faces:
-                face.cluster = unknown_cluster
-                face.save()
+            Face.objects.filter(id__in=unknown_ids).update(
+                cluster=unknown_cluster,
+                person=unknown_person,
+                person_label_is_inferred=False,
+            )
+            Face.objects.filter(id__in=known_ids).update(cluster=unknown_cluster)
 
             return added_clusters
 
-        if len(known_faces) == 0:
-            new_cluster: Cluster
-            new_person: Person
-
-            new_person = get_or_create_person(
+        if len(known_ids) == 0:
+            new_person: Person = get_or_create_person(
                 name="Unknown " + label_str, owner=user, kind=Person.KIND_CLUSTER
             )
             new_person.cluster_owner = user
             new_person.save()
             new_cluster = Cluster.get_or_create_cluster_by_id(user, cluster_id)
             new_cluster.name = "Cluster " + str(cluster_id)
-
             new_cluster.person = new_person
-            encoding_by_person[new_cluster.person.id] = []
+            new_cluster.set_metadata(encodings)
             new_cluster.save()
             added_clusters.append(new_cluster)
 
-            for face in unknown_faces:
-                encoding_by_person[new_cluster.person.id].append(
-                    face.get_encoding_array()
-                )
-
             Face.objects.filter(id__in=unknown_ids).update(
                 cluster=new_cluster, person=new_person, person_label_is_inferred=False
             )
 
-        else:
-            clusters_by_person: dict[int, Cluster] = dict()
-            mean_encoding_by_cluster: dict[int, list[np.ndarray]] = dict()
-            idx: int = 0
-
-            for face in known_faces:
-                if face.person.id not in clusters_by_person.keys():
-                    idx = idx + 1
-                    new_cluster = Cluster.get_or_create_cluster_by_name(
-                        user, "Cluster " + str(cluster_id) + "-" + str(idx)
-                    )
-                    new_cluster.cluster_id = cluster_id
-                    new_cluster.person = face.person
-                    clusters_by_person[new_cluster.person.id] = new_cluster
-                    added_clusters.append(new_cluster)
-                    encoding_by_person[face.person.id] = []
-                    face_ids_by_cluster[new_cluster.id] = []
-
-                else:
-                    new_cluster = clusters_by_person[face.person.id]
-
-                encoding_by_person[face.person.id].append(face.get_encoding_array())
-                face_ids_by_cluster[new_cluster.id].append(face.id)
-
-            for new_cluster in added_clusters:
-                Face.objects.filter(id__in=face_ids_by_cluster[new_cluster.id]).update(
-                    cluster=new_cluster, person_label_is_inferred=False
-                )
+            return added_clusters
 
-            # Set initial metadata on the split clusters based on known faces.
-            for new_cluster in added_clusters:
-                new_cluster.set_metadata(encoding_by_person[new_cluster.person.id])
-                mean_encoding_by_cluster[new_cluster.id] = (
-                    new_cluster.get_mean_encoding_array()
-                )
+        # Split the cluster by the persons of its labelled faces, in order of
+        # their first appearance.
+        known_person_ids = list(dict.fromkeys(person_ids[~unknown].tolist()))
 
-            # Clear the face IDs list to prepare for processing the unknown faces.
-            for new_cluster in added_clusters:
-                face_ids_by_cluster[new_cluster.id] = []
-
-            # Loop over all unknown faces and find the closest "known" cluster.
-            for face in unknown_faces:
-                encoding = face.get_encoding_array()
-                closest_cluster: Cluster
-                min_distance: np.float64 = np.Infinity
-
-                for new_cluster in added_clusters:
-                    distance = math.dist(
-                        encoding, mean_encoding_by_cluster[new_cluster.id]
-                    )
-
-                    if distance < min_distance:
-                        closest_cluster = new_cluster
-                        min_distance = distance
-
-                face_ids_by_cluster[closest_cluster.id].append(face.id)
-                encoding_by_person[closest_cluster.person.id].append(encoding)
-
-            for new_cluster in added_clusters:
-                Face.objects.filter(id__in=face_ids_by_cluster[new_cluster.id]).update(
-                    cluster=new_cluster,
-                    person_label_is_inferred=True,
-                    person=new_cluster.person,
-                )
+        for idx, person_id in enumerate(known_person_ids, start=1):
+            new_cluster = Cluster.get_or_create_cluster_by_name(
+                user, "Cluster " + str(cluster_id) + "-" + str(idx)
+            )
+            new_cluster.cluster_id = cluster_id
+            new_cluster.person_id = person_id
+            added_clusters.append(new_cluster)
 
-        # Update statistics again and save everything since we've added more faces.
-        for new_cluster in added_clusters:
-            new_cluster.set_metadata(encoding_by_person[new_cluster.person.id])
-            new_cluster.save()
+        known_members = [
+            ~unknown & (person_ids == person_id) for person_id in known_person_ids
+        ]
+        centroids = np.stack(
+            [encodings[members].mean(axis=0) for members in known_members]
+        )
+
+        # Assign every unknown face to the closest split cluster at once.
+        members_by_cluster = [members.copy() for members in known_members]
+
+        if np.any(unknown):
+            nearest, _ = nearest_centroids(encodings[unknown], centroids)
+            unknown_rows = np.flatnonzero(unknown)
+
+            for idx, members in enumerate(members_by_cluster):
+                members[unknown_rows[nearest == idx]] = True
+
+        for new_cluster, known, members in zip(
+            added_clusters, known_members, members_by_cluster
+        ):
+            Face.objects.filter(id__in=face_ids[known].tolist()).update(
+                cluster=new_cluster, person_label_is_inferred=False
+            )
+            Face.objects.filter(id__in=face_ids[members & unknown].tolist()).update(
+                cluster=new_cluster,
+                person_label_is_inferred=True,
+                person_id=new_cluster.person_id,
+            )
+            new_cluster.set_metadata(encodings[members])
+
+        Cluster.objects.bulk_update(
+            added_clusters, ["cluster_id", "person", "mean_face_encoding"]
+        )
 
         return added_clusters
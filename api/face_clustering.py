@@ -0,0 +1,122 @@
+"""Clustering backends for face encodings.
+
+HDBSCAN works on the full pairwise structure of the encodings and becomes slow
+and memory hungry for very large libraries. The kNN graph backend only looks at
+the nearest neighbours of every face, found with FAISS, and clusters the
+connected components of that graph.
+"""
+
+import faiss
+import numpy as np
+from hdbscan import HDBSCAN
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+NOISE_LABEL = -1
+
+HDBSCAN_BACKEND = "HDBSCAN"
+KNN_GRAPH_BACKEND = "KNN_GRAPH"
+
+# Number of neighbours every face is linked to in the kNN graph.
+GRAPH_NEIGHBORS = 10
+# Above this many faces the neighbour search uses an approximate HNSW index.
+EXACT_SEARCH_LIMIT = 50000
+HNSW_NEIGHBORS = 32
+
+
+def hdbscan_labels(
+    encodings: np.ndarray,
+    min_cluster_size: int,
+    min_samples: int,
+    cluster_selection_epsilon: float,
+) -> np.ndarray:
+    """Clusters encodings with HDBSCAN."""
+
+    clt = HDBSCAN(
+        min_cluster_size=min_cluster_size,
+        min_samples=min_samples,
+        cluster_selection_epsilon=cluster_selection_epsilon,
+        metric="euclidean",
+    )
+    clt.fit(encodings)
+
+    return clt.labels_
+
+
+def knn_search(encodings: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the euclidean distances to and the indexes of the `k` nearest
+    neighbours of every encoding, excluding itself."""
+
+    encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+    dim = encodings.shape[1]
+
+    if len(encodings) > EXACT_SEARCH_LIMIT:
+        index = faiss.IndexHNSWFlat(dim, HNSW_NEIGHBORS)
+    else:
+        index = faiss.IndexFlatL2(dim)
+
+    index.add(encodings)
+    k = min(k + 1, len(encodings))
+    squared, neighbors = index.search(encodings, k)
+
+    return np.sqrt(np.maximum(squared[:, 1:], 0)), neighbors[:, 1:]
+
+
+def knn_graph_labels(
+    encodings: np.ndarray,
+    min_cluster_size: int,
+    min_samples: int,
+    threshold: float,
+    neighbors: int = GRAPH_NEIGHBORS,
+) -> np.ndarray:
+    """Clusters encodings on their kNN graph.
+
+    Faces are linked to those of their nearest neighbours that are closer than
+    `threshold`. Faces with fewer than `min_samples` links are treated as noise,
+    and every connected component with at least `min_cluster_size` faces becomes
+    a cluster.
+    """
+
+    count = len(encodings)
+    labels = np.full(count, NOISE_LABEL)
+
+    if count < 2:
+        return labels
+
+    distances, indexes = knn_search(encodings, neighbors)
+    linked = (distances < threshold) & (indexes >= 0)
+    core = np.count_nonzero(linked, axis=1) >= max(min_samples, 1)
+    rows = np.repeat(np.arange(count), indexes.shape[1])[linked.ravel()]
+    cols = indexes.ravel()[linked.ravel()]
+    keep = core[rows] & core[cols]
+    graph = coo_matrix(
+        (np.ones(np.count_nonzero(keep), dtype=np.int8), (rows[keep], cols[keep])),
+        shape=(count, count),
+    )
+    _, components = connected_components(graph, directed=False)
+    sizes = np.bincount(components)
+    clustered = core & (sizes[components] >= min_cluster_size)
+
+    # Renumber the remaining components to 0..n, like HDBSCAN does.
+    _, labels[clustered] = np.unique(components[clustered], return_inverse=True)
+
+    return labels
+
+
+def cluster_encodings(
+    encodings: np.ndarray,
+    backend: str,
+    min_cluster_size: int,
+    min_samples: int,
+    cluster_selection_epsilon: float,
+    threshold: float,
+) -> np.ndarray:
+    """Clusters encodings with the given backend and returns a label per row,
+    `NOISE_LABEL` for faces that belong to no cluster."""
+
+    if backend == KNN_GRAPH_BACKEND:
+        return knn_graph_labels(encodings, min_cluster_size, min_samples, threshold)
+
+    return hdbscan_labels(
+        encodings, min_cluster_size, min_samples, cluster_selection_epsilon
+    )
@@ -0,0 +1,43 @@
+"""Binary storage format for face encodings.
+
+Encodings are stored as raw little-endian float32 bytes, 512 bytes for a
+128-dimensional vector, instead of hex encoded float64 text.
+"""
+
+import numpy as np
+
+ENCODING_DTYPE = np.dtype("<f4")
+ENCODING_SIZE = 128
+
+
+def pack_encoding(encoding) -> bytes:
+    """Packs a face encoding into its binary storage format."""
+
+    return np.asarray(encoding, dtype=ENCODING_DTYPE).tobytes()
+
+
+def unpack_encoding(data) -> np.ndarray:
+    """Unpacks a single stored face encoding."""
+
+    return np.frombuffer(data, dtype=ENCODING_DTYPE)
+
+
+def unpack_encodings(blobs) -> np.ndarray:
+    """Unpacks many stored face encodings into an (N, 128) matrix by joining the
+    raw bytes once, instead of decoding every row on its own."""
+
+    return np.frombuffer(b"".join(blobs), dtype=ENCODING_DTYPE).reshape(
+        -1, ENCODING_SIZE
+    )
+
+
+def legacy_hex_to_binary(value: str) -> bytes:
+    """Converts a hex encoded float64 encoding to the binary storage format."""
+
+    return pack_encoding(np.frombuffer(bytes.fromhex(value), dtype=np.float64))
+
+
+def binary_to_legacy_hex(data) -> str:
+    """Converts a binary encoding back to hex encoded float64."""
+
+    return unpack_encoding(data).astype(np.float64).tobytes().hex()
@@ -4,7 +4,11 @@ import numpy as np
 import PIL
 
 from api.exif_tags import Tags
-from api.face_recognition import get_face_locations
+from api.face_recognition import (
+    detect_and_encode_faces,
+    detect_and_encode_faces_batch,
+    get_face_locations,
+)
 from api.utils import get_metadata, is_number, logger
 
 
@@ -114,11 +118,21 @@ def extract_from_exif(image_path, optimized_image):
     return face_locations
 
 
+def get_model(owner):
+    """Returns the face detection model the owner has selected."""
+
+    return owner.face_recognition_model.lower()
+
+
 def extract_from_dlib(image_path, optimized_image, owner):
     """Extracts face locations from a given image using the dlib library."""
 
+    face_locations = []
+
     try:
-        face_locations = get_face_locations(image_path=optimized_image)
+        face_locations = get_face_locations(
+            image_path=optimized_image, model=get_model(owner)
+        )
 
     except Exception as e:  # pylint: disable=broad-except
         logger.info("Can't extract face information on photo: %s", image_path)
@@ -130,6 +144,51 @@ def extract_from_dlib(image_path, optimized_image, owner):
     return face_locations
 
 
+def _with_names(detections):
+    detections["face_locations"] = [
+        (*face_location, None) for face_location in detections["face_locations"]
+    ]
+
+    return detections
+
+
+def extract_and_encode(image_path, optimized_image, owner):
+    """Extracts face locations, encodings and crops of an image with a single
+    request to the face recognition service."""
+
+    try:
+        detections = detect_and_encode_faces(optimized_image, model=get_model(owner))
+
+    except Exception as e:  # pylint: disable=broad-except
+        logger.info("Can't extract face information on photo: %s", image_path)
+        logger.info(e)
+
+        return {"face_locations": [], "encodings": [], "crops": []}
+
+    return _with_names(detections)
+
+
+def extract_and_encode_batch(optimized_images, owner):
+    """Extracts face locations, encodings and crops for many optimized images with
+    a single batched request. Images that could not be processed are left out of
+    the result."""
+
+    try:
+        detections = detect_and_encode_faces_batch(
+            optimized_images, model=get_model(owner)
+        )
+    except Exception as e:  # pylint: disable=broad-except
+        logger.info(
+            "Can't extract face information on a batch of %d photos",
+            len(optimized_images),
+        )
+        logger.info(e)
+
+        return {}
+
+    return {path: _with_names(result) for path, result in detections.items()}
+
+
 def extract(image_path, optimized_image, owner):
     """Extracts face information from an image using either EXIF metadata or Dlib."""
 
@@ -0,0 +1,185 @@
+"""Stores detected faces of many photos at once."""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import api.models
+from api.embedding_store import face_store
+from api.face_encoding import pack_encoding, unpack_encodings
+from api.rendition_store import FACES, rendition_name, rendition_path
+from api.utils import logger
+
+# Detections within this fraction of the box width of an existing face are the
+# same face.
+DUPLICATE_MARGIN = 0.05
+CROP_WRITERS = 8
+
+
+def is_duplicate(box, boxes: np.ndarray) -> bool:
+    """Checks if a (top, right, bottom, left) box matches any of `boxes`."""
+
+    if len(boxes) == 0:
+        return False
+
+    margin = int((box[1] - box[3]) * DUPLICATE_MARGIN)
+
+    return bool(np.any(np.all(np.abs(boxes - np.asarray(box)) <= margin, axis=1)))
+
+
+def _existing_faces(photos):
+    """Returns the boxes and crop file names of the stored faces per photo."""
+
+    boxes = {photo.image_hash: [] for photo in photos}
+    names = {photo.image_hash: set() for photo in photos}
+
+    for (
+        photo_id,
+        top,
+        right,
+        bottom,
+        left,
+        image,
+    ) in api.models.face.Face.objects.filter(photo__in=photos).values_list(
+        "photo_id",
+        "location_top",
+        "location_right",
+        "location_bottom",
+        "location_left",
+        "image",
+    ):
+        boxes[photo_id].append((top, right, bottom, left))
+        names[photo_id].add(os.path.basename(image or ""))
+
+    return {
+        image_hash: np.array(photo_boxes, dtype=np.int64).reshape(-1, 4)
+        for image_hash, photo_boxes in boxes.items()
+    }, names
+
+
+def _crop_name(image_hash, taken_names):
+    idx = 0
+
+    while f"{image_hash}_{idx}.jpg" in taken_names:
+        idx += 1
+
+    filename = f"{image_hash}_{idx}.jpg"
+    taken_names.add(filename)
+
+    return filename
+
+
+def _write_crop(name_and_data):
+    name, data = name_and_data
+
+    with open(rendition_path(name, create_dirs=True), "wb") as f:
+        f.write(data)
+
+
+def save_faces(detections_by_photo) -> int:
+    """Stores the detected faces of many photos.
+
+    `detections_by_photo` is a list of (photo, detections) pairs, as returned by
+    `face_extractor.extract_and_encode`. Detections that match a face already
+    stored for the photo are skipped. Crops are written concurrently, the rows
+    are created with a single bulk insert, and the counters of named persons are
+    refreshed once. Returns the number of new faces.
+    """
+
+    photos = [photo for photo, _ in detections_by_photo]
+
+    if not photos:
+        return 0
+
+    existing_boxes, taken_names = _existing_faces(photos)
+    persons = {}
+    unknown_persons = {}
+    named_persons = {}
+    faces = []
+    crops = []
+
+    for photo, detections in detections_by_photo:
+        boxes = existing_boxes[photo.image_hash]
+
+        if photo.owner_id not in unknown_persons:
+            unknown_persons[photo.owner_id] = api.models.person.get_unknown_person(
+                owner=photo.owner
+            )
+
+        for face_encoding, face_location, face_crop in zip(
+            detections["encodings"],
+            detections["face_locations"],
+            detections["crops"],
+        ):
+            top, right, bottom, left, person_name = face_location
+            box = (top, right, bottom, left)
+
+            if is_duplicate(box, boxes):
+                continue
+
+            boxes = np.vstack([boxes, box])
+
+            if person_name:
+                key = (photo.owner_id, person_name)
+
+                if key not in persons:
+                    persons[key] = api.models.person.get_or_create_person(
+                        name=person_name, owner=photo.owner
+                    )
+
+                person = persons[key]
+                named_persons[person.id] = person
+
+            else:
+                person = unknown_persons[photo.owner_id]
+
+            face = api.models.face.Face(
+                photo=photo,
+                location_top=top,
+                location_right=right,
+                location_bottom=bottom,
+                location_left=left,
+                encoding=pack_encoding(face_encoding),
+                person=person,
+                # Faces without a cluster are picked up by the next
+                # incremental clustering run.
+                cluster=None,
+            )
+            face.image.name = rendition_name(
+                FACES, _crop_name(photo.image_hash, taken_names[photo.image_hash])
+            )
+            faces.append(face)
+            crops.append((face.image.name, face_crop))
+
+    if not faces:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=CROP_WRITERS) as executor:
+        list(executor.map(_write_crop, crops))
+
+    try:
+        api.models.face.Face.objects.bulk_create(faces)
+    except Exception:
+        for name, _ in crops:
+            if os.path.exists(rendition_path(name)):
+                os.remove(rendition_path(name))
+
+        raise
+
+    # bulk_create sends no post_save signals, so the embedding stores are
+    # updated here.
+    for owner_id in {face.photo.owner_id for face in faces}:
+        owned = [face for face in faces if face.photo.owner_id == owner_id]
+        face_store(owner_id).append(
+            [face.id for face in owned],
+            unpack_encodings([face.encoding for face in owned]),
+        )
+
+    for person in named_persons.values():
+        person._calculate_face_count()  # pylint: disable=protected-access
+        person._set_default_cover_photo()  # pylint: disable=protected-access
+
+    logger.info("%d face(s) saved for %d photo(s)", len(faces), len(photos))
+
+    return len(faces)
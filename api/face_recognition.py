@@ -1,5 +1,8 @@
+import base64
+
 import numpy as np
-import requests
+
+from api.services import post
 
 
 def get_face_encodings(image_path, known_face_locations):
@@ -7,9 +10,7 @@ def get_face_encodings(image_path, known_face_locations):
         "source": image_path,
         "face_locations": known_face_locations,
     }
-    face_encoding = requests.post(
-        "http://localhost:8005/face-encodings", json=json
-    ).json()
+    face_encoding = post("http://localhost:8005/face-encodings", json=json).json()
 
     face_encodings_list = face_encoding["encodings"]
     face_encodings = [np.array(enc) for enc in face_encodings_list]
@@ -19,7 +20,71 @@ def get_face_encodings(image_path, known_face_locations):
 
 def get_face_locations(image_path, model="hog"):
     json = {"source": image_path, "model": model}
-    face_locations = requests.post(
-        "http://localhost:8005/face-locations", json=json
-    ).json()
+    face_locations = post("http://localhost:8005/face-locations", json=json).json()
     return face_locations["face_locations"]
+
+
+def get_face_locations_batch(image_paths, model="hog", max_size=None, tile=False):
+    """Detects faces for many images in one request. Returns a dict of image path
+    to list of (top, right, bottom, left) locations."""
+
+    json = {"sources": list(image_paths), "model": model, "tile": tile}
+
+    if max_size is not None:
+        json["max_size"] = max_size
+
+    response = post("http://localhost:8005/face-locations-batch", json=json).json()
+
+    return response["face_locations"]
+
+
+def decode_array(payload):
+    """Unpacks a base64 encoded array as sent by the face recognition service."""
+
+    data = base64.b64decode(payload["data"])
+
+    return np.frombuffer(data, dtype=np.dtype(payload["dtype"])).reshape(
+        payload["shape"]
+    )
+
+
+def decode_detections(response):
+    """Converts a `/detect-and-encode` result into locations, an (N, 128) encoding
+    matrix and JPEG crops as bytes."""
+
+    return {
+        "face_locations": [tuple(location) for location in response["face_locations"]],
+        "encodings": decode_array(response["encodings"]),
+        "crops": [base64.b64decode(crop) for crop in response["crops"]],
+    }
+
+
+def detect_and_encode_faces(
+    image_path, model="hog", known_face_locations=None, crops=True
+):
+    """Detects, encodes and crops all faces of an image in a single request, so the
+    image is only decoded once. Detection is skipped if `known_face_locations` is
+    given."""
+
+    json = {"source": image_path, "model": model, "crops": crops}
+
+    if known_face_locations is not None:
+        json["known_face_locations"] = [
+            list(location[:4]) for location in known_face_locations
+        ]
+
+    response = post("http://localhost:8005/detect-and-encode", json=json).json()
+
+    return decode_detections(response)
+
+
+def detect_and_encode_faces_batch(image_paths, model="hog", crops=True):
+    """Runs `detect_and_encode_faces` for many images in one request. Returns a dict
+    of image path to detections, images that failed are left out."""
+
+    json = {"sources": list(image_paths), "model": model, "crops": crops}
+    response = post("http://localhost:8005/detect-and-encode-batch", json=json).json()
+
+    return {
+        path: decode_detections(result) for path, result in response["results"].items()
+    }
@@ -2,11 +2,53 @@ import datetime
 import operator
 from functools import reduce
 
-from django.db.models import Q
+from django.db.models import Case, IntegerField, Q, When
 from rest_framework import filters
 
+from api.clip_embeddings import semantic_search
+from api.utils import logger
+
 
 class SemanticSearchFilter(filters.SearchFilter):
+    """Matches the search terms against the search fields. With `semantic=true`
+    the photos whose CLIP embeddings are closest to the whole query are returned
+    instead, best match first. Keyword matching is the fallback when the
+    semantic search fails."""
+
+    semantic_param = "semantic"
+
+    def is_semantic(self, request):
+        return request.query_params.get(self.semantic_param, "").lower() in (
+            "true",
+            "1",
+        )
+
+    def semantic_queryset(self, request, queryset):
+        """Returns the semantic matches ordered by their rank, or None if the
+        search failed."""
+
+        query = request.query_params.get(self.search_param, "").strip()
+
+        try:
+            image_hashes = semantic_search(request.user, query)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Semantic search failed, using keyword search instead")
+
+            return None
+
+        if not image_hashes:
+            return queryset.none()
+
+        return queryset.filter(image_hash__in=image_hashes).order_by(
+            Case(
+                *[
+                    When(image_hash=image_hash, then=rank)
+                    for rank, image_hash in enumerate(image_hashes)
+                ],
+                output_field=IntegerField(),
+            )
+        )
+
     def filter_queryset(self, request, queryset, view):
         search_fields = self.get_search_fields(view, request)
         search_terms = self.get_search_terms(request)
@@ -14,6 +56,12 @@ class SemanticSearchFilter(filters.SearchFilter):
         if not search_fields or not search_terms:
             return queryset
 
+        if self.is_semantic(request):
+            semantic = self.semantic_queryset(request, queryset)
+
+            if semantic is not None:
+                return semantic
+
         orm_lookups = [
             self.construct_search(str(search_field), queryset=queryset)
             for search_field in search_fields
@@ -24,7 +72,8 @@ class SemanticSearchFilter(filters.SearchFilter):
             queries = [Q(**{orm_lookup: search_term}) for orm_lookup in orm_lookups]
 
             conditions.append(reduce(operator.or_, queries))
-        queryset = queryset.filter(reduce(operator.and_, conditions))
+        condition = reduce(operator.and_, conditions)
+        queryset = queryset.filter(condition)
 
         if self.must_call_distinct(queryset, search_fields):
             # Filtering against a many-to-many field requires us to
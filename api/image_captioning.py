@@ -1,19 +1,58 @@
 import requests
 
+from api.services import post
+
+
+def generate_caption(image_path, model, image_hash=None, refresh=False):
+    """Captions an image with one of the captioning models. With `image_hash` the
+    service returns the caption it cached for the image and model, unless
+    `refresh` is set."""
 
-def generate_caption(image_path, onnx, blip):
     json = {
         "image_path": image_path,
-        "onnx": onnx,
-        "blip": blip,
+        "model": model,
+        "image_hash": image_hash,
+        "refresh": refresh,
     }
-    caption_response = requests.post(
-        "http://localhost:8007/generate-caption", json=json
-    ).json()
+    caption_response = post("http://localhost:8007/generate-caption", json=json).json()
 
     return caption_response["caption"]
 
 
+def generate_captions_batch(images, model, refresh=False):
+    """Captions many (image hash, image path) pairs in one request, decoded in
+    batches. Returns the caption of every image that could be captioned, by path.
+    Captions cached for an image and model are reused unless `refresh` is set."""
+
+    response = post(
+        "http://localhost:8007/generate-captions-batch",
+        json={
+            "images": [
+                {"image_hash": image_hash, "image_path": image_path}
+                for image_hash, image_path in images
+            ],
+            "model": model,
+            "refresh": refresh,
+        },
+        timeout=600,
+    ).json()
+
+    return response["captions"]
+
+
+def generate_places365_tags(image_paths, confidence):
+    """Tags many images with the scene categories and attributes of Places365 in
+    one request. Returns the tags of every image that could be tagged, by path."""
+
+    response = post(
+        "http://localhost:8011/generate-tags-batch",
+        json={"image_paths": list(image_paths), "confidence": confidence},
+        timeout=600,
+    ).json()
+
+    return response["tags"]
+
+
 def unload_model():
     requests.get("http://localhost:8007/unload-model")
 
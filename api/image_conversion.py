@@ -1,11 +1,12 @@
 """Functions used to covert image format, quality, and size."""
 
-import os
+import base64
 import subprocess
+from io import BytesIO
 from PIL import Image
 from pillow_heif import register_heif_opener
 
-from django.conf import settings
+from api.rendition_store import rendition_name, rendition_path
 
 
 def generate_optimized_image(
@@ -15,9 +16,9 @@ def generate_optimized_image(
 
     register_heif_opener()
 
-    final_path = os.path.join(
-        settings.MEDIA_ROOT, output_path, image_hash + file_type
-    ).strip()
+    final_path = rendition_path(
+        rendition_name(output_path, image_hash + file_type), create_dirs=True
+    )
     img = Image.open(input_path)
     img.save(final_path, "webp", quality=quality)
 
@@ -29,9 +30,9 @@ def generate_thumbnail(input_path, output_path, image_hash, file_type):
 
     register_heif_opener()
 
-    final_path = os.path.join(
-        settings.MEDIA_ROOT, output_path, image_hash + file_type
-    ).strip()
+    final_path = rendition_path(
+        rendition_name(output_path, image_hash + file_type), create_dirs=True
+    )
     img = Image.open(input_path)
     img.thumbnail((200, 200))
     img.save(final_path, "webp")
@@ -39,52 +40,29 @@ def generate_thumbnail(input_path, output_path, image_hash, file_type):
     return img
 
 
-def does_optimized_image_exist(output_path, image_hash):
-    """Check if an optimized image exists in the specified output path and with
-    the given image_hash."""
-
-    return os.path.exists(
-        os.path.join(
-            settings.MEDIA_ROOT,
-            output_path,
-            image_hash + ".webp",
-        ).strip()
-    )
-
-
-def does_thumbnail_exist(output_path, image_hash):
-    """Check if a thumbnail image exists in the specified output path and with
-    the given image_hash."""
+def generate_placeholder(img, size=16, quality=40):
+    """Generate a tiny inline webp placeholder (LQIP) from an already decoded image.
 
-    return os.path.exists(
-        os.path.join(
-            settings.MEDIA_ROOT,
-            output_path,
-            image_hash + ".webp",
-        ).strip()
-    )
+    The result is a data URI, so clients can paint it without an extra request.
+    """
 
+    placeholder = img.convert("RGB")
+    placeholder.thumbnail((size, size))
 
-def does_video_thumbnail_exist(output_path, image_hash):
-    """Check if a video thumbnail image exists in the specified output path and
-    with the given image_hash."""
+    with BytesIO() as buffer:
+        placeholder.save(buffer, "webp", quality=quality)
+        encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
 
-    return os.path.exists(
-        os.path.join(
-            settings.MEDIA_ROOT,
-            output_path,
-            image_hash + ".mp4",
-        ).strip()
-    )
+    return "data:image/webp;base64," + encoded
 
 
 def generate_thumbnail_for_video(input_path, output_path, image_hash, file_type):
     """Generate a video thumbnail from the given video."""
 
     try:
-        output = os.path.join(
-            settings.MEDIA_ROOT, output_path, image_hash + file_type
-        ).strip()
+        output = rendition_path(
+            rendition_name(output_path, image_hash + file_type), create_dirs=True
+        )
         command = [
             "ffmpeg",
             "-i",
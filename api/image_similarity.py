@@ -1,21 +1,164 @@
-"""Compares images and returns similar ones."""
+"""Compares images and returns similar ones.
 
+The similarity indices live in the image similarity service, which is their only
+owner. This module holds a small client for it that keeps its connections open
+and sends embeddings as base64 encoded float32 arrays.
+"""
+
+import base64
 from datetime import datetime
 import logging.handlers
 
-from django.core.paginator import Paginator
+import numpy as np
+import requests
+from django.core.cache import cache
 from django.db.models import Q
+from requests.adapters import HTTPAdapter
 
-from api.retrieval_index import RetrievalIndex
+from api.embedding_store import clip_store, load_clip_embeddings
 
-from api.models import Photos
+import api.models
 
 logger = logging.getLogger("image_similarity")
 
-index = RetrievalIndex()
+SERVICE_URL = "http://localhost:8002"
+# Connections to the service kept open per worker process.
+POOL_SIZE = 10
+
+# Photos added to the index at once while building it.
+BUILD_BATCH_SIZE = 5000
+
+# Similar photos listed per photo. The lists are cached per index version, so
+# they are recomputed once the index changes.
+SIMILAR_PHOTOS_COUNT = 100
+SIMILAR_PHOTOS_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def _encode_array(array):
+    """Packs a NumPy array as base64 bytes instead of nested JSON float lists."""
+
+    array = np.ascontiguousarray(array, dtype=np.float32)
+
+    return {
+        "data": base64.b64encode(array.tobytes()).decode("ascii"),
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+    }
+
+
+class SimilarityIndexClient:
+    """Client of the image similarity service, with the methods of its
+    RetrievalIndex.
+
+    Requests go through one pooled session per process, so the connection to the
+    service is reused instead of opened for every call.
+    """
+
+    def __init__(self, url=SERVICE_URL, pool_size=POOL_SIZE):
+        self.url = url
+        self.pool_size = pool_size
+        self.session = None
+
+    def _get_session(self):
+        if self.session is None:
+            session = requests.Session()
+            session.mount(
+                "http://",
+                HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size),
+            )
+            self.session = session
+
+        return self.session
+
+    def _request(self, method, path, payload, timeout=60):
+        response = self._get_session().request(
+            method, f"{self.url}{path}", json=payload, timeout=timeout
+        )
+        response.raise_for_status()
+
+        return response.json()
+
+    def build_index_for_user(
+        self, user_id, image_hashes, image_embeddings, persist=True
+    ):
+        """Adds photos to the index of a user, replacing those already in it.
+        With `persist` false the index has to be stored with `save`."""
+
+        self._request(
+            "POST",
+            "/build/",
+            {
+                "user_id": user_id,
+                "image_hashes": list(image_hashes),
+                "image_embeddings": _encode_array(image_embeddings),
+                "persist": persist,
+            },
+            timeout=600,
+        )
+
+    def save(self, user_id):
+        """Stores the index of a user."""
 
+        self._request("POST", "/save/", {"user_id": user_id}, timeout=600)
 
-def search_similar_images(user, photo, threshold=27):
+    def delete_index(self, user_id):
+        """Deletes the index of a user."""
+
+        self._request("DELETE", "/build/", {"user_id": user_id})
+
+    def remove_from_index(self, user_id, image_hashes, persist=True):
+        """Removes photos from the index of a user and returns how many were
+        removed."""
+
+        return self._request(
+            "POST",
+            "/remove/",
+            {
+                "user_id": user_id,
+                "image_hashes": list(image_hashes),
+                "persist": persist,
+            },
+        )["removed"]
+
+    def index_info(self, user_id):
+        """Returns the version, build time and size of the index of a user, or
+        None if there is none."""
+
+        return self._request("POST", "/info/", {"user_id": user_id}, timeout=10)[
+            "index"
+        ]
+
+    def search_similar(self, user_id, in_embedding, n=100, thres=0.27):
+        """Searches for similar images, `thres` is a cosine similarity. A `thres`
+        of None ranks without a threshold."""
+
+        return self.search_similar_batch(user_id, [in_embedding], n, thres)[0]
+
+    def search_similar_batch(self, user_id, in_embeddings, n=100, thres=0.27):
+        """Searches for the images similar to each of many embeddings with a single
+        request. Returns a list of image hashes per embedding, best first."""
+
+        return self._request(
+            "POST",
+            "/search-batch/",
+            {
+                "user_id": user_id,
+                "image_embeddings": _encode_array(in_embeddings),
+                "n": n,
+                "threshold": thres,
+            },
+        )["results"]
+
+    def metrics(self):
+        """Returns the sizes and memory of the loaded indices."""
+
+        return self._request("GET", "/metrics/", None, timeout=10)
+
+
+index = SimilarityIndexClient()
+
+
+def search_similar_images(user, photo, threshold=0.27):
     """Search for similar images."""
 
     if isinstance(user, int):
@@ -24,7 +167,14 @@ def search_similar_images(user, photo, threshold=27):
         user_id = user.id
 
     try:
-        res = index.search_similar(user_id=user_id, thres=threshold, in_embedding=[])
+        _, embeddings = load_clip_embeddings(user_id, [photo.image_hash])
+
+        if len(embeddings) == 0:
+            return []
+
+        res = index.search_similar(
+            user_id=user_id, thres=threshold, in_embedding=embeddings[0]
+        )
 
         return res
     except Exception:  # pylint: disable=broad-except
@@ -37,6 +187,94 @@ def search_similar_images(user, photo, threshold=27):
         return []
 
 
+def search_similar_images_batch(
+    user_id, image_hashes, threshold=0.27, n=SIMILAR_PHOTOS_COUNT
+) -> dict:
+    """Searches the photos similar to many photos of a user with a single index
+    search. Returns the similar image hashes of every photo, best first and
+    without the photo itself."""
+
+    results = {image_hash: [] for image_hash in image_hashes}
+    found, embeddings = load_clip_embeddings(user_id, image_hashes)
+
+    if not found:
+        return results
+
+    # Every photo finds itself first, so one more neighbour is asked for.
+    for image_hash, similar in zip(
+        found, index.search_similar_batch(user_id, embeddings, n + 1, threshold)
+    ):
+        results[image_hash] = [other for other in similar if other != image_hash][:n]
+
+    return results
+
+
+def _similar_photos_key(user_id, version, threshold, image_hash):
+    return f"similar_photos:{user_id}:{version}:{threshold}:{image_hash}"
+
+
+def get_similar_photos(user_id, image_hashes, threshold=0.9) -> dict:
+    """Returns the similar photos of many photos of a user, as lists of
+    {"image_hash", "type"} dicts.
+
+    Lists are served from the cache where possible, the missing ones are computed
+    with one index search and one database query.
+    """
+
+    try:
+        header = index.index_info(user_id)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Error retrieving the index of user %s.", user_id)
+        header = None
+
+    if header is None:
+        return {image_hash: [] for image_hash in image_hashes}
+
+    keys = {
+        image_hash: _similar_photos_key(
+            user_id, header["version"], threshold, image_hash
+        )
+        for image_hash in image_hashes
+    }
+    cached = cache.get_many(keys.values())
+    results = {
+        image_hash: cached[key] for image_hash, key in keys.items() if key in cached
+    }
+    missing = [image_hash for image_hash in image_hashes if image_hash not in results]
+
+    if not missing:
+        return results
+
+    try:
+        similar = search_similar_images_batch(user_id, missing, threshold)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Error retrieving similar photos of user %s.", user_id)
+        results.update({image_hash: [] for image_hash in missing})
+
+        return results
+
+    videos = dict(
+        api.models.Photos.objects.filter(
+            image_hash__in={other for others in similar.values() for other in others}
+        ).values_list("image_hash", "video")
+    )
+    computed = {
+        image_hash: [
+            {"image_hash": other, "type": "video" if videos[other] else "image"}
+            for other in others
+            if other in videos
+        ]
+        for image_hash, others in similar.items()
+    }
+    cache.set_many(
+        {keys[image_hash]: photos for image_hash, photos in computed.items()},
+        SIMILAR_PHOTOS_CACHE_TIMEOUT,
+    )
+    results.update(computed)
+
+    return results
+
+
 def build_image_similarity_index(user):
     """
     Builds the image similarity index for a given user.
@@ -44,42 +282,66 @@ def build_image_similarity_index(user):
         user (User): The user for whom the similarity index is being built.
     Returns:
         None
-    This function deletes any existing similarity index for the user from the server.
-    It then retrieves all photos belonging to the user that are not hidden,
-    orders them by image hash, and paginates them into groups of 5000.
-    For each page of photos, it extracts the image hashes and sends a POST request
-    to the server to build the similarity index for that page.
+    This function deletes any existing similarity index for the user in the
+    similarity service.
+    It then sends the stored CLIP embeddings of all photos belonging to the user
+    that are not hidden or deleted to the service, in batches of
+    `BUILD_BATCH_SIZE`. The index is stored once all batches are added.
     The function logs the start and end time of the index building process.
-    Note:
-        The function assumes that the `settings.IMAGE_SIMILARITY_SERVER` variable
-        is set and points to the correct server address.
     """
 
     logger.info("Building similarity index for user %s", user.username)
 
-    if user.id in index.indices:
-        del index.indices[user.id]
-        del index.image_hashes[user.id]
+    index.delete_index(user.id)
 
     start = datetime.now()
-    photos = (
-        Photos.objects.filter(Q(hidden=False) & Q(owner=user))
-        .only("image_hash")
-        .order_by("image_hash")
-        .all()
+    visible = set(
+        api.models.Photos.objects.filter(
+            Q(hidden=False) & Q(deleted=False) & Q(owner=user)
+        ).values_list("image_hash", flat=True)
     )
-    paginator = Paginator(photos, 5000)
-
-    for page in range(1, paginator.num_pages + 1):
-        image_hashes = []
-
-        for photo in paginator.page(page).object_list:
-            image_hashes.append(photo.image_hash)
+    image_hashes, embeddings = clip_store(user.id).load()
+    image_hashes = [image_hash.decode() for image_hash in image_hashes.tolist()]
+    rows = [row for row, image_hash in enumerate(image_hashes) if image_hash in visible]
 
+    for batch_start in range(0, len(rows), BUILD_BATCH_SIZE):
+        batch = rows[batch_start : batch_start + BUILD_BATCH_SIZE]
         index.build_index_for_user(
-            user_id=user.id, image_hashes=image_hashes, image_embeddings=[]
+            user_id=user.id,
+            image_hashes=[image_hashes[row] for row in batch],
+            # The half precision store is converted one batch at a time.
+            image_embeddings=embeddings[batch].astype("float32"),
+            persist=False,
         )
 
+    index.save(user.id)
     elapsed_time = (datetime.now() - start).total_seconds()
 
     logger.info("building similarity index took %.2f seconds", elapsed_time)
+
+
+def remove_from_similarity_index(user_id, image_hashes):
+    """Removes photos from the stored similarity index of a user."""
+
+    try:
+        removed = index.remove_from_index(user_id, image_hashes)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Error removing photos from the index of user %s", user_id)
+
+        return
+
+    if removed:
+        logger.info("removed %d photos from the index of user %s", removed, user_id)
+
+
+def add_to_similarity_index(user_id, image_hashes):
+    """Adds photos with a stored CLIP embedding to the similarity index of a
+    user."""
+
+    try:
+        image_hashes, embeddings = load_clip_embeddings(user_id, image_hashes)
+
+        if image_hashes:
+            index.build_index_for_user(user_id, image_hashes, embeddings)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Error adding photos to the index of user %s", user_id)
@@ -0,0 +1,98 @@
+"""Django manager integration for benchmarking face clustering backends."""
+
+import time
+import tracemalloc
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from sklearn.metrics import adjusted_rand_score
+
+from api.face_clustering import (
+    HDBSCAN_BACKEND,
+    KNN_GRAPH_BACKEND,
+    NOISE_LABEL,
+    cluster_encodings,
+)
+from api.face_encoding import ENCODING_SIZE
+
+# Spread of the synthetic identities and of the faces around them, chosen so that
+# faces of one identity are about 0.3 apart and identities about 1.0, like dlib
+# encodings.
+CENTER_SCALE = 0.0625
+FACE_SCALE = 0.022
+
+
+class Command(BaseCommand):
+    """Django manager command."""
+
+    help = "compare runtime, memory and quality of the face clustering backends on synthetic encodings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--faces", type=int, default=20000)
+        parser.add_argument("--identities", type=int, default=500)
+        parser.add_argument(
+            "--noise",
+            type=float,
+            default=0.1,
+            help="Fraction of faces that belong to no identity",
+        )
+        parser.add_argument("--min-cluster-size", type=int, default=4)
+        parser.add_argument("--min-samples", type=int, default=1)
+        parser.add_argument("--epsilon", type=float, default=0.05)
+        parser.add_argument("--threshold", type=float, default=0.45)
+        parser.add_argument(
+            "--backends",
+            nargs="+",
+            default=[HDBSCAN_BACKEND, KNN_GRAPH_BACKEND],
+            choices=[HDBSCAN_BACKEND, KNN_GRAPH_BACKEND],
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def _generate(self, faces, identities, noise, seed):
+        rng = np.random.default_rng(seed)
+        centers = rng.normal(0, CENTER_SCALE, (identities, ENCODING_SIZE))
+        labels = rng.integers(0, identities, faces)
+        encodings = centers[labels] + rng.normal(0, FACE_SCALE, (faces, ENCODING_SIZE))
+
+        # Noise faces are drawn like identities of their own.
+        noisy = rng.random(faces) < noise
+        encodings[noisy] = rng.normal(
+            0, CENTER_SCALE, (np.count_nonzero(noisy), ENCODING_SIZE)
+        )
+        labels[noisy] = NOISE_LABEL
+
+        return encodings.astype(np.float32), labels
+
+    def handle(self, *args, **options):
+        encodings, truth = self._generate(
+            options["faces"], options["identities"], options["noise"], options["seed"]
+        )
+        self.stdout.write(
+            f"{len(encodings)} faces, {options['identities']} identities, "
+            f"{np.count_nonzero(truth == NOISE_LABEL)} noise faces"
+        )
+
+        for backend in options["backends"]:
+            # tracemalloc only sees allocations made through Python and NumPy, not
+            # memory allocated inside FAISS or HDBSCAN's C extensions.
+            tracemalloc.start()
+            start = time.perf_counter()
+            labels = cluster_encodings(
+                encodings,
+                backend,
+                min_cluster_size=options["min_cluster_size"],
+                min_samples=options["min_samples"],
+                cluster_selection_epsilon=options["epsilon"],
+                threshold=options["threshold"],
+            )
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            clusters = len(set(labels.tolist()) - {NOISE_LABEL})
+            noise = np.count_nonzero(labels == NOISE_LABEL) / len(labels)
+            score = adjusted_rand_score(truth, labels)
+            self.stdout.write(
+                f"{backend:>10}: {elapsed:8.2f}s, peak {peak / 2**20:8.1f} MiB, "
+                f"{clusters} clusters, {noise:.1%} noise, ARI {score:.3f}"
+            )
@@ -0,0 +1,151 @@
+"""Django manager integration for moving renditions into the sharded store."""
+
+import os
+
+from django.core.management.base import BaseCommand
+
+from api.models import Face, Photos
+from api.rendition_store import (
+    FACES,
+    OPTIMIZED,
+    THUMBNAILS,
+    is_sharded,
+    record_rendition,
+    rendition_name,
+    rendition_path,
+)
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    """Django manager command."""
+
+    help = "move optimized images, thumbnails and face crops into sharded directories"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            help="Only report how many renditions would be moved",
+            action="store_true",
+        )
+
+    def _move(self, kind, name, dry_run, stored_name=None):
+        """Moves a flat rendition into its shard directory.
+
+        `stored_name` is the name of the file on disk, if it differs from the name
+        recorded in the database (video thumbnails are stored as webp frames).
+        Returns the new name, or None if the file is missing.
+        """
+
+        new_name = rendition_name(kind, os.path.basename(name))
+        stored_name = stored_name or name
+        source = rendition_path(stored_name)
+        target = rendition_path(
+            rendition_name(kind, os.path.basename(stored_name)), create_dirs=not dry_run
+        )
+
+        if not os.path.exists(source) and not os.path.exists(target):
+            return None
+
+        if not dry_run and os.path.exists(source):
+            os.replace(source, target)
+
+        return new_name
+
+    def _shard_photos(self, dry_run):
+        moved = 0
+        pending = []
+        photos = (
+            Photos.objects.only(
+                "image_hash", "optimized_image", "thumbnail", "renditions"
+            )
+            .order_by("image_hash")
+            .iterator(chunk_size=BATCH_SIZE)
+        )
+
+        for photo in photos:
+            changed = False
+
+            for kind, field in (
+                (OPTIMIZED, photo.optimized_image),
+                (THUMBNAILS, photo.thumbnail),
+            ):
+                if not field.name:
+                    continue
+
+                if not is_sharded(field.name):
+                    stored_name = os.path.splitext(field.name)[0] + ".webp"
+                    new_name = self._move(kind, field.name, dry_run, stored_name)
+
+                    if new_name is None:
+                        self.stdout.write(f"missing {kind} for {photo.image_hash}")
+                        continue
+
+                    field.name = new_name
+                    moved += 1
+                    changed = True
+
+                if (photo.renditions or {}).get(kind) != field.name:
+                    record_rendition(photo, kind, field.name)
+                    changed = True
+
+            if changed:
+                pending.append(photo)
+
+            if len(pending) >= BATCH_SIZE and not dry_run:
+                Photos.objects.bulk_update(
+                    pending, ["optimized_image", "thumbnail", "renditions"]
+                )
+                pending = []
+
+        if pending and not dry_run:
+            Photos.objects.bulk_update(
+                pending, ["optimized_image", "thumbnail", "renditions"]
+            )
+
+        return moved
+
+    def _shard_faces(self, dry_run):
+        moved = 0
+        pending = []
+        faces = (
+            Face.objects.exclude(image="")
+            .exclude(image=None)
+            .only("id", "image")
+            .order_by("id")
+            .iterator(chunk_size=BATCH_SIZE)
+        )
+
+        for face in faces:
+            if is_sharded(face.image.name):
+                continue
+
+            new_name = self._move(FACES, face.image.name, dry_run)
+
+            if new_name is None:
+                self.stdout.write(f"missing face crop {face.image.name}")
+                continue
+
+            face.image.name = new_name
+            pending.append(face)
+            moved += 1
+
+            if len(pending) >= BATCH_SIZE and not dry_run:
+                Face.objects.bulk_update(pending, ["image"])
+                pending = []
+
+        if pending and not dry_run:
+            Face.objects.bulk_update(pending, ["image"])
+
+        return moved
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        photo_count = self._shard_photos(dry_run)
+        face_count = self._shard_faces(dry_run)
+
+        self.stdout.write(
+            f"{'Would move' if dry_run else 'Moved'} {photo_count} photo renditions "
+            f"and {face_count} face crops."
+        )
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_user_image_scale'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photos',
+            name='color_palette',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='photos',
+            name='color_signature',
+            field=models.CharField(blank=True, db_index=True, max_length=128, null=True),
+        ),
+    ]
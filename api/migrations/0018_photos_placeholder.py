@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_photos_color_palette_photos_color_signature'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photos',
+            name='placeholder',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
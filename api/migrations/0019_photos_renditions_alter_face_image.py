@@ -0,0 +1,22 @@
+import api.rendition_store
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_photos_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photos',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AlterField(
+            model_name='face',
+            name='image',
+            field=models.ImageField(null=True, upload_to=api.rendition_store.face_upload_to),
+        ),
+    ]
@@ -0,0 +1,75 @@
+from django.db import migrations, models
+
+from api.face_encoding import binary_to_legacy_hex, legacy_hex_to_binary
+
+BATCH_SIZE = 2000
+
+
+def convert(model, source, target, converter):
+    pending = []
+
+    for row in model.objects.only('id', source).iterator(chunk_size=BATCH_SIZE):
+        value = getattr(row, source)
+
+        if not value:
+            continue
+
+        setattr(row, target, converter(value))
+        pending.append(row)
+
+        if len(pending) >= BATCH_SIZE:
+            model.objects.bulk_update(pending, [target])
+            pending = []
+
+    if pending:
+        model.objects.bulk_update(pending, [target])
+
+
+def forwards(apps, schema_editor):
+    convert(apps.get_model('api', 'Face'), 'encoding', 'encoding_binary', legacy_hex_to_binary)
+    convert(apps.get_model('api', 'Cluster'), 'mean_face_encoding', 'mean_face_encoding_binary', legacy_hex_to_binary)
+
+
+def backwards(apps, schema_editor):
+    convert(apps.get_model('api', 'Face'), 'encoding_binary', 'encoding', binary_to_legacy_hex)
+    convert(apps.get_model('api', 'Cluster'), 'mean_face_encoding_binary', 'mean_face_encoding', binary_to_legacy_hex)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_photos_renditions_alter_face_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='face',
+            name='encoding_binary',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='cluster',
+            name='mean_face_encoding_binary',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(
+            model_name='face',
+            name='encoding',
+        ),
+        migrations.RemoveField(
+            model_name='cluster',
+            name='mean_face_encoding',
+        ),
+        migrations.RenameField(
+            model_name='face',
+            old_name='encoding_binary',
+            new_name='encoding',
+        ),
+        migrations.RenameField(
+            model_name='cluster',
+            old_name='mean_face_encoding_binary',
+            new_name='mean_face_encoding',
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_binary_face_encodings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='face_clustering_backend',
+            field=models.TextField(choices=[('HDBSCAN', 'Hdbscan'), ('KNN_GRAPH', 'Knn Graph')], default='HDBSCAN'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='face_clustering_threshold',
+            field=models.FloatField(default=0.45),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_user_face_clustering_backend_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='face_classifier',
+            field=models.TextField(choices=[('MLP', 'Mlp'), ('KNN', 'Knn')], default='MLP'),
+        ),
+    ]
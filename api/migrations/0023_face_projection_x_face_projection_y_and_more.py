@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_user_face_classifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='face',
+            name='projection_x',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='face',
+            name='projection_y',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='face',
+            name='projection_z',
+            field=models.FloatField(null=True),
+        ),
+    ]
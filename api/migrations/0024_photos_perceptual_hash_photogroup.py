@@ -0,0 +1,33 @@
+import api.models.user
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_face_projection_x_face_projection_y_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photos',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=16, null=True),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='job_type',
+            field=models.PositiveIntegerField(choices=[(1, 'Scan Photos'), (2, 'Scan Faces'), (3, 'Train Faces'), (4, 'Find Similar Faces'), (5, 'Delete Missing Photos'), (6, 'Download Selected Photos'), (7, 'Download Models'), (8, 'Generate Event Albums'), (9, 'Regenerate Event Titles'), (10, 'Detect Duplicates')]),
+        ),
+        migrations.CreateModel(
+            name='PhotoGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('DUPLICATE', 'Duplicate'), ('BURST', 'Burst')], db_index=True, max_length=16)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(default=None, on_delete=models.SET(api.models.user.get_deleted_user), to=settings.AUTH_USER_MODEL)),
+                ('photos', models.ManyToManyField(related_name='photo_groups', to='api.photos')),
+            ],
+        ),
+    ]
@@ -11,6 +11,7 @@ from api.models.face import Face
 from api.models.file import File
 from api.models.job import Job
 from api.models.person import Person
+from api.models.photo_group import PhotoGroup
 from api.models.photos import Photos
 from api.models.user import User
 
@@ -26,6 +27,7 @@ __all__ = [
     "File",
     "Job",
     "Person",
+    "PhotoGroup",
     "Photos",
     "User",
 ]
@@ -4,6 +4,7 @@ import numpy as np
 from django.core.exceptions import MultipleObjectsReturned
 from django.db import models
 
+from api.face_encoding import pack_encoding, unpack_encoding
 from api.models.person import Person, get_unknown_person
 from api.models.user import User, get_deleted_user
 from api.utils import logger
@@ -23,7 +24,7 @@ class Cluster(models.Model):
         blank=True,
         null=True,
     )
-    mean_face_encoding = models.TextField()
+    mean_face_encoding = models.BinaryField(null=True)
     name = models.TextField(null=True)
 
     owner = models.ForeignKey(
@@ -36,13 +37,13 @@ class Cluster(models.Model):
     def get_mean_encoding_array(self) -> np.ndarray:
         """Returns a NumPy array containing the mean face encoding for this cluster."""
 
-        return np.frombuffer(bytes.fromhex(self.mean_face_encoding))
+        return unpack_encoding(self.mean_face_encoding)
 
     def set_metadata(self, all_vectors):
         """Set metadata for the cluster based on all vectors."""
 
-        self.mean_face_encoding = (
-            Cluster.calculate_mean_face_encoding(all_vectors).tobytes().hex()
+        self.mean_face_encoding = pack_encoding(
+            Cluster.calculate_mean_face_encoding(all_vectors)
         )
 
     @staticmethod
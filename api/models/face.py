@@ -1,13 +1,34 @@
 """Create face model for database."""
 
 import os
+
 import numpy as np
 from django.db import models
 from django.dispatch import receiver
 
+from api.embedding_store import commit_batch, face_store
+from api.face_encoding import unpack_encoding, unpack_encodings
 from api.models.cluster import Cluster
 from api.models.person import Person, get_unknown_person
 from api.models.photos import Photos
+from api.rendition_store import face_upload_to
+
+
+class FaceQuerySet(models.QuerySet):
+    """Face queryset with bulk encoding access."""
+
+    def encoding_matrix(self) -> tuple[list[int], np.ndarray]:
+        """Returns the ids and an (N, 128) matrix of the encodings of all faces in
+        the queryset, loaded with a single query."""
+
+        rows = list(self.order_by("id").values_list("id", "encoding"))
+
+        if not rows:
+            return [], unpack_encodings([])
+
+        ids, blobs = zip(*rows)
+
+        return list(ids), unpack_encodings(blobs)
 
 
 class Face(models.Model):
@@ -16,7 +37,7 @@ class Face(models.Model):
     photo = models.ForeignKey(
         Photos, related_name="faces", on_delete=models.CASCADE, blank=False, null=True
     )
-    image = models.ImageField(upload_to="faces", null=True)
+    image = models.ImageField(upload_to=face_upload_to, null=True)
 
     person = models.ForeignKey(
         Person, on_delete=models.DO_NOTHING, related_name="faces"
@@ -37,7 +58,14 @@ class Face(models.Model):
     location_left = models.IntegerField()
     location_right = models.IntegerField()
 
-    encoding = models.TextField()
+    encoding = models.BinaryField()
+
+    # Position of the face on the face map, see `update_face_projections`.
+    projection_x = models.FloatField(null=True)
+    projection_y = models.FloatField(null=True)
+    projection_z = models.FloatField(null=True)
+
+    objects = FaceQuerySet.as_manager()
 
     @property
     def timestamp(self):
@@ -51,7 +79,7 @@ class Face(models.Model):
     def get_encoding_array(self):
         """Returns a NumPy array containing the encoding of the face."""
 
-        return np.frombuffer(bytes.fromhex(self.encoding))
+        return unpack_encoding(self.encoding)
 
 
 @receiver(models.signals.post_delete, sender=Person)
@@ -71,3 +99,48 @@ def auto_delete_file_on_delete(
     if instance.image:
         if os.path.isfile(instance.image.path):
             os.remove(instance.image.path)
+
+
+def _owner_id(face):
+    return (
+        Photos.objects.filter(pk=face.photo_id)
+        .values_list("owner_id", flat=True)
+        .first()
+    )
+
+
+@receiver(models.signals.post_save, sender=Face)
+def append_encoding(
+    sender, instance, created, **kwargs
+):  # pylint: disable=unused-argument
+    """Appends the encoding of a new face to the embedding store of its owner."""
+
+    if created and instance.encoding:
+        face_store(_owner_id(instance)).append(
+            [instance.id], unpack_encoding(instance.encoding)
+        )
+
+
+def _remove_encodings(face_ids_by_owner):
+    for owner_id, face_ids in face_ids_by_owner.items():
+        face_store(owner_id).remove(face_ids)
+
+
+@receiver(models.signals.pre_delete, sender=Face)
+def collect_encoding(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """Collects the encoding of a face about to be deleted for removal from the
+    embedding store of its owner.
+
+    The owner is resolved while the photo still exists, as cascade deletes
+    remove it along with its faces. Deletes always run in a transaction, the
+    store is updated once per owner when it commits.
+    """
+
+    batch = commit_batch(_remove_encodings)
+    owners = batch.cache
+
+    if instance.photo_id not in owners:
+        owners[instance.photo_id] = _owner_id(instance)
+
+    if owners[instance.photo_id] is not None:
+        batch.add(owners[instance.photo_id], instance.id)
@@ -26,6 +26,8 @@ class Job(models.Model):
     JOB_DOWLOAD_MODELS = 7
     JOB_GENERATE_AUTO_ALBUMS = 8
     JOB_GENERATE_AUTO_ALBUM_TITLES = 9
+    JOB_DETECT_DUPLICATES = 10
+    JOB_GENERATE_CAPTIONS = 11
 
     JOB_TYPES = (
         (JOB_SCAN_PHOTOS, "Scan Photos"),
@@ -37,6 +39,8 @@ class Job(models.Model):
         (JOB_DOWLOAD_MODELS, "Download Models"),
         (JOB_GENERATE_AUTO_ALBUMS, "Generate Event Albums"),
         (JOB_GENERATE_AUTO_ALBUM_TITLES, "Regenerate Event Titles"),
+        (JOB_DETECT_DUPLICATES, "Detect Duplicates"),
+        (JOB_GENERATE_CAPTIONS, "Generate Captions"),
     )
 
     job_id = models.CharField(max_length=36, unique=True, db_index=True)
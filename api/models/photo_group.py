@@ -0,0 +1,28 @@
+"""Create photo group model for database."""
+
+from django.db import models
+
+from api.models.photos import Photos
+from api.models.user import User, get_deleted_user
+
+
+class PhotoGroup(models.Model):
+    """Near-duplicates or a burst of photos found by the duplicate detection."""
+
+    KIND_DUPLICATE = "DUPLICATE"
+    KIND_BURST = "BURST"
+
+    KIND_CHOICES = (
+        (KIND_DUPLICATE, "Duplicate"),
+        (KIND_BURST, "Burst"),
+    )
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, db_index=True)
+    photos = models.ManyToManyField(Photos, related_name="photo_groups")
+    owner = models.ForeignKey(
+        User, on_delete=models.SET(get_deleted_user), default=None
+    )
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.id} - {self.kind} - {self.owner}"
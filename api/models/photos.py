@@ -4,34 +4,46 @@
 import json
 import numbers
 import os
-from io import BytesIO
 from api.geocode import GEOCODE_VERSION
-import numpy as np
 import PIL
-from django.core.files.base import ContentFile
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
+from django.dispatch import receiver
 from django.db.utils import IntegrityError
-import requests
+from django_q.tasks import AsyncTask
 from pillow_heif import register_heif_opener
 from taggit.managers import TaggableManager
 
 from api import date_time_extractor
 from api.exif_tags import Tags
 import api.models
+from api.color_analysis import calculate_colors, load_thumbnail
+from api.duplicate_detection import calculate_perceptual_hashes
+from api.embedding_store import clip_store, commit_batch
+from api.face_persistence import save_faces
 from api.models.file import File
 import api.face_extractor as face_extractor
-from api.face_recognition import get_face_encodings
 from api.geocode.geocode import reverse_geocode
 from api.image_captioning import generate_caption
+from api.image_similarity import (
+    add_to_similarity_index,
+    remove_from_similarity_index,
+)
 from api.image_conversion import (
-    does_optimized_image_exist,
-    does_thumbnail_exist,
     generate_optimized_image,
+    generate_placeholder,
     generate_thumbnail,
     generate_thumbnail_for_video,
 )
 from api.llm import generate_prompt
+from api.rendition_store import (
+    OPTIMIZED,
+    THUMBNAILS,
+    has_rendition,
+    record_rendition,
+    rendition_name,
+)
+from api.services import post
 from api.utils import get_metadata, logger, write_metadata
 
 from .user import User, get_deleted_user
@@ -89,6 +101,15 @@ class Photos(models.Model):
     video_length = models.TextField(blank=True, null=True)
 
     dominant_color = models.TextField(blank=True, null=True)
+    color_palette = models.JSONField(blank=True, null=True)
+    color_signature = models.CharField(
+        max_length=128, blank=True, null=True, db_index=True
+    )
+    perceptual_hash = models.CharField(
+        max_length=16, blank=True, null=True, db_index=True
+    )
+    placeholder = models.TextField(blank=True, null=True)
+    renditions = models.JSONField(default=dict, blank=True)
 
     tags = TaggableManager()
 
@@ -96,6 +117,9 @@ class Photos(models.Model):
     visible = VisiblePhotoManager()
 
     _loaded_values = {}
+    _thumbnail_image = None
+    # Visibility as of the last save, see `update_similarity_index`.
+    _saved_visibility = None
 
     class Meta:
         """Meta class for Photos model."""
@@ -323,85 +347,25 @@ class Photos(models.Model):
         if commit:
             self.save()
 
-    def _extract_faces(self, second_try=False):
-        unknown_cluster: api.models.cluster.Cluster = (
-            api.models.cluster.get_unknown_cluster(user=self.owner)
-        )
+    def _extract_faces(self, second_try=False, detections=None):
         try:
-            optimized_image = np.array(PIL.Image.open(self.optimized_image.path))
-
-            face_locations = face_extractor.extract(
-                self.original_image.path, self.optimized_image.path, self.owner
-            )
+            # Detections can be passed in when they were computed in a batch.
+            if detections is None:
+                detections = face_extractor.extract_and_encode(
+                    self.original_image.path, self.optimized_image.path, self.owner
+                )
 
-            if len(face_locations) == 0:
+            if len(detections["face_locations"]) == 0:
                 return
 
-            face_encodings = get_face_encodings(
-                self.optimized_image.path, known_face_locations=face_locations
-            )
-            for idx_face, face in enumerate(zip(face_encodings, face_locations)):
-                face_encoding = face[0]
-                face_location = face[1]
-
-                top, right, bottom, left, person_name = face_location
-                if person_name:
-                    person = api.models.person.get_or_create_person(
-                        name=person_name, owner=self.owner
-                    )
-                    person.save()
-                else:
-                    person = api.models.person.get_unknown_person(owner=self.owner)
-
-                face_image = optimized_image[top:bottom, left:right]
-                face_image = PIL.Image.fromarray(face_image)
-
-                image_path = self.image_hash + "_" + str(idx_face) + ".jpg"
-
-                margin = int((right - left) * 0.05)
-                existing_faces = api.models.face.Face.objects.filter(
-                    photo=self,
-                    location_top__lte=top + margin,
-                    location_top__gte=top - margin,
-                    location_right__lte=right + margin,
-                    location_right__gte=right - margin,
-                    location_bottom__lte=bottom + margin,
-                    location_bottom__gte=bottom - margin,
-                    location_left__lte=left + margin,
-                    location_left__gte=left - margin,
-                )
-
-                if existing_faces.count() != 0:
-                    continue
-
-                face = api.models.face.Face(
-                    photo=self,
-                    location_top=top,
-                    location_right=right,
-                    location_bottom=bottom,
-                    location_left=left,
-                    encoding=face_encoding.tobytes().hex(),
-                    person=person,
-                    cluster=unknown_cluster,
-                )
-                if person_name:
-                    person._calculate_face_count()
-                    person._set_default_cover_photo()
-                face_io = BytesIO()
-                face_image.save(face_io, format="JPEG")
-                face.image.save(image_path, ContentFile(face_io.getvalue()))
-                face_io.close()
-                face.save()
-            logger.info(
-                "image %s: %d face(s) saved", self.image_hash, len(face_locations)
-            )
+            save_faces([(self, detections)])
         except IntegrityError:
             # When using multiple processes, then we can save at the same time, which leads to this error
             if self.files.count() > 0:
                 # print out the location of the image only if we have a path
                 logger.info("image %s: rescan face failed", self.original_image.path)
             if not second_try:
-                self._extract_faces(True)
+                self._extract_faces(True, detections)
             else:
                 if self.files.count() > 0:
                     logger.error(
@@ -494,18 +458,20 @@ class Photos(models.Model):
         if commit:
             self.save()
 
-    def _generate_captions(self, commit=True):
+    def _generate_captions(self, commit=True, res_places365=None):
         try:
             image_path = self.optimized_image.path
             confidence = self.owner.confidence
 
-            json = {
-                "image_path": image_path,
-                "confidence": confidence,
-            }
-            res_places365 = requests.post(
-                "http://localhost:8011/generate-tags", json=json
-            ).json()["tags"]
+            # Batch jobs pass tags they already fetched for many photos at once.
+            if res_places365 is None:
+                json = {
+                    "image_path": image_path,
+                    "confidence": confidence,
+                }
+                res_places365 = post(
+                    "http://localhost:8011/generate-tags", json=json
+                ).json()["tags"]
 
             if res_places365 is None:
                 return
@@ -555,9 +521,9 @@ class Photos(models.Model):
         )
         self.save()
 
-    def _generate_captions_im2txt(self, commit=True):
+    def _generate_captions_im2txt(self, commit=True, caption=None, refresh=False):
         image_path = self.optimized_image.path
-        captions = self.captions_json
+        captions = self.captions_json or {}
         current_user = User.objects.get(username=self.owner)
 
         try:
@@ -567,15 +533,14 @@ class Photos(models.Model):
                 logger.info("Generating captions is disabled")
                 return False
 
-            onnx = False
-            if site_config.CAPTIONING_MODEL == "im2txt_onnx":
-                onnx = True
-
-            blip = False
-            if site_config.CAPTIONING_MODEL == "blip_base_capfilt_large":
-                blip = True
-
-            caption = generate_caption(image_path=image_path, blip=blip, onnx=onnx)
+            # Batch jobs pass the caption they already fetched for many photos.
+            if caption is None:
+                caption = generate_caption(
+                    image_path=image_path,
+                    model=site_config.CAPTIONING_MODEL,
+                    image_hash=self.image_hash,
+                    refresh=refresh,
+                )
             caption = caption.replace("<start>", "").replace("<end>", "").strip()
 
             llm_settings = current_user.llm_settings
@@ -618,11 +583,9 @@ class Photos(models.Model):
                 self.save()
 
             logger.info(
-                "Generated im2txt captions for image %s with SiteConfig %s with Blip: %s and Onnx: %s caption: %s",  # pylint: disable=line-too-long
+                "Generated im2txt captions for image %s with model %s caption: %s",
                 image_path,
                 site_config.CAPTIONING_MODEL,
-                blip,
-                onnx,
                 caption,
             )
 
@@ -636,14 +599,19 @@ class Photos(models.Model):
 
     def _generate_optimized_image(self, commit=True):
         try:
-            if not does_optimized_image_exist("optimized", self.image_hash):
+            if not has_rendition(self, OPTIMIZED):
                 generate_optimized_image(
                     input_path=self.original_image.path,
-                    output_path="optimized",
+                    output_path=OPTIMIZED,
                     image_hash=self.image_hash,
                     file_type=".webp",
                     quality=85,
                 )
+                self.optimized_image.name = rendition_name(
+                    OPTIMIZED, self.image_hash + ".webp"
+                )
+                record_rendition(self, OPTIMIZED, self.optimized_image.name)
+
             if commit:
                 self.save()
 
@@ -652,31 +620,35 @@ class Photos(models.Model):
 
     def _generate_thumbnail(self, commit=True):
         try:
-            if not does_thumbnail_exist("thumbnails", self.image_hash):
+            filetype = ".webp"
+
+            if self.video:
+                filetype = ".mp4"
+
+            if not has_rendition(self, THUMBNAILS):
                 if not self.video:
-                    generate_thumbnail(
+                    # Keep the decoded thumbnail for the color analysis stage.
+                    self._thumbnail_image = generate_thumbnail(
                         input_path=self.original_image.path,
-                        output_path="thumbnails",
+                        output_path=THUMBNAILS,
                         image_hash=self.image_hash,
                         file_type=".webp",
                     )
                 else:
                     generate_thumbnail_for_video(
                         input_path=self.original_image.path,
-                        output_path="thumbnails",
+                        output_path=THUMBNAILS,
                         image_hash=self.image_hash,
                         file_type=".webp",
                     )
 
-            filetype = ".webp"
-
-            if self.video:
-                filetype = ".mp4"
+                self.thumbnail.name = rendition_name(
+                    THUMBNAILS, self.image_hash + filetype
+                )
+                record_rendition(self, THUMBNAILS, self.thumbnail.name)
 
-            self.optimized_image.name = os.path.join(
-                "optimized", self.image_hash + ".webp"
-            ).strip()
-            self.thumbnail.name = os.path.join("thumbnails", self.image_hash + filetype)
+            if not self.placeholder:
+                self._generate_placeholder()
 
             if commit:
                 self.save()
@@ -684,6 +656,17 @@ class Photos(models.Model):
         except Exception:  # pylint: disable=broad-except
             logger.exception("Could not generate thumbnail for image %s", self)
 
+    def _generate_placeholder(self):
+        try:
+            img = self._thumbnail_image
+
+            if img is None:
+                img = load_thumbnail(self)
+
+            self.placeholder = generate_placeholder(img)
+        except (OSError, ValueError):
+            logger.info("Cannot generate placeholder for image %s", self)
+
     def manual_delete(self):
         """
         Deletes the original image, optimized image, and thumbnail associated
@@ -793,27 +776,88 @@ class Photos(models.Model):
 
         self.save()
 
-    def _get_dominant_color(self, palette_size=16):
+    def _get_dominant_color(self):
         # Skip if it's already calculated
-        if self.dominant_color:
+        if self.dominant_color and self.color_signature:
             return
 
-        try:
-            register_heif_opener()
+        images = None
 
-            # Resize image to speed up processing
-            img = PIL.Image.open(self.optimized_image.path)
-            img.thumbnail((100, 100))
+        if self._thumbnail_image is not None:
+            images = [self._thumbnail_image]
 
-            # Reduce colors (uses k-means internally)
-            paletted = img.convert("P", palette=1, colors=palette_size)
+        calculate_colors([self], images)
+        self._thumbnail_image = None
 
-            # Find the color that occurs most often
-            palette = paletted.getpalette()
-            color_counts = sorted(paletted.getcolors(), reverse=True)
-            palette_index = color_counts[0][1]
-            dominant_color = palette[palette_index * 3 : palette_index * 3 + 3]
-            self.dominant_color = dominant_color
-            self.save()
-        except ValueError:
-            logger.info("Cannot calculate dominant color %s object", self)
+    def _calculate_perceptual_hash(self):
+        # Skip if it's already calculated
+        if self.perceptual_hash or self.video:
+            return
+
+        images = None
+
+        if self._thumbnail_image is not None:
+            images = [self._thumbnail_image]
+
+        calculate_perceptual_hashes([self], images)
+
+
+def _visibility(photo):
+    # Fields deferred by .only() and never assigned were not changed.
+    deferred = photo.get_deferred_fields()
+
+    return {
+        field_name: bool(getattr(photo, field_name))
+        for field_name in ("hidden", "deleted")
+        if field_name not in deferred
+    }
+
+
+def _update_index_on_commit(function, photo):
+    # The index lives in the similarity service, so it is updated by a worker
+    # once the change is committed rather than during the save.
+    owner_id, image_hash = photo.owner_id, photo.image_hash
+    transaction.on_commit(lambda: AsyncTask(function, owner_id, [image_hash]).run())
+
+
+@receiver(models.signals.post_save, sender=Photos)
+def update_similarity_index(
+    sender, instance, created, **kwargs
+):  # pylint: disable=unused-argument
+    """Removes photos that were hidden or moved to the trash from the similarity
+    index of their owner, and adds them back once they are visible again. New
+    photos are added once their CLIP embedding is computed."""
+
+    current = _visibility(instance)
+    # Compared with the last save of this instance, or the values it was loaded
+    # with, kept apart from `_loaded_values`.
+    previous = instance._saved_visibility or {
+        field_name: bool(instance._loaded_values.get(field_name))
+        for field_name in current
+    }
+    instance._saved_visibility = {**previous, **current}
+
+    if created:
+        return
+
+    if any(value and not previous.get(name) for name, value in current.items()):
+        _update_index_on_commit(remove_from_similarity_index, instance)
+
+    elif any(previous.values()) and not (instance.hidden or instance.deleted):
+        _update_index_on_commit(add_to_similarity_index, instance)
+
+
+def _remove_deleted(image_hashes_by_owner):
+    for owner_id, image_hashes in image_hashes_by_owner.items():
+        clip_store(owner_id).remove(image_hashes)
+        AsyncTask(remove_from_similarity_index, owner_id, image_hashes).run()
+
+
+@receiver(models.signals.post_delete, sender=Photos)
+def remove_deleted_from_index(
+    sender, instance, **kwargs
+):  # pylint: disable=unused-argument
+    """Removes deleted photos from the similarity index and the CLIP embedding
+    store of their owner, once per owner when the transaction commits."""
+
+    commit_batch(_remove_deleted).add(instance.owner_id, instance.image_hash)
@@ -66,6 +66,27 @@ class User(AbstractUser):
     min_samples = models.IntegerField(default=1)
     cluster_selection_epsilon = models.FloatField(default=0.05)
 
+    class FaceClusteringBackend(models.TextChoices):
+        """Options for face clustering backend."""
+
+        HDBSCAN = "HDBSCAN"
+        KNN_GRAPH = "KNN_GRAPH"
+
+    face_clustering_backend = models.TextField(
+        choices=FaceClusteringBackend.choices, default=FaceClusteringBackend.HDBSCAN
+    )
+    face_clustering_threshold = models.FloatField(default=0.45)
+
+    class FaceClassifier(models.TextChoices):
+        """Options for face classifier."""
+
+        MLP = "MLP"
+        KNN = "KNN"
+
+    face_classifier = models.TextField(
+        choices=FaceClassifier.choices, default=FaceClassifier.MLP
+    )
+
     class CaptioningModel(models.TextChoices):
         """Options for captioning model."""
 
@@ -0,0 +1,112 @@
+"""Content-addressed, sharded storage layout for generated renditions.
+
+Renditions are stored below `MEDIA_ROOT/<kind>/<aa>/<bb>/`, where `aa` and `bb`
+are the first characters of the photo's image hash. This keeps every directory
+small, while nginx can still serve everything from a single `/protected_media/`
+location.
+"""
+
+import os
+
+from django.conf import settings
+
+OPTIMIZED = "optimized"
+THUMBNAILS = "thumbnails"
+FACES = "faces"
+RENDITION_KINDS = (OPTIMIZED, THUMBNAILS, FACES)
+
+# Photo fields naming the renditions generated before the manifest existed.
+LEGACY_FIELDS = {OPTIMIZED: "optimized_image", THUMBNAILS: "thumbnail"}
+
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+PROTECTED_MEDIA_URL = "/protected_media/"
+
+
+def shard_dir(image_hash: str) -> str:
+    """Returns the relative shard directory for an image hash, e.g. `ab/cd`."""
+
+    return os.path.join(
+        *[
+            image_hash[level * SHARD_WIDTH : (level + 1) * SHARD_WIDTH]
+            for level in range(SHARD_LEVELS)
+        ]
+    )
+
+
+def hash_from_filename(filename: str) -> str:
+    """Extracts the image hash from a rendition filename like `<hash>_<idx>.jpg`."""
+
+    return os.path.basename(filename).split(".")[0].split("_")[0]
+
+
+def rendition_name(kind: str, filename: str) -> str:
+    """Returns the storage name (relative to MEDIA_ROOT) of a rendition file."""
+
+    return os.path.join(kind, shard_dir(hash_from_filename(filename)), filename)
+
+
+def rendition_path(name: str, create_dirs: bool = False) -> str:
+    """Returns the absolute path for a storage name, optionally creating its shard
+    directory."""
+
+    path = os.path.join(settings.MEDIA_ROOT, name).strip()
+
+    if create_dirs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    return path
+
+
+def is_sharded(name: str) -> bool:
+    """Checks if a storage name already uses the sharded layout."""
+
+    return name.count(os.sep) > SHARD_LEVELS
+
+
+def protected_media_url(name: str) -> str:
+    """Returns the internal nginx redirect location for a storage name."""
+
+    return PROTECTED_MEDIA_URL + name
+
+
+def face_upload_to(instance, filename):  # pylint: disable=unused-argument
+    """`upload_to` callable for face crops."""
+
+    return rendition_name(FACES, filename)
+
+
+def has_rendition(photo, kind: str) -> bool:
+    """Checks the manifest of a photo for a generated rendition.
+
+    Renditions generated before the manifest existed, flat or sharded, are
+    looked up on disk once and recorded, so they are not generated again. The
+    manifest is persisted with the next save of the photo.
+    """
+
+    if photo.renditions and photo.renditions.get(kind):
+        return True
+
+    field = LEGACY_FIELDS.get(kind)
+    name = getattr(photo, field).name if field else None
+
+    if not name:
+        return False
+
+    # Video thumbnails are stored as webp frames next to the mp4 name.
+    if not os.path.exists(rendition_path(os.path.splitext(name)[0] + ".webp")):
+        return False
+
+    record_rendition(photo, kind, name)
+
+    return True
+
+
+def record_rendition(photo, kind: str, name: str):
+    """Records a generated rendition in the manifest of a photo."""
+
+    if photo.renditions is None:
+        photo.renditions = {}
+
+    photo.renditions[kind] = name
@@ -0,0 +1,16 @@
+"""Photo group serializer."""
+
+from rest_framework import serializers
+
+from api.models import PhotoGroup
+from api.serializers.simple import PhotoSuperSimpleSerializer
+
+
+class PhotoGroupSerializer(serializers.ModelSerializer):
+    """Near-duplicates or a burst, with their photos."""
+
+    photos = PhotoSuperSimpleSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = PhotoGroup
+        fields = ("id", "kind", "created_on", "photos")
@@ -3,9 +3,10 @@
 import json
 import pytz
 
+from django.db import models
 from rest_framework import serializers
 
-from api.image_similarity import search_similar_images
+from api.image_similarity import get_similar_photos
 from api.models import Photos
 from api.serializers.simple import UserSimpleSerializer
 from api.serializers.user import UserSerializer
@@ -13,6 +14,8 @@ from api.serializers.user import UserSerializer
 
 utc = pytz.UTC
 
+SIMILAR_PHOTOS_THRESHOLD = 0.9
+
 
 class PhotoHashListSerializer(serializers.ModelSerializer):
     class Meta:
@@ -20,6 +23,30 @@ class PhotoHashListSerializer(serializers.ModelSerializer):
         fields = ["image_hash", "video"]
 
 
+class PhotosListSerializer(serializers.ListSerializer):
+    """Looks up the similar photos of all serialized photos at once."""
+
+    def to_representation(self, data):
+        photos = list(data.all() if isinstance(data, models.Manager) else data)
+        image_hashes_by_owner = {}
+
+        for photo in photos:
+            image_hashes_by_owner.setdefault(photo.owner_id, []).append(
+                photo.image_hash
+            )
+
+        similar_photos = self.context.setdefault("similar_photos", {})
+
+        for owner_id, image_hashes in image_hashes_by_owner.items():
+            similar_photos.update(
+                get_similar_photos(
+                    owner_id, image_hashes, threshold=SIMILAR_PHOTOS_THRESHOLD
+                )
+            )
+
+        return super().to_representation(photos)
+
+
 class PhotosSerializer(serializers.ModelSerializer):
     """Photos serializer."""
 
@@ -57,13 +84,14 @@ class PhotosSerializer(serializers.ModelSerializer):
             "height",
             "width",
         )
+        list_serializer_class = PhotosListSerializer
 
     def get_similar_photos(self, obj) -> list:
-        """Retrieves a list of similar photos based on the given `obj` and `threshold` value.
+        """Retrieves a list of similar photos based on the given `obj`. List
+        serializers look them up for all photos at once.
 
         Parameters:
             obj (Photo): The photo object for which to retrieve similar photos.
-            threshold (int, optional): The threshold value for similarity. Defaults to 90.
 
         Returns:
             list: A list of dictionaries containing the image hash and type of each similar photo.
@@ -74,24 +102,14 @@ class PhotosSerializer(serializers.ModelSerializer):
                 If no similar photos are found, an empty list is returned.
         """
 
-        res = search_similar_images(obj.owner, obj, threshold=90)
-        arr = []
-
-        if len(res) > 0:
-            photos = Photos.objects.filter(image_hash__in=arr).all()
-            res = []
+        similar_photos = self.context.get("similar_photos", {})
 
-            for photo in photos:
-                photo_type = "image"
+        if obj.image_hash in similar_photos:
+            return similar_photos[obj.image_hash]
 
-                if photo.video:
-                    photo_type = "video"
-
-                res.append({"image_hash": photo.image_hash, "type": photo_type})
-
-            return res
-        else:
-            return []
+        return get_similar_photos(
+            obj.owner_id, [obj.image_hash], threshold=SIMILAR_PHOTOS_THRESHOLD
+        )[obj.image_hash]
 
     def get_captions_json(self, obj) -> dict:
         """Get the captions JSON for the given object.
@@ -251,6 +269,7 @@ class PhotoSummarySerializer(serializers.ModelSerializer):
         fields = (
             "id",
             "dominantColor",
+            "placeholder",
             "url",
             "location",
             "date",
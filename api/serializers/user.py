@@ -51,6 +51,9 @@ class UserSerializer(serializers.ModelSerializer):
             "confidence_unknown_face",
             "min_samples",
             "cluster_selection_epsilon",
+            "face_clustering_backend",
+            "face_clustering_threshold",
+            "face_classifier",
             "save_metadata_to_disk",
             "datetime_rules",
             "default_timezone",
@@ -163,6 +166,22 @@ class UserSerializer(serializers.ModelSerializer):
             )
             instance.save()
 
+        if "face_clustering_backend" in validated_data:
+            instance.face_clustering_backend = validated_data.pop(
+                "face_clustering_backend"
+            )
+            instance.save()
+
+        if "face_clustering_threshold" in validated_data:
+            instance.face_clustering_threshold = validated_data.pop(
+                "face_clustering_threshold"
+            )
+            instance.save()
+
+        if "face_classifier" in validated_data:
+            instance.face_classifier = validated_data.pop("face_classifier")
+            instance.save()
+
         if "llm_settings" in validated_data:
             instance.llm_settings = validated_data.pop("llm_settings")
             instance.save()
@@ -1,5 +1,7 @@
 """Contains functions to start and stop services."""
 
+import os
+import signal
 import subprocess
 import time
 
@@ -12,12 +14,34 @@ SERVICES = {
     "image_similarity": 8002,
     "thumbnail": 8003,
     "face_recognition": 8005,
+    "clip_embeddings": 8006,
     "llm": 8008,
     "image_captioning": 8007,
     "exif": 8010,
     "tags": 8011,
 }
 
+# Attempts at a request the model services reject because their queue is full.
+BUSY_ATTEMPTS = 5
+
+
+def post(url, **kwargs):
+    """Sends a POST request to a service. While the service answers 503 because
+    its request queue is full, the request is repeated after the Retry-After
+    delay it asks for, growing with every attempt."""
+
+    for attempt in range(1, BUSY_ATTEMPTS + 1):
+        response = requests.post(url, **kwargs)
+
+        if response.status_code != 503 or attempt == BUSY_ATTEMPTS:
+            return response
+
+        delay = float(response.headers.get("Retry-After", 1)) * attempt
+        logger.info("Service at %s is busy, retrying in %ss", url, delay)
+        time.sleep(delay)
+
+    return response
+
 
 def check_services():
     """Checks the health of all services. If any service is not healthy,
@@ -73,12 +97,15 @@ def start_service(service):
     """
 
     if service in SERVICES.keys():  # pylint: disable=consider-iterating-dictionary
+        # In a session of its own, the service and its worker processes form a
+        # process group that `stop_service` kills together.
         subprocess.Popen(
             [
                 "python",
                 f"service/{service}/main.py",
                 "2>&1 | tee {settings.BASE_LOGS}/{service}.log",
-            ]
+            ],
+            start_new_session=True,
         )
     else:
         logger.warning("Unknown service: %s", service)
@@ -91,7 +118,7 @@ def start_service(service):
 def stop_service(service):
     """
     Stops the specified service by finding its process ID (PID) using `ps` and `grep`,
-    and then killing each process found.
+    and then killing each process found together with its worker processes.
     Parameters:
         service (str): The name of the service to stop.
     Returns:
@@ -115,9 +142,20 @@ def stop_service(service):
             logger.warning("Service '%s' is not running", service)
             return False
 
-        # Kill each process found
-        for pid in pids:
-            subprocess.run(["kill", "-9", pid], check=True)
+        # Kill each process found, the worker processes of the model services
+        # do not match the pattern.
+        for pid in map(int, pids):
+            try:
+                if os.getpgid(pid) == pid:
+                    os.killpg(pid, signal.SIGKILL)
+                else:
+                    # Started before services had a process group of their own.
+                    subprocess.run(["pkill", "-9", "-P", str(pid)], check=False)
+                    os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # Already gone with the group of an earlier PID.
+                continue
+
             logger.info("Service '%s' with PID %d stopped successfully", service, pid)
 
         return True
@@ -8,10 +8,15 @@ import pytz
 from django import db
 from django_q.tasks import AsyncTask
 
+import api.face_extractor as face_extractor
 from api.face_classify import cluster_all_faces
+from api.face_persistence import save_faces
 from api.models import Job, Photos
 from api.utils import logger
 
+# Number of photos sent to the face detection service in one request.
+FACE_SCAN_BATCH_SIZE = 32
+
 
 def scan_faces(user, job_id):
     """Scans the faces of all photos owned by the given user and performs face
@@ -32,15 +37,18 @@ def scan_faces(user, job_id):
     lrj.save()
 
     try:
-        existing_photos = Photos.objects.filter(owner=user.id)
-        all_photos = [(photo, job_id) for photo in existing_photos]
+        existing_photos = list(Photos.objects.filter(owner=user.id))
+        batches = [
+            existing_photos[i : i + FACE_SCAN_BATCH_SIZE]
+            for i in range(0, len(existing_photos), FACE_SCAN_BATCH_SIZE)
+        ]
 
-        lrj.result = {"progress": {"current": 0, "target": existing_photos.count()}}
+        lrj.result = {"progress": {"current": 0, "target": len(existing_photos)}}
         lrj.save()
         db.connections.close_all()
 
-        for photo in all_photos:
-            face_scanner(*photo)
+        for batch in batches:
+            face_scanner(batch, job_id)
 
     except Exception as e:
         logger.exception("An error occured: ")
@@ -51,25 +59,51 @@ def scan_faces(user, job_id):
     AsyncTask(cluster_all_faces, user, cluster_job_id).run()
 
 
-def face_scan_job(photo: Photos, job_id):
-    """Updates the progress and status of a face scan job in the database."""
+def face_scan_job(photos: list[Photos], job_id):
+    """Detects faces for a batch of photos and updates the progress and status of
+    the face scan job in the database."""
 
     failed = False
+    detections = {}
 
     try:
-        photo._extract_faces()
+        detections = face_extractor.extract_and_encode_batch(
+            [photo.optimized_image.path for photo in photos], photos[0].owner
+        )
     except Exception:
         logger.exception("An error occurred: ")
-        failed = True
+
+    detected = [
+        (photo, detections[photo.optimized_image.path])
+        for photo in photos
+        if photo.optimized_image.path in detections
+    ]
+    remaining = [
+        photo for photo in photos if photo.optimized_image.path not in detections
+    ]
+
+    try:
+        save_faces(detected)
+    except Exception:
+        logger.exception("An error occurred while saving a batch of faces: ")
+        remaining = photos
+
+    # Photos the batch could not handle are processed one by one.
+    for photo in remaining:
+        try:
+            photo._extract_faces(detections=detections.get(photo.optimized_image.path))
+        except Exception:
+            logger.exception("An error occurred: ")
+            failed = True
 
     with db.connection.cursor() as cursor:
         cursor.execute(
             """
                 update api_Job
                 set result = jsonb_set(result,'{"progress","current"}',
-                      ((jsonb_extract_path(result,'progress','current')::int + 1)::text)::jsonb
+                      ((jsonb_extract_path(result,'progress','current')::int + %(count)s)::text)::jsonb
                 ) where job_id = %(job_id)s""",
-            {"job_id": str(job_id)},
+            {"job_id": str(job_id), "count": len(photos)},
         )
         cursor.execute(
             """
@@ -92,7 +126,8 @@ def face_scan_job(photo: Photos, job_id):
             )
 
 
-def face_scanner(photo: Photos, job_id):
-    """Runs the face_scanner task asynchronously using the AsyncTask class."""
+def face_scanner(photos: list[Photos], job_id):
+    """Runs the face_scan_job task for a batch of photos asynchronously using the
+    AsyncTask class."""
 
-    AsyncTask(face_scan_job, photo, job_id).run()
+    AsyncTask(face_scan_job, photos, job_id).run()
@@ -90,6 +90,7 @@ class AlbumDateViewSet(viewsets.ModelViewSet):
                 "main_file",
                 "search_location",
                 "dominant_color",
+                "placeholder",
                 "rating",
                 "hidden",
                 "exif_timestamp",
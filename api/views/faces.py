@@ -3,11 +3,19 @@
 import uuid
 
 from django.db.models import Case, Count, IntegerField, Q, When
+from django.http import HttpResponse
 from django_q.tasks import AsyncTask, Chain
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from api.face_classify import cluster_all_faces, cluster_faces
+from api.face_classify import (
+    FACE_MAP_FIELDS,
+    cluster_all_faces,
+    cluster_faces,
+    face_map_rows,
+    pack_face_map,
+    person_colors,
+)
 from api.ml_models import do_all_models_exist, download_models
 from api.models import Face
 from api.models.person import Person, get_or_create_person
@@ -19,21 +27,38 @@ from api.serializers.face import (
 from api.utils import logger
 from api.utils_face import scan_faces
 from api.mixins.list_view_mixin import ListViewSet
-from api.mixins.pagination_mixin import RegularResultsSetPagination
+from api.mixins.pagination_mixin import (
+    RegularResultsSetPagination,
+    StandardResultsSetPagination,
+)
 
 
 class ClusterFaceView(APIView):
-    # Deprecated
+    """Serves the stored face map positions, paginated, or with `?packed=true` as
+    `FACE_MAP_DTYPE` records."""
+
     def get(self, request, format=None):
-        return self._cluster_faces(request.user)
+        return self._cluster_faces(request)
 
     def post(self, request, format=None):
-        return self._cluster_faces(request.user)
+        return self._cluster_faces(request)
+
+    def _cluster_faces(self, request):
+        faces = cluster_faces(request.user)
 
-    def _cluster_faces(self, user):
-        res = cluster_faces(user)
+        if request.query_params.get("packed", "").lower() == "true":
+            return HttpResponse(
+                pack_face_map(faces), content_type="application/octet-stream"
+            )
+
+        paginator = StandardResultsSetPagination()
+        page = paginator.paginate_queryset(
+            faces.values_list(*FACE_MAP_FIELDS), request, view=self
+        )
 
-        return Response(res)
+        return paginator.get_paginated_response(
+            face_map_rows(page, person_colors(request.user))
+        )
 
 
 class ScanFacesView(APIView):
@@ -63,7 +88,7 @@ class TrainFaceView(APIView):
     def _train_faces(request):
         try:
             job_id = uuid.uuid4()
-            AsyncTask(cluster_all_faces, request.user, job_id).run()
+            AsyncTask(cluster_all_faces, request.user, job_id, full=True).run()
 
             return Response({"status": True, "job_id": job_id})
         except BaseException as e:
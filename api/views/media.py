@@ -1,5 +1,7 @@
 """Media views."""
 
+import os
+
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseForbidden
 from rest_framework.authtoken.models import Token
@@ -9,6 +11,12 @@ from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.tokens import AccessToken
 
 from api.models.photos import Photos
+from api.rendition_store import (
+    FACES,
+    protected_media_url,
+    rendition_name,
+    rendition_path,
+)
 from api.utils import logger
 
 
@@ -38,12 +46,13 @@ class MediaAccessView(APIView):
             logger.warning("Could not get token.")
             return HttpResponseForbidden()
 
-        match (path.lower()):
+        # Sharded rendition urls look like `faces/ab/cd`, only the kind matters here.
+        match (path.lower().split("/")[0]):
             case "thumbnails":
                 response = HttpResponse()
                 response["Content-Type"] = "image/webp"
-                response["X-Accel-Redirect"] = self._get_protected_media_url(
-                    "thumbnails", fname + ".webp"
+                response["X-Accel-Redirect"] = protected_media_url(
+                    os.path.splitext(photo.thumbnail.name)[0] + ".webp"
                 )
 
                 return response
@@ -51,18 +60,22 @@ class MediaAccessView(APIView):
             case "optimized":
                 response = HttpResponse()
                 response["Content-Type"] = "image/webp"
-                response["X-Accel-Redirect"] = self._get_protected_media_url(
-                    "optimized", fname + ".webp"
+                response["X-Accel-Redirect"] = protected_media_url(
+                    photo.optimized_image.name
                 )
 
                 return response
 
             case "faces":
+                name = rendition_name(FACES, fname)
+
+                # Face crops not moved by `shard_renditions` yet are still flat.
+                if not os.path.exists(rendition_path(name)):
+                    name = os.path.join(FACES, fname)
+
                 response = HttpResponse()
                 response["Content-Type"] = "image/jpg"
-                response["X-Accel-Redirect"] = self._get_protected_media_url(
-                    path, fname
-                )
+                response["X-Accel-Redirect"] = protected_media_url(name)
 
                 return response
 
@@ -0,0 +1,49 @@
+"""Near-duplicate and burst groups viewset."""
+
+import uuid
+
+from django.db.models import Prefetch
+from django_q.tasks import AsyncTask
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from api.duplicate_detection import detect_duplicates
+from api.mixins.list_view_mixin import ListViewSet
+from api.mixins.pagination_mixin import StandardResultsSetPagination
+from api.models import PhotoGroup, Photos
+from api.serializers.photo_group import PhotoGroupSerializer
+from api.utils import logger
+
+
+class PhotoGroupListViewSet(ListViewSet):
+    """Lists the duplicate and burst groups of the user, or only one `?kind=`."""
+
+    serializer_class = PhotoGroupSerializer
+    pagination_class = StandardResultsSetPagination
+
+    def get_queryset(self):
+        queryset = PhotoGroup.objects.filter(owner=self.request.user)
+        kind = self.request.query_params.get("kind", "").upper()
+
+        if kind:
+            queryset = queryset.filter(kind=kind)
+
+        return queryset.prefetch_related(
+            Prefetch(
+                "photos",
+                queryset=Photos.visible.order_by("exif_timestamp").only(
+                    "image_hash", "rating", "hidden", "exif_timestamp", "video"
+                ),
+            )
+        ).order_by("-created_on", "id")
+
+
+class DetectDuplicatesView(APIView):
+    def post(self, request, format=None):
+        try:
+            job_id = uuid.uuid4()
+            AsyncTask(detect_duplicates, request.user, job_id).run()
+            return Response({"status": True, "job_id": job_id})
+        except BaseException as e:
+            logger.error(str(e))
+            return Response({"status": False})
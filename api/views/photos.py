@@ -1,7 +1,10 @@
 # pylint: disable=redefined-builtin, unused-argument
 """Photos viewset."""
 
+import uuid
+
 from django.db.models import Prefetch, Q
+from django_q.tasks import AsyncTask
 from rest_framework import filters, status, permissions
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAdminUser
@@ -9,6 +12,7 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 
+from api.background_tasks import generate_im2txt_captions
 from api.mixins.list_view_mixin import ListViewSet
 from api.mixins.pagination_mixin import (
     HugeResultsSetPagination,
@@ -363,6 +367,25 @@ class GeneratePhotoCaption(APIView):
         return Response({"status": res})
 
 
+class GenerateCaptionsView(APIView):
+    """Starts a job captioning all photos of the user, or only those without a
+    caption unless `overwrite` is set."""
+
+    def post(self, request, format=None):
+        try:
+            job_id = uuid.uuid4()
+            AsyncTask(
+                generate_im2txt_captions,
+                request.user,
+                job_id,
+                bool(request.data.get("overwrite", False)),
+            ).run()
+            return Response({"status": True, "job_id": job_id})
+        except BaseException as e:
+            logger.error(str(e))
+            return Response({"status": False})
+
+
 class SavePhotoCaption(APIView):
     permission_classes = (IsOwnerOrReadOnly,)
 
@@ -41,6 +41,7 @@ class SearchListViewSet(ListViewSet):
                 "original_image",
                 "search_location",
                 "dominant_color",
+                "placeholder",
                 "rating",
                 "hidden",
                 "exif_timestamp",
@@ -22,6 +22,7 @@ IM2TXT_ROOT = os.path.join(MEDIA_ROOT, "data_models", "im2txt")
 IM2TXT_ONNX_ROOT = os.path.join(MEDIA_ROOT, "data_models", "im2txt_onnx")
 BLIP_ROOT = os.path.join(MEDIA_ROOT, "data_models", "blip")
 PLACES365_ROOT = os.path.join(MEDIA_ROOT, "data_models", "places365", "model")
+EMBEDDINGS_ROOT = os.path.join(MEDIA_ROOT, "embeddings")
 LOGS_ROOT = BASE_LOGS
 
 #################################################
@@ -23,6 +23,7 @@ from api.views import (
     media,
     misc_views,
     person,
+    photo_groups,
     photos,
     search,
     services,
@@ -109,6 +110,10 @@ router.register(
     r"api/photos/exists", upload.UploadPhotoExists, basename="photos_exists"
 )
 
+router.register(
+    r"api/photos/groups", photo_groups.PhotoGroupListViewSet, basename="photo_groups"
+)
+
 router.register(
     r"api/photos/recently-added",
     photos.RecentlyAddedPhotosViewSet,
@@ -180,7 +185,9 @@ urlpatterns = [
         r"^api/photos/edit/caption/generate", photos.GeneratePhotoCaption.as_view()
     ),
     re_path(r"^api/photos/edit/caption/save", photos.SavePhotoCaption.as_view()),
+    re_path(r"^api/photos/captions/generate", photos.GenerateCaptionsView.as_view()),
     re_path(r"^api/photos/edit/set-deleted", photos.SetPhotosDeleted.as_view()),
+    re_path(r"^api/photos/groups/detect", photo_groups.DetectDuplicatesView.as_view()),
     re_path(r"^api/photos/month-counts", dataviz.PhotoMonthCountsView.as_view()),
     re_path(r"^api/queue-availability/$", jobs.QueueAvailabilityView.as_view()),
     re_path(r"^api/rules/default", user.DefaultRulesView.as_view()),
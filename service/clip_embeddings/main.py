@@ -0,0 +1,256 @@
+import base64
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gevent
+import numpy as np
+import PIL
+import torch
+from flask import Flask, request
+from gevent.pywsgi import WSGIServer
+from transformers import CLIPModel, CLIPProcessor
+
+# The services are started as scripts, the shared modules are one level up.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_server import (  # noqa: E402 pylint: disable=import-error
+    MicroBatcher,
+    QueueFull,
+    busy,
+)
+
+app = Flask(__name__)
+
+last_request_time = None
+
+MODEL_PATH = os.environ.get(
+    "CLIP_MODEL_PATH", "/protected_media/data_models/clip-embeddings"
+)
+# Images per forward pass. Larger batches use the cores better but need more
+# memory, about 20 MB per image for ViT-B/32.
+BATCH_SIZE = int(os.environ.get("CLIP_BATCH_SIZE", 32))
+# Threads used by torch, 0 leaves the torch default.
+THREADS = int(os.environ.get("CLIP_THREADS", 0))
+# Threads decoding images while the model runs.
+LOADERS = int(os.environ.get("CLIP_LOADERS", 4))
+# CLIP looks at 224x224 pixels, so larger images are decoded at a reduced size.
+DRAFT_SIZE = (448, 448)
+
+clip_instance = None
+loader_pool = None
+
+
+def log(message):
+    print("clip_embeddings: {}".format(message))
+
+
+def encode_array(array):
+    """Packs a NumPy array as base64 bytes instead of nested JSON float lists."""
+
+    array = np.ascontiguousarray(array)
+
+    return {
+        "data": base64.b64encode(array.tobytes()).decode("ascii"),
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+    }
+
+
+def get_loader_pool():
+    global loader_pool
+
+    if loader_pool is None:
+        loader_pool = ThreadPoolExecutor(max_workers=LOADERS)
+
+    return loader_pool
+
+
+def load_image(source):
+    try:
+        image = PIL.Image.open(source)
+        image.draft("RGB", DRAFT_SIZE)
+
+        return source, image.convert("RGB"), None
+    except Exception as e:
+        return source, None, str(e)
+
+
+class Clip:
+    """CLIP ViT-B/32 image and text encoder.
+
+    The clip-embeddings model is stored in the sentence-transformers layout,
+    with the Hugging Face model in its 0_CLIPModel directory. Embeddings are
+    returned as computed, the similarity index scales them to unit length.
+    """
+
+    def __init__(self, model_path=MODEL_PATH):
+        if os.path.isdir(os.path.join(model_path, "0_CLIPModel")):
+            model_path = os.path.join(model_path, "0_CLIPModel")
+
+        if THREADS > 0:
+            torch.set_num_threads(THREADS)
+
+        self.model = CLIPModel.from_pretrained(model_path).eval()
+        self.processor = CLIPProcessor.from_pretrained(model_path)
+
+    def encode_images(self, images):
+        """Returns an (N, 512) float32 matrix for a list of PIL images."""
+
+        embeddings = []
+
+        with torch.inference_mode():
+            for start in range(0, len(images), BATCH_SIZE):
+                inputs = self.processor(
+                    images=images[start : start + BATCH_SIZE], return_tensors="pt"
+                )
+                embeddings.append(self.model.get_image_features(**inputs).numpy())
+
+        return np.concatenate(embeddings).astype(np.float32)
+
+    def encode_texts(self, texts):
+        """Returns an (N, 512) float32 matrix for a list of strings."""
+
+        embeddings = []
+
+        with torch.inference_mode():
+            for start in range(0, len(texts), BATCH_SIZE):
+                inputs = self.processor(
+                    text=texts[start : start + BATCH_SIZE],
+                    return_tensors="pt",
+                    padding=True,
+                    truncation=True,
+                )
+                embeddings.append(self.model.get_text_features(**inputs).numpy())
+
+        return np.concatenate(embeddings).astype(np.float32)
+
+
+def get_clip():
+    global clip_instance
+
+    if clip_instance is None:
+        clip_instance = Clip()
+
+    return clip_instance
+
+
+def embed_images(sources):
+    """Encodes a batch of image paths, returning an (embedding, error) pair per
+    image. Images are decoded concurrently and run through the model together."""
+
+    results = [None] * len(sources)
+    loaded = []
+
+    for row, (_, image, error) in enumerate(get_loader_pool().map(load_image, sources)):
+        if error:
+            results[row] = (None, error)
+        else:
+            loaded.append((row, image))
+
+    if loaded:
+        embeddings = get_clip().encode_images([image for _, image in loaded])
+
+        for (row, _), embedding in zip(loaded, embeddings):
+            results[row] = (embedding, None)
+
+    return results
+
+
+def embed_texts(texts):
+    """Encodes a batch of texts, returning an (embedding, error) pair per text."""
+
+    return [(embedding, None) for embedding in get_clip().encode_texts(texts)]
+
+
+# Images and texts are batched across requests, each on its own batcher, so the
+# short text queries of searches do not wait behind the images of a scan.
+# Configured with CLIP_IMAGES_* and CLIP_TEXTS_*, see `MicroBatcher.from_env`.
+image_batcher = MicroBatcher.from_env(
+    "clip_images", embed_images, "CLIP_IMAGES", max_batch_size=BATCH_SIZE
+)
+text_batcher = MicroBatcher.from_env(
+    "clip_texts", embed_texts, "CLIP_TEXTS", max_batch_size=BATCH_SIZE
+)
+
+
+def pack_results(results):
+    """Returns the rows of the encoded items as one (N, 512) matrix and the
+    errors of the others by position."""
+
+    embeddings = [embedding for embedding, error in results if not error]
+
+    return (
+        np.stack(embeddings) if embeddings else np.empty((0, 512), dtype=np.float32),
+        {row: error for row, (_, error) in enumerate(results) if error},
+    )
+
+
+@app.route("/image-embeddings", methods=["POST"])
+def create_image_embeddings():
+    """Encodes many images, batched together with the requests of other
+    clients."""
+
+    global last_request_time
+    # Update last request time
+    last_request_time = time.time()
+
+    try:
+        data = request.get_json()
+        sources = list(data["sources"])
+    except Exception:
+        return "", 400
+
+    try:
+        results = image_batcher.submit_many(sources)
+    except QueueFull as e:
+        return busy(e)
+
+    embeddings, errors = pack_results(results)
+    errors = {sources[row]: error for row, error in errors.items()}
+
+    log(f"encoded {len(embeddings)} images, {len(errors)} failed")
+    return {
+        "sources": [source for source in sources if source not in errors],
+        "embeddings": encode_array(embeddings),
+        "errors": errors,
+    }, 201
+
+
+@app.route("/text-embeddings", methods=["POST"])
+def create_text_embeddings():
+    global last_request_time
+    # Update last request time
+    last_request_time = time.time()
+
+    try:
+        data = request.get_json()
+        texts = [str(text) for text in data["texts"]]
+    except Exception:
+        return "", 400
+
+    try:
+        embeddings, _ = pack_results(text_batcher.submit_many(texts))
+    except QueueFull as e:
+        return busy(e)
+
+    return {"embeddings": encode_array(embeddings)}, 201
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    return {
+        "last_request_time": last_request_time,
+        "batching": {
+            "images": image_batcher.stats(),
+            "texts": text_batcher.stats(),
+        },
+    }, 200
+
+
+if __name__ == "__main__":
+    log("service starting")
+    server = WSGIServer(("0.0.0.0", 8006), app)
+    server_thread = gevent.spawn(server.serve_forever)
+    gevent.joinall([server_thread])
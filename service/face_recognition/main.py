@@ -1,4 +1,8 @@
+import base64
+import os
+import sys
 import time
+from io import BytesIO
 
 import face_recognition
 import gevent
@@ -7,15 +11,252 @@ import PIL
 from flask import Flask, request
 from gevent.pywsgi import WSGIServer
 
+# The services are started as scripts, the shared modules are one level up.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_server import (  # noqa: E402 pylint: disable=import-error
+    MicroBatcher,
+    QueueFull,
+    busy,
+)
+
 app = Flask(__name__)
 
 last_request_time = None
 
+# Number of processes running detection and encoding.
+WORKERS = int(os.environ.get("FACE_RECOGNITION_WORKERS", os.cpu_count() or 1))
+# dlib handles one image at a time, so batches are kept small to spread the
+# images of a batch request over all workers.
+MAX_BATCH_SIZE = 4
+# Longest side in pixels that detection runs on. 0 disables downscaling.
+DETECTION_MAX_SIZE = int(os.environ.get("FACE_DETECTION_MAX_SIZE", 1600))
+# Overlap between tiles, relative to the tile size.
+TILE_OVERLAP = 0.2
+MODELS = ("hog", "cnn")
+
 
 def log(message):
     print("face_recognition: {}".format(message))
 
 
+def parse_model(model):
+    model = (model or "hog").lower()
+
+    return model if model in MODELS else "hog"
+
+
+def load_image(source):
+    image = PIL.Image.open(source)
+    image.draft("RGB", image.size)
+
+    return image.convert("RGB")
+
+
+def _iou(box, other):
+    top, right, bottom, left = box
+    other_top, other_right, other_bottom, other_left = other
+    width = min(right, other_right) - max(left, other_left)
+    height = min(bottom, other_bottom) - max(top, other_top)
+
+    if width <= 0 or height <= 0:
+        return 0.0
+
+    intersection = width * height
+    area = (right - left) * (bottom - top)
+    other_area = (other_right - other_left) * (other_bottom - other_top)
+
+    return intersection / float(area + other_area - intersection)
+
+
+def _suppress_duplicates(boxes, threshold=0.3):
+    """Drops boxes found twice in overlapping tiles, keeping the larger one."""
+
+    kept = []
+
+    for box in sorted(boxes, key=lambda b: (b[1] - b[3]) * (b[2] - b[0]), reverse=True):
+        if all(_iou(box, other) < threshold for other in kept):
+            kept.append(box)
+
+    return kept
+
+
+def _tile_offsets(size, tile_size):
+    if size <= tile_size:
+        return [0]
+
+    step = max(1, int(tile_size * (1 - TILE_OVERLAP)))
+
+    # The last tile is aligned to the edge so the whole image is covered.
+    return list(range(0, size - tile_size, step)) + [size - tile_size]
+
+
+def _tiles(width, height, tile_size):
+    for top in _tile_offsets(height, tile_size):
+        for left in _tile_offsets(width, tile_size):
+            yield left, top, min(left + tile_size, width), min(top + tile_size, height)
+
+
+def detect_faces(source, model="hog", max_size=DETECTION_MAX_SIZE, tile=False):
+    """Detects faces in an image file, see `detect_faces_in_image`."""
+
+    return detect_faces_in_image(load_image(source), model, max_size, tile)
+
+
+def detect_faces_in_image(image, model="hog", max_size=DETECTION_MAX_SIZE, tile=False):
+    """Detects faces in a decoded image and returns (top, right, bottom, left) boxes
+    in full resolution coordinates.
+
+    Large images are either downscaled to `max_size` before detection, or, with
+    `tile`, split into overlapping `max_size` tiles so small faces stay detectable.
+    """
+
+    width, height = image.size
+    longest_side = max(width, height)
+
+    if not max_size or longest_side <= max_size:
+        return [
+            tuple(box)
+            for box in face_recognition.face_locations(np.array(image), model=model)
+        ]
+
+    if tile:
+        boxes = []
+
+        for left, top, right, bottom in _tiles(width, height, max_size):
+            crop = np.array(image.crop((left, top, right, bottom)))
+
+            for t, r, b, l in face_recognition.face_locations(crop, model=model):
+                boxes.append((t + top, r + left, b + top, l + left))
+
+        return _suppress_duplicates(boxes)
+
+    scale = max_size / longest_side
+    resized = image.resize(
+        (round(width * scale), round(height * scale)), PIL.Image.Resampling.BILINEAR
+    )
+    boxes = face_recognition.face_locations(np.array(resized), model=model)
+
+    return [
+        (
+            max(0, int(round(top / scale))),
+            min(width, int(round(right / scale))),
+            min(height, int(round(bottom / scale))),
+            max(0, int(round(left / scale))),
+        )
+        for top, right, bottom, left in boxes
+    ]
+
+
+def _detect_faces_safe(args):
+    source, model, max_size, tile = args
+
+    try:
+        return source, detect_faces(source, model, max_size, tile), None
+    except Exception as e:
+        return source, [], str(e)
+
+
+def encode_array(array):
+    """Packs a NumPy array as base64 bytes instead of nested JSON float lists."""
+
+    array = np.ascontiguousarray(array)
+
+    return {
+        "data": base64.b64encode(array.tobytes()).decode("ascii"),
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+    }
+
+
+def detect_and_encode(
+    source,
+    model="hog",
+    max_size=DETECTION_MAX_SIZE,
+    tile=False,
+    known_face_locations=None,
+    crops=True,
+):
+    """Decodes an image once, then detects, encodes and optionally crops its faces."""
+
+    image = load_image(source)
+
+    if known_face_locations is None:
+        face_locations = detect_faces_in_image(image, model, max_size, tile)
+    else:
+        face_locations = [tuple(location[:4]) for location in known_face_locations]
+
+    face_encodings = face_recognition.face_encodings(
+        np.array(image), known_face_locations=face_locations
+    )
+    encodings = np.array(face_encodings, dtype=np.float64).reshape(-1, 128)
+    face_crops = []
+
+    if crops:
+        for top, right, bottom, left in face_locations:
+            with BytesIO() as buffer:
+                image.crop((left, top, right, bottom)).save(buffer, format="JPEG")
+                face_crops.append(base64.b64encode(buffer.getvalue()).decode("ascii"))
+
+    return {
+        "face_locations": face_locations,
+        "encodings": encode_array(encodings),
+        "crops": face_crops,
+    }
+
+
+def _detect_and_encode_safe(args):
+    source, kwargs = args
+
+    try:
+        return source, detect_and_encode(source, **kwargs), None
+    except Exception as e:
+        return source, None, str(e)
+
+
+def _face_encodings_safe(args):
+    source, face_locations = args
+
+    try:
+        image = np.array(PIL.Image.open(source))
+        face_encodings = face_recognition.face_encodings(
+            image,
+            known_face_locations=face_locations,
+        )
+        # Convert NumPy arrays to Python lists
+        return source, [enc.tolist() for enc in face_encodings], None
+    except Exception as e:
+        return source, [], str(e)
+
+
+def run_jobs(jobs):
+    """Runs a batch of (function, arguments) jobs, one of the `_safe` functions
+    above each."""
+
+    return [function(args) for function, args in jobs]
+
+
+# Requests of concurrent clients share the queue and the worker processes,
+# configured with FACE_RECOGNITION_MAX_BATCH_SIZE, FACE_RECOGNITION_MAX_WAIT_MS,
+# FACE_RECOGNITION_MAX_QUEUE_SIZE and FACE_RECOGNITION_WORKERS.
+batcher = MicroBatcher.from_env(
+    "face_recognition",
+    run_jobs,
+    "FACE_RECOGNITION",
+    max_batch_size=MAX_BATCH_SIZE,
+    workers=WORKERS,
+)
+
+
+def parse_detection_options(data):
+    return {
+        "model": parse_model(data.get("model")),
+        "max_size": int(data.get("max_size", DETECTION_MAX_SIZE)),
+        "tile": bool(data.get("tile", False)),
+        "crops": bool(data.get("crops", True)),
+    }
+
+
 @app.route("/face-encodings", methods=["POST"])
 def create_face_encodings():
     global last_request_time
@@ -29,13 +270,17 @@ def create_face_encodings():
     except Exception:
         return "", 400
 
-    image = np.array(PIL.Image.open(source))
-    face_encodings = face_recognition.face_encodings(
-        image,
-        known_face_locations=face_locations,
-    )
-    # Convert NumPy arrays to Python lists
-    face_encodings_list = [enc.tolist() for enc in face_encodings]
+    try:
+        _, face_encodings_list, error = batcher.submit(
+            (_face_encodings_safe, (source, face_locations))
+        )
+    except QueueFull as e:
+        return busy(e)
+
+    if error:
+        log(f"could not encode faces of {source}: {error}")
+        return {"error": error}, 500
+
     # Log number of face encodings
     log(f"created face_encodings={len(face_encodings_list)}")
     return {"encodings": face_encodings_list}, 201
@@ -50,20 +295,138 @@ def create_face_locations():
     try:
         data = request.get_json()
         source = data["source"]
-        model = data["model"]
+        model = parse_model(data.get("model"))
+        max_size = int(data.get("max_size", DETECTION_MAX_SIZE))
+        tile = bool(data.get("tile", False))
     except Exception:
         return "", 400
 
-    # image = np.array(PIL.Image.open(source))
-    image = face_recognition.load_image_file(source)
-    face_locations = face_recognition.face_locations(image)
+    try:
+        _, face_locations, error = batcher.submit(
+            (_detect_faces_safe, (source, model, max_size, tile))
+        )
+    except QueueFull as e:
+        return busy(e)
+
+    if error:
+        log(f"could not detect faces of {source}: {error}")
+        return {"error": error}, 500
+
     log(f"created face_location={face_locations}")
     return {"face_locations": face_locations}, 201
 
 
+@app.route("/face-locations-batch", methods=["POST"])
+def create_face_locations_batch():
+    """Detects faces for many images at once, spread over the worker processes."""
+
+    global last_request_time
+    # Update last request time
+    last_request_time = time.time()
+
+    try:
+        data = request.get_json()
+        sources = list(data["sources"])
+        model = parse_model(data.get("model"))
+        max_size = int(data.get("max_size", DETECTION_MAX_SIZE))
+        tile = bool(data.get("tile", False))
+    except Exception:
+        return "", 400
+
+    try:
+        results = batcher.submit_many(
+            (_detect_faces_safe, (source, model, max_size, tile)) for source in sources
+        )
+    except QueueFull as e:
+        return busy(e)
+
+    face_locations = {}
+    errors = {}
+
+    for source, locations, error in results:
+        face_locations[source] = locations
+
+        if error:
+            errors[source] = error
+
+    log(f"created face_locations for {len(sources)} images with model={model}")
+    return {"face_locations": face_locations, "errors": errors}, 201
+
+
+@app.route("/detect-and-encode", methods=["POST"])
+def create_detect_and_encode():
+    """Returns locations, encodings and optionally JPEG crops of all faces in one
+    image, decoding the image only once."""
+
+    global last_request_time
+    # Update last request time
+    last_request_time = time.time()
+
+    try:
+        data = request.get_json()
+        source = data["source"]
+        options = parse_detection_options(data)
+        known_face_locations = data.get("known_face_locations")
+    except Exception:
+        return "", 400
+
+    try:
+        _, result, error = batcher.submit(
+            (
+                _detect_and_encode_safe,
+                (source, dict(options, known_face_locations=known_face_locations)),
+            )
+        )
+    except QueueFull as e:
+        return busy(e)
+
+    if error:
+        log(f"could not detect and encode faces of {source}: {error}")
+        return {"error": error}, 500
+
+    log(f"detected and encoded faces={len(result['face_locations'])}")
+    return result, 201
+
+
+@app.route("/detect-and-encode-batch", methods=["POST"])
+def create_detect_and_encode_batch():
+    """Runs `/detect-and-encode` for many images, spread over the worker
+    processes."""
+
+    global last_request_time
+    # Update last request time
+    last_request_time = time.time()
+
+    try:
+        data = request.get_json()
+        sources = list(data["sources"])
+        options = parse_detection_options(data)
+    except Exception:
+        return "", 400
+
+    try:
+        detections = batcher.submit_many(
+            (_detect_and_encode_safe, (source, options)) for source in sources
+        )
+    except QueueFull as e:
+        return busy(e)
+
+    results = {}
+    errors = {}
+
+    for source, result, error in detections:
+        if error:
+            errors[source] = error
+        else:
+            results[source] = result
+
+    log(f"detected and encoded faces for {len(sources)} images")
+    return {"results": results, "errors": errors}, 201
+
+
 @app.route("/health", methods=["GET"])
 def health():
-    return {"last_request_time": last_request_time}, 200
+    return {"last_request_time": last_request_time, "batching": batcher.stats()}, 200
 
 
 if __name__ == "__main__":
@@ -53,3 +53,22 @@ class DecoderRNN(nn.Module):
             sampled_ids, 1
         )  # sampled_ids: (batch_size, max_seq_length)
         return sampled_ids
+
+    def sample(self, features, end_id):
+        """Greedy search like `forward`, but stops once every caption of the batch
+        has ended. Tokens after the end of a caption are `end_id`."""
+        sampled_ids = []
+        states = None
+        inputs = features.unsqueeze(1)
+        ended = torch.zeros(features.size(0), dtype=torch.bool, device=features.device)
+        for i in range(self.max_seg_length):
+            hiddens, states = self.lstm(inputs, states)
+            outputs = self.linear(hiddens.squeeze(1))
+            _, predicted = outputs.max(1)
+            predicted = predicted.masked_fill(ended, end_id)
+            sampled_ids.append(predicted)
+            ended |= predicted == end_id
+            if ended.all():
+                break
+            inputs = self.embed(predicted).unsqueeze(1)
+        return torch.stack(sampled_ids, 1)
@@ -1,9 +1,9 @@
 import os
 import pickle
 
+import numpy as np
 import onnxruntime as ort
 import torch
-from numpy import asarray
 from PIL import Image
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
@@ -32,6 +32,28 @@ vocab_onnx_path = os.path.join(im2txt_onnx_models_path, "vocab.pkl")
 blip_model_url = os.path.join(blip_models_path, "model_base_capfilt_large.pth")
 blip_config_url = os.path.join(blip_models_path, "med_config.json")
 
+transform = transforms.Compose(
+    [
+        transforms.Resize((224, 224), interpolation=InterpolationMode.BICUBIC),
+        transforms.ToTensor(),
+        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    ]
+)
+
+blip_transform = transforms.Compose(
+    [
+        transforms.Resize(
+            (blip_image_size, blip_image_size),
+            interpolation=InterpolationMode.BICUBIC,
+        ),
+        transforms.ToTensor(),
+        transforms.Normalize(
+            (0.48145466, 0.4578275, 0.40821073),
+            (0.26862954, 0.26130258, 0.27577711),
+        ),
+    ]
+)
+
 
 class Im2txt(object):
     def __init__(
@@ -129,81 +151,63 @@ class Im2txt(object):
         image_path,
         onnx=False,
     ):
-        self.load_models(onnx=onnx)
+        return self.generate_captions([image_path], onnx=onnx)[0]
 
-        transform = transforms.Compose(
-            [
-                transforms.Resize((224, 224), interpolation=InterpolationMode.BICUBIC),
-                transforms.ToTensor(),
-                transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-            ]
-        )
+    def generate_captions(self, image_paths, onnx=False):
+        """Captions a batch of images with one pass through the encoder and a
+        batched decoder, returning one caption per image."""
 
-        blip_transform = transforms.Compose(
-            [
-                transforms.Resize(
-                    (blip_image_size, blip_image_size),
-                    interpolation=InterpolationMode.BICUBIC,
-                ),
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    (0.48145466, 0.4578275, 0.40821073),
-                    (0.26862954, 0.26130258, 0.27577711),
-                ),
-            ]
-        )
+        self.load_models(onnx=onnx)
 
         if self.blip:
-            image = self.load_image(image_path, blip_transform).to(self.device)
+            images = torch.cat(
+                [self.load_image(path, blip_transform) for path in image_paths]
+            ).to(self.device)
             with torch.no_grad():
-                caption_blip = self.model.generate(
-                    image, sample=True, num_beams=3, max_length=50, min_length=10
+                # Beam search pads the captions of the batch that end early, and
+                # unlike sampling returns the same caption for the same image.
+                return self.model.generate(
+                    images, sample=False, num_beams=3, max_length=50, min_length=10
                 )
-                return caption_blip[0]
 
-        # Prepare an image
-        image = self.load_image(image_path, transform)
-        if onnx:
-            # image to numpy
-
-            image_np = asarray(image)
-            print("Before encoder")
-            # Generate features with the ONNX Encoder
-            encoder_output = self.encoder.run(["embedding"], {"image": image_np})[0]
-            print("After encoder")
-            inputs = {
-                "embedding": encoder_output,
-            }
-            sampled_ids = self.decoder.run(["caption"], inputs)
-            sampled_ids = sampled_ids[0][0]
-
-            # Convert word_ids to words
-            sampled_caption = []
-            for word_id in sampled_ids:
-                word = self.vocab.idx2word[word_id]
-                sampled_caption.append(word)
-                if word == "<end>":
-                    break
-            sentence = " ".join(sampled_caption)
+        images = torch.cat([self.load_image(path, transform) for path in image_paths])
 
+        if onnx:
+            embeddings = self.run_onnx(self.encoder, "image", "embedding", images)
+            sampled_ids = self.run_onnx(
+                self.decoder, "embedding", "caption", embeddings
+            )
         else:
-            image_tensor = image.to(self.device)
-            feature = self.encoder(image_tensor)
-            sampled_ids = self.decoder.forward(feature)
-            sampled_ids = (
-                sampled_ids[0].cpu().numpy()
-            )  # (1, max_seq_length) -> (max_seq_length)
-
-            # Convert word_ids to words
-            sampled_caption = []
-            for word_id in sampled_ids:
-                word = self.vocab.idx2word[word_id]
-                sampled_caption.append(word)
-                if word == "<end>":
-                    break
-            sentence = " ".join(sampled_caption)
-
-        return sentence
+            with torch.no_grad():
+                features = self.encoder(images.to(self.device))
+                sampled_ids = self.decoder.sample(features, self.vocab("<end>"))
+            sampled_ids = sampled_ids.cpu().numpy()
+
+        return [self.to_sentence(word_ids) for word_ids in sampled_ids]
+
+    def run_onnx(self, session, input_name, output_name, batch):
+        batch = np.asarray(batch)
+
+        # Models exported with a fixed batch size of one run image by image.
+        if isinstance(session.get_inputs()[0].shape[0], int) and len(batch) > 1:
+            return np.concatenate(
+                [
+                    session.run([output_name], {input_name: batch[row : row + 1]})[0]
+                    for row in range(len(batch))
+                ]
+            )
+
+        return session.run([output_name], {input_name: batch})[0]
+
+    def to_sentence(self, word_ids):
+        # Convert word_ids to words
+        sampled_caption = []
+        for word_id in word_ids:
+            word = self.vocab.idx2word[word_id]
+            sampled_caption.append(word)
+            if word == "<end>":
+                break
+        return " ".join(sampled_caption)
 
     def export_onnx(self, encoder_output_path, decoder_output_path):
         from torch.onnx import dynamo_export, export
@@ -225,6 +229,7 @@ class Im2txt(object):
                 verbose=True,
                 input_names=["image"],
                 output_names=["embedding"],
+                dynamic_axes={"image": {0: "batch"}, "embedding": {0: "batch"}},
             )
 
             encoder_dyn_export_path = encoder_output_path.replace(".onnx", "_dyn.onnx")
@@ -244,6 +249,7 @@ class Im2txt(object):
                 verbose=True,
                 input_names=["embedding"],
                 output_names=["caption"],
+                dynamic_axes={"embedding": {0: "batch"}, "caption": {0: "batch"}},
             )
 
             decoder_dyn_export_path = decoder_output_path.replace(".onnx", "_dyn.onnx")
@@ -1,21 +1,168 @@
+import os
+import sys
 import time
 
+import diskcache
 import gevent
 from flask import Flask, request
 from gevent.pywsgi import WSGIServer
 
-from api.im2txt.sample import Im2txt
+from registry import (  # pylint: disable=import-error
+    IM2TXT,
+    IM2TXT_ONNX,
+    MODELS,
+    ModelRegistry,
+    model_name,
+)
+
+# The services are started as scripts, the shared modules are one level up.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_server import (  # noqa: E402 pylint: disable=import-error
+    MicroBatcher,
+    QueueFull,
+    busy,
+)
 
 app = Flask(__name__)
 
-im2txt_instance = None
+registry = ModelRegistry()
 last_request_time = None
 
+# Captions by (image hash, model). Decoding is deterministic, so a caption is
+# only computed again when asked to refresh it.
+CACHE_ROOT = os.environ.get(
+    "CAPTION_CACHE_ROOT",
+    os.path.join(
+        os.environ.get("BASE_DATA", "/"), "protected_media", "cache", "captions"
+    ),
+)
+
+caption_cache = None
+
 
 def log(message):
     print("image_captioning: {}".format(message))
 
 
+def get_caption_cache():
+    global caption_cache
+
+    if caption_cache is None:
+        caption_cache = diskcache.Cache(CACHE_ROOT)
+
+    return caption_cache
+
+
+def in_thread(function, *args):
+    """Runs a registry call on a native thread, as it may wait for a model in
+    use by the batcher."""
+
+    return gevent.get_hub().threadpool.apply(function, args)
+
+
+def caption_images(items):
+    """Captions a batch of (model, image path) items, returning a (caption,
+    error) pair per item. Images of the same model are decoded together.
+
+    Items without an image path load their model instead, if they name one, and
+    return the models loaded in the process in place of a caption."""
+
+    results = [None] * len(items)
+    rows_by_model = {}
+
+    for row, (model, image_path) in enumerate(items):
+        if image_path is not None:
+            rows_by_model.setdefault(model, []).append(row)
+            continue
+
+        try:
+            if model is not None:
+                registry.get(model)
+
+            results[row] = (registry.loaded(), None)
+        except Exception as e:
+            results[row] = (None, str(e))
+
+    for model, rows in rows_by_model.items():
+        try:
+            captions = registry.caption(model, [items[row][1] for row in rows])
+
+            for row, caption in zip(rows, captions):
+                results[row] = (caption, None)
+        except Exception:
+            # One unreadable image fails its batch, so the images of the batch
+            # are captioned one at a time instead.
+            for row in rows:
+                try:
+                    results[row] = (registry.caption(model, [items[row][1]])[0], None)
+                except Exception as e:
+                    results[row] = (None, str(e))
+
+    return results
+
+
+# Requests of concurrent clients are queued and captioned in batches,
+# configured with CAPTIONING_MAX_BATCH_SIZE, CAPTIONING_MAX_WAIT_MS,
+# CAPTIONING_MAX_QUEUE_SIZE and CAPTIONING_WORKERS.
+batcher = MicroBatcher.from_env(
+    "image_captioning", caption_images, "CAPTIONING", max_batch_size=8
+)
+
+
+def caption_with_cache(images, model, refresh=False):
+    """Captions (image path, image hash) pairs with `model`, returning a
+    (caption, error) pair per image. Images without a hash are not cached."""
+
+    cache = get_caption_cache()
+    results = [None] * len(images)
+    missing = []
+
+    for row, (_, image_hash) in enumerate(images):
+        cached = None if refresh or not image_hash else cache.get((image_hash, model))
+
+        if cached is None:
+            missing.append(row)
+        else:
+            results[row] = (cached, None)
+
+    if missing:
+        captions = batcher.submit_many((model, images[row][0]) for row in missing)
+
+        for row, (caption, error) in zip(missing, captions):
+            results[row] = (caption, error)
+            image_hash = images[row][1]
+
+            if caption is not None and image_hash:
+                cache.set((image_hash, model), caption)
+
+    return results
+
+
+def load_in_batcher(model=None):
+    """Loads `model` where the batcher captions, returning the models loaded
+    there. With worker processes that is the worker taking the request."""
+
+    loaded, error = batcher.submit((model, None))
+
+    if error:
+        raise RuntimeError(error)
+
+    return loaded
+
+
+def parse_model(data):
+    """Returns the requested model, or the one the `blip` and `onnx` flags of
+    older clients select."""
+
+    model = data.get("model") or model_name(data.get("blip"), data.get("onnx"))
+
+    if model not in MODELS:
+        raise ValueError("unknown captioning model {}".format(model))
+
+    return model
+
+
 @app.route("/generate-caption", methods=["POST"])
 def generate_caption():
     global last_request_time
@@ -25,47 +172,134 @@ def generate_caption():
     try:
         data = request.get_json()
         image_path = data["image_path"]
-        onnx = data["onnx"]
-        blip = data["blip"]
+        model = parse_model(data)
+    except Exception as e:
+        print(str(e))
+        return "", 400
+
+    try:
+        [(caption, error)] = caption_with_cache(
+            [(image_path, data.get("image_hash"))], model, data.get("refresh", False)
+        )
+    except QueueFull as e:
+        return busy(e)
+
+    if error:
+        log(f"could not caption {image_path}: {error}")
+        return {"error": error}, 500
+
+    return {"caption": caption}, 201
+
+
+@app.route("/generate-captions-batch", methods=["POST"])
+def generate_captions_batch():
+    """Captions many images with one model. Images are given as
+    {"image_path", "image_hash"} objects, the hash keys the result cache."""
+
+    global last_request_time
+    # Update last request time
+    last_request_time = time.time()
+
+    try:
+        data = request.get_json()
+        images = [
+            (image["image_path"], image.get("image_hash")) for image in data["images"]
+        ]
+        model = parse_model(data)
     except Exception as e:
         print(str(e))
         return "", 400
 
-    global im2txt_instance
+    try:
+        results = caption_with_cache(images, model, data.get("refresh", False))
+    except QueueFull as e:
+        return busy(e)
+
+    captions = {}
+    errors = {}
+
+    for (image_path, _), (caption, error) in zip(images, results):
+        if error:
+            errors[image_path] = error
+        else:
+            captions[image_path] = caption
 
-    if im2txt_instance is None:
-        im2txt_instance = Im2txt(blip=blip)
+    log(f"captioned {len(captions)} images with {model}, {len(errors)} failed")
+    return {"captions": captions, "errors": errors}, 201
 
-    return {
-        "caption": im2txt_instance.generate_caption(image_path=image_path, onnx=onnx)
-    }, 201
+
+@app.route("/models", methods=["GET"])
+def list_models():
+    """Lists the models, and the loaded ones. With worker processes these are
+    the models of the worker answering, as each holds its own."""
+
+    if not batcher.workers:
+        return {"models": list(MODELS), "loaded": registry.loaded()}, 200
+
+    try:
+        loaded = load_in_batcher()
+    except QueueFull as e:
+        return busy(e)
+
+    return {"models": list(MODELS), "loaded": loaded}, 200
+
+
+@app.route("/models/load", methods=["POST"])
+def load_model():
+    """Loads a model ahead of requests, unloading the least recently used ones
+    beyond CAPTIONING_MAX_LOADED_MODELS."""
+
+    try:
+        model = parse_model(request.get_json())
+    except Exception as e:
+        print(str(e))
+        return "", 400
+
+    try:
+        loaded = load_in_batcher(model)
+    except QueueFull as e:
+        return busy(e)
+
+    return {"loaded": loaded}, 200
 
 
 @app.route("/unload-model", methods=["GET"])
 def unload_model():
-    global im2txt_instance
-    im2txt_instance.unload_models()
-    im2txt_instance = None
+    """Unloads the model named in the body, or every model. Worker processes
+    are replaced instead, which unloads all of their models."""
+
+    data = request.get_json(silent=True) or {}
+
+    if batcher.workers:
+        batcher.restart_workers()
+    else:
+        in_thread(registry.unload, data.get("model"))
+
     return "", 200
 
 
 @app.route("/export-onnx", methods=["GET"])
 def export_onnx():
-    global im2txt_instance
-    if im2txt_instance is None:
-        im2txt_instance = Im2txt()
     data = request.get_json()
     encoder_path = data["encoder_path"]
     decoder_path = data["decoder_path"]
-    im2txt_instance.export_onnx(
-        encoder_output_path=encoder_path, decoder_output_path=decoder_path
-    )
+    im2txt = in_thread(registry.get, IM2TXT)
+    in_thread(im2txt.export_onnx, encoder_path, decoder_path)
+    # The exported model is loaded again with the next request, in this
+    # process and in new worker processes.
+    in_thread(registry.unload, IM2TXT_ONNX)
+
+    if batcher.workers:
+        # Exporting loaded the model here, the workers caption with their own.
+        in_thread(registry.unload, IM2TXT)
+        batcher.restart_workers()
+
     return "", 200
 
 
 @app.route("/health", methods=["GET"])
 def health():
-    return {"last_request_time": last_request_time}, 200
+    return {"last_request_time": last_request_time, "batching": batcher.stats()}, 200
 
 
 if __name__ == "__main__":
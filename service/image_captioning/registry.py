@@ -0,0 +1,84 @@
+"""Registry of the captioning models held by the service.
+
+Models are loaded on first use, or explicitly, and the least recently used one
+is unloaded once more than `MAX_LOADED` would be held. Every process has its
+own registry, so with CAPTIONING_WORKERS set each worker holds its models.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from api.im2txt.sample import Im2txt
+
+IM2TXT = "im2txt"
+IM2TXT_ONNX = "im2txt_onnx"
+BLIP = "blip_base_capfilt_large"
+
+# Named like the captioning model setting of the backend.
+MODELS = {
+    IM2TXT: {"blip": False, "onnx": False},
+    IM2TXT_ONNX: {"blip": False, "onnx": True},
+    BLIP: {"blip": True, "onnx": False},
+}
+
+MAX_LOADED = int(os.environ.get("CAPTIONING_MAX_LOADED_MODELS", 1))
+
+
+def model_name(blip=False, onnx=False):
+    """Returns the model selected by the `blip` and `onnx` flags of requests
+    that do not name one."""
+
+    if blip:
+        return BLIP
+
+    return IM2TXT_ONNX if onnx else IM2TXT
+
+
+class ModelRegistry:
+    def __init__(self, max_loaded=MAX_LOADED):
+        self.max_loaded = max(1, max_loaded)
+        self.models = OrderedDict()
+        # Held while a model is loaded or captioning, so it is not unloaded
+        # while in use. Callers on the gevent loop use a native thread.
+        self.lock = threading.RLock()
+
+    def get(self, name):
+        """Returns the model `name`, loading it first if needed."""
+
+        if name not in MODELS:
+            raise KeyError("unknown captioning model {}".format(name))
+
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+
+            while len(self.models) >= self.max_loaded:
+                self.models.popitem(last=False)[1].unload_models()
+
+            model = Im2txt(blip=MODELS[name]["blip"])
+            model.load_models(onnx=MODELS[name]["onnx"])
+            self.models[name] = model
+
+            return model
+
+    def caption(self, name, image_paths):
+        """Captions a batch of images with the model `name`."""
+
+        with self.lock:
+            return self.get(name).generate_captions(
+                image_paths, onnx=MODELS[name]["onnx"]
+            )
+
+    def unload(self, name=None):
+        """Unloads the model `name`, or every model."""
+
+        with self.lock:
+            for loaded in list(self.models) if name is None else [name]:
+                if loaded in self.models:
+                    self.models.pop(loaded).unload_models()
+
+    def loaded(self):
+        # Read without the lock, which a batch in progress may hold.
+        return list(self.models)
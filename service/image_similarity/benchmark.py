@@ -0,0 +1,127 @@
+"""Compares recall and latency of the similarity index types on synthetic
+embeddings.
+
+Run from the service directory, for example:
+
+    python benchmark.py --photos 1000000 --types hnsw ivfpq
+"""
+
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from retrieval_index import (  # pylint: disable=import-error
+    EMBEDDING_SIZE,
+    FLAT,
+    HNSW,
+    INDEX_TYPES,
+    IVF_PQ,
+    create_index,
+    set_search_parameters,
+)
+
+# Photos are drawn around this many scene centres, so that neighbourhoods are
+# denser than for uniformly random vectors, like image embeddings.
+SCENES = 1000
+SCENE_SPREAD = 0.5
+
+
+def generate(photos, queries, seed):
+    """Returns unit length photo and query embeddings."""
+
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(SCENES, EMBEDDING_SIZE)).astype(np.float32)
+    embeddings = np.empty((photos + queries, EMBEDDING_SIZE), dtype=np.float32)
+
+    # Generated in chunks to bound the float64 temporaries.
+    for start in range(0, len(embeddings), 100000):
+        end = min(start + 100000, len(embeddings))
+        scenes = rng.integers(0, SCENES, end - start)
+        embeddings[start:end] = centres[scenes] + SCENE_SPREAD * rng.normal(
+            size=(end - start, EMBEDDING_SIZE)
+        )
+
+    faiss.normalize_L2(embeddings)
+
+    return embeddings[:photos], embeddings[photos:]
+
+
+def search_all(index, queries, k):
+    """Searches one query at a time, like the service does, and returns the
+    results and the mean latency in milliseconds."""
+
+    results = np.empty((len(queries), k), dtype=np.int64)
+    start = time.perf_counter()
+
+    for i, query in enumerate(queries):
+        _, results[i] = index.search(query[None, :], k)
+
+    return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def recall(results, truth):
+    """Returns the fraction of the true neighbours that were found."""
+
+    found = sum(
+        len(np.intersect1d(row, true_row)) for row, true_row in zip(results, truth)
+    )
+
+    return found / truth.size
+
+
+def main():
+    """Builds every index type and reports build time, size, recall and latency."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--photos", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=100)
+    parser.add_argument(
+        "--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES
+    )
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    embeddings, queries = generate(args.photos, args.queries, args.seed)
+    ids = np.arange(len(embeddings), dtype=np.int64)
+    print(f"{len(embeddings)} photos, {len(queries)} queries, k={args.k}")
+
+    exact = create_index(FLAT, embeddings, ids)
+    truth, _ = search_all(exact, queries, args.k)
+    del exact
+
+    for index_type in args.types:
+        start = time.perf_counter()
+        index = create_index(index_type, embeddings, ids, seed=args.seed)
+        build_time = time.perf_counter() - start
+        size = faiss.serialize_index(index).nbytes / 2**20
+        print(f"{index_type:>6}: built in {build_time:.1f}s, {size:.1f} MiB")
+
+        if index_type == IVF_PQ:
+            settings = [("nprobe", value, {"nprobe": value}) for value in args.nprobe]
+        elif index_type == HNSW:
+            settings = [
+                ("efSearch", value, {"ef_search": value}) for value in args.ef_search
+            ]
+        else:
+            settings = [("exact", "", {})]
+
+        for name, value, parameters in settings:
+            set_search_parameters(index, **parameters)
+            results, latency = search_all(index, queries, args.k)
+            print(
+                f"{'':>8}{name} {value:<5} recall@{args.k} "
+                f"{recall(results, truth):.3f}, {latency:.2f} ms/query"
+            )
+
+        del index
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,163 @@
-"""Main image similarity service functions."""
+"""Main image similarity service functions.
 
+The service is the only owner of the similarity indices. Django workers talk to
+it through the client in `api.image_similarity`, so every index is held in
+memory once, however many workers there are.
+
+Embeddings are exchanged as base64 encoded float32 arrays, see `decode_array`,
+instead of nested JSON lists of floats.
+"""
+
+import base64
 import json
+import os
+import resource
+import time
 from urllib.error import URLError
 
+import numpy as np
+import psutil
 from flask import Flask, jsonify, request
 from flask_restful import Api, Resource
 from gevent.pywsgi import WSGIServer
 
-from retrieval_index import RetrievalIndex  # pylint: disable=import-error
+from retrieval_index import (  # pylint: disable=import-error
+    APPROXIMATE_THRESHOLD,
+    HNSW_EF_SEARCH,
+    IVF_NPROBE,
+    IVF_PQ,
+    RetrievalIndex,
+)
 from utils import logger  # pylint: disable=import-error
 
 app = Flask(__name__)
 api = Api(app)
 
-index = RetrievalIndex()
+INDEX_ROOT = os.environ.get(
+    "SIMILARITY_INDEX_ROOT",
+    os.path.join(
+        os.environ.get("BASE_DATA", "/"), "protected_media", "embeddings", "similarity"
+    ),
+)
+
+index = RetrievalIndex(
+    INDEX_ROOT,
+    index_type=os.environ.get("SIMILARITY_INDEX_TYPE", IVF_PQ),
+    approximate_threshold=int(
+        os.environ.get("SIMILARITY_APPROXIMATE_THRESHOLD", APPROXIMATE_THRESHOLD)
+    ),
+    nprobe=int(os.environ.get("SIMILARITY_NPROBE", IVF_NPROBE)),
+    ef_search=int(os.environ.get("SIMILARITY_EF_SEARCH", HNSW_EF_SEARCH)),
+)
+
+started_at = time.time()
+last_request_time = None
+request_counts = {}
+
+
+def decode_array(payload):
+    """Unpacks a base64 encoded array. Plain lists are still accepted."""
+
+    if not isinstance(payload, dict):
+        return np.asarray(payload, dtype=np.float32)
+
+    data = base64.b64decode(payload["data"])
+
+    return np.frombuffer(data, dtype=np.dtype(payload["dtype"])).reshape(
+        payload["shape"]
+    )
+
+
+def parse_threshold(request_body):
+    """Returns the cosine similarity threshold of a search. A missing or null
+    threshold disables it, which is what ranking queries want."""
+
+    threshold = request_body.get("threshold", 0.27)
+
+    return float("-inf") if threshold is None else float(threshold)
+
+
+@app.before_request
+def count_request():
+    global last_request_time
+    # Update last request time
+    last_request_time = time.time()
+    request_counts[request.path] = request_counts.get(request.path, 0) + 1
 
 
 class BuildIndex(Resource):
     """Builds the image similarity index for a specific user."""
 
     def post(self):
-        """Receives the image hashes and embeddings for a specific user and builds the index."""
+        """Receives the image hashes and embeddings for a specific user and adds
+        them to the index. With `persist` false the index is only stored by a
+        later call to /save/, so large builds can be sent in batches."""
 
         request_body = json.loads(request.data)
 
         user_id = request_body["user_id"]
         image_hashes = request_body["image_hashes"]
-        image_embeddings = request_body["image_embeddings"]
-
-        index.build_index_for_user(user_id, image_hashes, image_embeddings)
-
-        return jsonify({"status": True, "index_size": index.indices[user_id].ntotal})
+        image_embeddings = decode_array(request_body["image_embeddings"])
+
+        index.build_index_for_user(
+            user_id,
+            image_hashes,
+            image_embeddings,
+            persist=request_body.get("persist", True),
+        )
+
+        return jsonify(
+            {
+                "status": True,
+                "index_size": index.indices[user_id].ntotal,
+                "index": index.index_info(user_id),
+            }
+        )
 
     def delete(self):
         """Deletes the index for a specific user."""
 
         user_id = json.loads(request.data)["user_id"]
-        if user_id not in index.indices:
-            return jsonify({"status": True})
-        del index.indices[user_id]
-        del index.image_hashes[user_id]
+        index.delete_index(user_id)
         return jsonify({"status": True})
 
 
+class SaveIndex(Resource):
+    """Stores the index of a specific user after batched builds."""
+
+    def post(self):
+        user_id = json.loads(request.data)["user_id"]
+        index.save(user_id)
+
+        return jsonify({"status": True, "index": index.index_info(user_id)})
+
+
+class IndexInfo(Resource):
+    """Returns the version, build time and size of the index of a user."""
+
+    def post(self):
+        user_id = json.loads(request.data)["user_id"]
+
+        return jsonify({"status": True, "index": index.index_info(user_id)})
+
+
+class RemoveFromIndex(Resource):
+    """Removes photos from the image similarity index of a specific user."""
+
+    def post(self):
+        """Receives the image hashes to remove for a specific user."""
+
+        request_body = json.loads(request.data)
+
+        removed = index.remove_from_index(
+            request_body["user_id"],
+            request_body["image_hashes"],
+            persist=request_body.get("persist", True),
+        )
+
+        return jsonify({"status": True, "removed": removed})
+
+
 class SearchIndex(Resource):
     """Searches the image similarity index for a specific user."""
 
@@ -53,16 +168,9 @@ class SearchIndex(Resource):
             request_body = json.loads(request.data)
 
             user_id = request_body["user_id"]
-            image_embedding = request_body["image_embedding"]
-            if "n" in request_body.keys():
-                n = int(request_body["n"])
-            else:
-                n = 100
-
-            if "threshold" in request_body.keys():
-                thres = float(request_body["threshold"])
-            else:
-                thres = 27.0
+            image_embedding = decode_array(request_body["image_embedding"])
+            n = int(request_body.get("n", 100))
+            thres = parse_threshold(request_body)
 
             res = index.search_similar(user_id, image_embedding, n, thres)
 
@@ -72,18 +180,85 @@ class SearchIndex(Resource):
             return jsonify({"status": False, "result": []}), 500
 
 
+class SearchIndexBatch(Resource):
+    """Searches the image similarity index of a specific user for many
+    embeddings at once."""
+
+    def post(self):
+        """Receives the image embeddings for a specific user and searches the index
+        with a single call."""
+
+        request_body = json.loads(request.data)
+
+        results = index.search_similar_batch(
+            request_body["user_id"],
+            decode_array(request_body["image_embeddings"]),
+            int(request_body.get("n", 100)),
+            parse_threshold(request_body),
+        )
+
+        return jsonify({"status": True, "results": results})
+
+
+def process_memory():
+    """Returns the resident and peak memory of the service in bytes."""
+
+    return {
+        "rss": psutil.Process().memory_info().rss,
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
 class Health(Resource):
     """Services health check."""
 
     def get(self):
-        """Returns the health of the service."""
+        """Returns the health of the service, with the number of loaded indices
+        and photos and the memory in use.
 
-        return jsonify({"status": True})
+        Unlike the model services it reports no last request time, so it is not
+        restarted when idle and keeps its indices loaded.
+        """
+
+        stats = index.stats()
+
+        return jsonify(
+            {
+                "status": True,
+                "indices": len(stats),
+                "photos": sum(user["count"] for user in stats.values()),
+                "memory": process_memory()["rss"],
+            }
+        )
+
+
+class Metrics(Resource):
+    """Reports the size and estimated memory of every loaded index."""
+
+    def get(self):
+        stats = index.stats()
+
+        return jsonify(
+            {
+                "uptime": time.time() - started_at,
+                "last_request_time": last_request_time,
+                "requests": request_counts,
+                "memory": process_memory(),
+                "index_memory": sum(user["memory"] for user in stats.values()),
+                "indices": {str(user_id): user for user_id, user in stats.items()},
+            }
+        )
 
 
 api.add_resource(BuildIndex, "/build/")
+api.add_resource(SaveIndex, "/save/")
+api.add_resource(IndexInfo, "/info/")
+api.add_resource(RemoveFromIndex, "/remove/")
 api.add_resource(SearchIndex, "/search/")
+api.add_resource(SearchIndexBatch, "/search-batch/")
 api.add_resource(Health, "/health/")
+api.add_resource(Metrics, "/metrics/")
 
 
 def start_server():
@@ -1,29 +1,472 @@
-"""Builds an index for image retrieval."""
+"""Builds an index for image retrieval.
+
+The index of every user is stored below `<root>/<user id>/` as a FAISS index file,
+the image hashes of its rows and a small json header with a version and the time
+of the last full build. Indices are loaded lazily on first use, and reloaded when
+another process has stored a newer version.
+
+Rows carry integer ids that are never reused, mapped to image hashes, so single
+photos can be removed without rebuilding the index.
+
+Embeddings and queries are scaled to unit length, so inner products and search
+thresholds are cosine similarities.
+
+Small libraries use an exact flat index. Once a library reaches
+`approximate_threshold` photos its index is converted to an approximate one,
+HNSW or IVF-PQ, which keeps queries fast and, for IVF-PQ, memory bounded.
+"""
 
 import datetime
+import json
+import os
+import time
 
 import faiss
 import numpy as np
+from filelock import FileLock
 
 from utils import logger  # pylint: disable=import-error
 
 EMBEDDING_SIZE = 512
+INDEX_FORMAT = 3
+
+FLAT = "flat"
+HNSW = "hnsw"
+IVF_PQ = "ivfpq"
+INDEX_TYPES = (FLAT, HNSW, IVF_PQ)
+
+APPROXIMATE_THRESHOLD = 100000
+
+HNSW_NEIGHBORS = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+
+# Inverted lists per square root of the library size, and training points per
+# list. Every vector is compressed to PQ_SUBQUANTIZERS bytes.
+IVF_LISTS_PER_SQRT = 4
+IVF_TRAIN_POINTS_PER_LIST = 64
+# Fewer training points per list than this make k-means unreliable.
+IVF_MIN_POINTS_PER_LIST = 39
+IVF_NPROBE = 16
+PQ_SUBQUANTIZERS = 64
+PQ_BITS = 8
+
+# Fraction of removed rows after which an index that cannot remove rows, like
+# HNSW, is rebuilt.
+COMPACT_RATIO = 0.1
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def index_type_of(index) -> str:
+    """Returns the type of an index created by `create_index`."""
+
+    if isinstance(index, faiss.IndexIVF):
+        return IVF_PQ
+
+    if isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW):
+        return HNSW
+
+    return FLAT
+
+
+def normalize(embeddings) -> np.ndarray:
+    """Returns a float32 copy of the embeddings, scaled to unit length."""
+
+    embeddings = np.array(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_SIZE)
+    faiss.normalize_L2(embeddings)
+
+    return embeddings
+
+
+def _ivf_lists(count) -> int:
+    lists = max(1, int(IVF_LISTS_PER_SQRT * np.sqrt(count)))
+
+    return min(lists, count // IVF_TRAIN_POINTS_PER_LIST or 1)
+
+
+def can_train_ivf_pq(count) -> bool:
+    """Returns whether `count` embeddings are enough to train an IVF-PQ index.
+    The product quantizer needs at least one point per centroid."""
+
+    return count >= max(2**PQ_BITS, _ivf_lists(count) * IVF_MIN_POINTS_PER_LIST)
+
+
+def create_index(index_type, embeddings: np.ndarray, ids: np.ndarray, seed=0):
+    """Creates an inner product index of the given type holding the embeddings
+    under the given ids.
+
+    Flat and HNSW indices are wrapped in an id map. IVF-PQ indices store the ids
+    themselves, which also keeps removals consistent, and are trained on a sample
+    of the embeddings. Too few embeddings to train one get an HNSW index instead.
+    """
+
+    if index_type == IVF_PQ and not can_train_ivf_pq(len(embeddings)):
+        logger.info(
+            "%d photos are too few to train an IVF-PQ index, using HNSW",
+            len(embeddings),
+        )
+        index_type = HNSW
+
+    if index_type == IVF_PQ:
+        lists = _ivf_lists(len(embeddings))
+        index = faiss.IndexIVFPQ(
+            faiss.IndexFlatIP(EMBEDDING_SIZE),
+            EMBEDDING_SIZE,
+            lists,
+            PQ_SUBQUANTIZERS,
+            PQ_BITS,
+            faiss.METRIC_INNER_PRODUCT,
+        )
+        # The product quantizer needs enough points for its 2**PQ_BITS centroids.
+        sample_size = min(
+            len(embeddings),
+            IVF_TRAIN_POINTS_PER_LIST * max(lists, 2**PQ_BITS),
+        )
+        sample = np.random.default_rng(seed).choice(
+            len(embeddings), sample_size, replace=False
+        )
+        index.train(embeddings[np.sort(sample)])
+
+    elif index_type == HNSW:
+        inner = faiss.IndexHNSWFlat(
+            EMBEDDING_SIZE, HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT
+        )
+        inner.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index = faiss.IndexIDMap2(inner)
+
+    else:
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(EMBEDDING_SIZE))
+
+    if len(embeddings):
+        index.add_with_ids(embeddings, ids)
+
+    return index
+
+
+def set_search_parameters(index, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH):
+    """Sets how many inverted lists or graph nodes a search visits."""
+
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = nprobe
+
+    elif index_type_of(index) == HNSW:
+        faiss.downcast_index(index.index).hnsw.efSearch = ef_search
+
+
+def index_memory(index) -> int:
+    """Estimates the bytes held by an index created by `create_index`."""
+
+    if index_type_of(index) == IVF_PQ:
+        # Codes and ids of the rows, coarse centroids and product quantizer.
+        return (
+            index.ntotal * (index.code_size + 8)
+            + index.nlist * index.d * 4
+            + 2**PQ_BITS * index.d * 4
+        )
+
+    # Vectors and both directions of the id map.
+    memory = index.ntotal * (index.d * 4 + 2 * 8)
+
+    if index_type_of(index) == HNSW:
+        # Nodes keep 2 * M links on the base layer.
+        memory += index.ntotal * 2 * HNSW_NEIGHBORS * 4
+
+    return memory
+
+
+def _stored_vectors(index) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the ids and the vectors of a flat or HNSW index."""
+
+    ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+
+    if index.ntotal == 0:
+        return ids, np.empty((0, EMBEDDING_SIZE), dtype=np.float32)
+
+    return ids, index.index.reconstruct_n(0, index.ntotal)
 
 
 class RetrievalIndex(object):
     """Retrieval index class."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        root,
+        index_type=IVF_PQ,
+        approximate_threshold=APPROXIMATE_THRESHOLD,
+        nprobe=IVF_NPROBE,
+        ef_search=HNSW_EF_SEARCH,
+    ):
+        """`index_type` is used for libraries of at least `approximate_threshold`
+        photos, smaller ones always use a flat index."""
+
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type}")
+
+        self.root = root
+        self.index_type = index_type
+        self.approximate_threshold = approximate_threshold
+        self.nprobe = nprobe
+        self.ef_search = ef_search
         self.indices = {}
+        # Per user, the image hash of every id and the id of every image hash.
         self.image_hashes = {}
+        self.ids = {}
+        self.headers = {}
+
+    def _path(self, user_id, name):
+        return os.path.join(self.root, str(user_id), name)
+
+    def _lock(self, user_id):
+        os.makedirs(os.path.join(self.root, str(user_id)), exist_ok=True)
+
+        return FileLock(self._path(user_id, ".lock"))
+
+    def _read_header(self, user_id):
+        try:
+            with open(self._path(user_id, "header.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
 
-    def build_index_for_user(self, user_id, image_hashes, image_embeddings):
+    def _replace(self, user_id, name, write):
+        tmp_path = self._path(user_id, name + ".tmp")
+        write(tmp_path)
+        os.replace(tmp_path, self._path(user_id, name))
+
+    def _load(self, user_id):
+        """Loads the stored index of a user, unless the loaded one is current."""
+
+        header = self._read_header(user_id)
+
+        if (
+            header is None
+            or header.get("dim") != EMBEDDING_SIZE
+            or header.get("format") != INDEX_FORMAT
+        ):
+            return
+
+        if self.headers.get(user_id, {}).get("version") == header["version"]:
+            return
+
+        index = faiss.read_index(self._path(user_id, "index.faiss"))
+
+        with open(self._path(user_id, "ids.json")) as f:
+            ids = json.load(f)
+
+        self.indices[user_id] = index
+        self.ids[user_id] = ids
+        self.image_hashes[user_id] = {
+            row_id: image_hash for image_hash, row_id in ids.items()
+        }
+        self.headers[user_id] = header
+        logger.info(
+            "loaded index of %s for user %d - %d photos",
+            header["updated_at"],
+            user_id,
+            index.ntotal,
+        )
+
+    def _rebuild(self, user_id, index_type):
+        ids, vectors = _stored_vectors(self.indices[user_id])
+        live = np.isin(ids, np.fromiter(self.image_hashes[user_id], dtype=np.int64))
+        start = datetime.datetime.now()
+        self.indices[user_id] = create_index(index_type, vectors[live], ids[live])
+        elapsed = (datetime.datetime.now() - start).total_seconds()
+        logger.info(
+            "rebuilt index for user %d as %s - %d photos - took %.2f seconds",
+            user_id,
+            index_type,
+            np.count_nonzero(live),
+            elapsed,
+        )
+
+    def _maintain(self, user_id):
+        """Converts the index of a library that grew past the threshold, and
+        compacts indices with many removed rows. An HNSW index standing in for an
+        IVF-PQ one that could not be trained is converted once it can be."""
+
+        index = self.indices[user_id]
+        index_type = index_type_of(index)
+        count = len(self.image_hashes[user_id])
+
+        if (
+            index_type == FLAT
+            and self.index_type != FLAT
+            and count >= self.approximate_threshold
+        ):
+            self._rebuild(user_id, self.index_type)
+
+        elif (
+            index_type == HNSW
+            and self.index_type == IVF_PQ
+            and count >= self.approximate_threshold
+            and can_train_ivf_pq(count)
+        ):
+            self._rebuild(user_id, IVF_PQ)
+
+        elif index_type == HNSW and index.ntotal - count > COMPACT_RATIO * index.ntotal:
+            self._rebuild(user_id, HNSW)
+
+    def _save(self, user_id):
+        self._maintain(user_id)
+        index = self.indices[user_id]
+        ids = self.ids[user_id]
+        header = {
+            # Versions only have to differ between writes, also across a
+            # delete and rebuild, so the write time is used.
+            "version": time.time_ns(),
+            "built_at": self.headers.get(user_id, {}).get("built_at") or _now(),
+            "updated_at": _now(),
+            "count": len(ids),
+            "type": index_type_of(index),
+            "next_id": self.headers[user_id]["next_id"],
+            "dim": EMBEDDING_SIZE,
+            "format": INDEX_FORMAT,
+        }
+
+        def write_ids(path):
+            with open(path, "w") as f:
+                json.dump(ids, f)
+
+        def write_header(path):
+            with open(path, "w") as f:
+                json.dump(header, f)
+
+        self._replace(
+            user_id, "index.faiss", lambda path: faiss.write_index(index, path)
+        )
+        self._replace(user_id, "ids.json", write_ids)
+        # The header is written last, so readers never see it ahead of the data.
+        self._replace(user_id, "header.json", write_header)
+        self.headers[user_id] = header
+
+    def _forget(self, user_id):
+        self.indices.pop(user_id, None)
+        self.image_hashes.pop(user_id, None)
+        self.ids.pop(user_id, None)
+        self.headers.pop(user_id, None)
+
+    def get_index(self, user_id):
+        """Returns the index of a user, loading it from disk if needed, or None if
+        the user has no index."""
+
+        header = self._read_header(user_id)
+        loaded_version = self.headers.get(user_id, {}).get("version")
+
+        if header is None and loaded_version is not None:
+            # Another process deleted the stored index.
+            self._forget(user_id)
+
+        elif header is not None and loaded_version != header.get("version"):
+            with self._lock(user_id):
+                self._load(user_id)
+
+        return self.indices.get(user_id)
+
+    def index_info(self, user_id):
+        """Returns the version, build time and size of the stored index of a user."""
+
+        return self._read_header(user_id)
+
+    def stats(self):
+        """Returns the photo count, type and estimated memory of every loaded
+        index."""
+
+        return {
+            user_id: {
+                "count": len(self.image_hashes[user_id]),
+                "rows": index.ntotal,
+                "type": index_type_of(index),
+                "memory": index_memory(index),
+                "version": self.headers[user_id].get("version"),
+            }
+            for user_id, index in self.indices.items()
+        }
+
+    def save(self, user_id):
+        """Stores the in-memory index of a user."""
+
+        if user_id not in self.indices:
+            return
+
+        with self._lock(user_id):
+            self._save(user_id)
+
+    def delete_index(self, user_id):
+        """Deletes the index of a user from memory and disk."""
+
+        self._forget(user_id)
+
+        with self._lock(user_id):
+            for name in ("header.json", "index.faiss", "ids.json"):
+                if os.path.exists(self._path(user_id, name)):
+                    os.remove(self._path(user_id, name))
+
+    def _remove_rows(self, user_id, image_hashes):
+        ids = self.ids[user_id]
+        removed = [
+            ids.pop(image_hash) for image_hash in image_hashes if image_hash in ids
+        ]
+
+        if not removed:
+            return 0
+
+        # HNSW graphs cannot remove nodes, their rows stay in the index without
+        # an image hash until it is compacted.
+        if index_type_of(self.indices[user_id]) != HNSW:
+            self.indices[user_id].remove_ids(np.asarray(removed, dtype=np.int64))
+
+        for row_id in removed:
+            del self.image_hashes[user_id][row_id]
+
+        return len(removed)
+
+    def _add_rows(self, user_id, image_hashes, image_embeddings):
+        embeddings = normalize(image_embeddings)
+
+        if len(embeddings) == 0:
+            return
+
+        if len(embeddings) != len(image_hashes):
+            raise ValueError(
+                f"Got {len(image_hashes)} image hashes for {len(embeddings)} embeddings"
+            )
+
+        # A photo that is added twice keeps its last embedding.
+        last_rows = {image_hash: row for row, image_hash in enumerate(image_hashes)}
+
+        if len(last_rows) < len(image_hashes):
+            image_hashes = list(last_rows)
+            embeddings = embeddings[list(last_rows.values())]
+
+        # Replace photos that are already in the index.
+        self._remove_rows(user_id, image_hashes)
+
+        next_id = self.headers[user_id]["next_id"]
+        row_ids = np.arange(next_id, next_id + len(embeddings), dtype=np.int64)
+        self.indices[user_id].add_with_ids(embeddings, row_ids)
+        self.headers[user_id]["next_id"] = next_id + len(embeddings)
+
+        for image_hash, row_id in zip(image_hashes, row_ids.tolist()):
+            self.ids[user_id][image_hash] = row_id
+            self.image_hashes[user_id][row_id] = image_hash
+
+    def build_index_for_user(
+        self, user_id, image_hashes, image_embeddings, persist=True
+    ):
         """
-        Builds an index for a specific user based on the provided image hashes and image embeddings.
+        Adds photos to the index of a user. Photos that are already in the index
+        are replaced.
         Parameters:
             user_id (int): The ID of the user for whom the index is built.
             image_hashes (list): List of image hashes for the user.
-            image_embeddings (list): List of image embeddings for the user.
+            image_embeddings (list | np.ndarray): Image embeddings for the user,
+                one row per image hash.
+            persist (bool): Store the index afterwards. Builds that add many
+                pages can store it once at the end with `save`.
         Returns:
             None
         """
@@ -34,36 +477,91 @@ class RetrievalIndex(object):
             len(image_hashes),
         )
         start = datetime.datetime.now()
-        if not self.indices.get(user_id):
-            self.indices[user_id] = faiss.IndexFlatIP(EMBEDDING_SIZE)
-        if not self.image_hashes.get(user_id):
-            self.image_hashes[user_id] = []
 
-        for h, e in zip(image_hashes, image_embeddings):
-            self.image_hashes[user_id].append(h)
-            self.indices[user_id].add(np.array([e], dtype=np.float32))
+        with self._lock(user_id):
+            self._load(user_id)
+
+            if user_id not in self.indices:
+                self.indices[user_id] = create_index(
+                    FLAT,
+                    np.empty((0, EMBEDDING_SIZE), dtype=np.float32),
+                    np.empty(0, dtype=np.int64),
+                )
+                self.image_hashes[user_id] = {}
+                self.ids[user_id] = {}
+                self.headers[user_id] = {"built_at": _now(), "next_id": 0}
+
+            self._add_rows(user_id, image_hashes, image_embeddings)
+
+            if persist:
+                self._save(user_id)
 
         elapsed = (datetime.datetime.now() - start).total_seconds()
         logger.info(
             "finished building index for user %d - took %.2f seconds", user_id, elapsed
         )
 
-    def search_similar(self, user_id, in_embedding, n=100, thres=27.0):
+    def remove_from_index(self, user_id, image_hashes, persist=True):
+        """Removes photos from the index of a user and returns how many were
+        removed."""
+
+        if self._read_header(user_id) is None and user_id not in self.indices:
+            return 0
+
+        with self._lock(user_id):
+            self._load(user_id)
+
+            if user_id not in self.indices:
+                return 0
+
+            removed = self._remove_rows(user_id, image_hashes)
+
+            if removed and persist:
+                self._save(user_id)
+
+        return removed
+
+    def search_similar(self, user_id, in_embedding, n=100, thres=0.27):
         """Searches for similar images."""
 
+        return self.search_similar_batch(user_id, [in_embedding], n, thres)[0]
+
+    def search_similar_batch(self, user_id, in_embeddings, n=100, thres=0.27):
+        """Searches for the images similar to each of many embeddings with a single
+        index search. Returns a list of image hashes per embedding, best first."""
+
         start = datetime.datetime.now()
-        dist, res_indices = self.indices[user_id].search(
-            np.array([in_embedding], dtype=np.float32), n
-        )
-        res = []
-        for distance, idx in sorted(zip(dist[0], res_indices[0]), reverse=True):
-            if distance >= thres:
-                res.append(self.image_hashes[user_id][idx])
+        queries = normalize(in_embeddings)
+        index = self.get_index(user_id)
+
+        if index is None or index.ntotal == 0 or len(queries) == 0:
+            return [[] for _ in range(len(queries))]
+
+        set_search_parameters(index, self.nprobe, self.ef_search)
+        # Removed rows of HNSW indices are still found, so more rows are asked for.
+        removed = index.ntotal - len(self.image_hashes[user_id])
+        dist, res_indices = index.search(queries, min(n + removed, index.ntotal))
+        results = []
+
+        for distances, row_ids in zip(dist, res_indices):
+            res = []
+
+            for distance, row_id in zip(distances, row_ids):
+                # Fewer than n rows pad the result with -1.
+                image_hash = self.image_hashes[user_id].get(int(row_id))
+
+                if image_hash is not None and distance >= thres:
+                    res.append(image_hash)
+
+            results.append(res[:n])
+
         elapsed = (datetime.datetime.now() - start).total_seconds()
         logger.info(
-            "searched for %d images for user %d - took %.2f seconds",
+            "searched for %d images for %d queries of user %d - took %.2f seconds",
             n,
+            len(queries),
             user_id,
             elapsed,
         )
-        return res
+
+        return results
@@ -0,0 +1,287 @@
+"""Dynamic micro-batching for the model services.
+
+The services answer one image per request, and under concurrent scanning those
+requests used to queue behind a single greenlet running the model. A
+`MicroBatcher` puts requests on a queue instead and collects them into batches
+of up to `max_batch_size` items, waiting at most `max_wait` seconds after the
+first one. Each batch runs on one of `workers` processes, or on a thread of
+the service itself with no workers, so the gevent loop keeps accepting
+requests meanwhile and throughput scales with the cores given to the service.
+
+When more than `max_queue_size` items are waiting, new requests are rejected
+with `QueueFull`, which the endpoints answer with 503 and a Retry-After header.
+
+Worker processes are stopped when the service exits or receives SIGTERM. The
+backend kills services with SIGKILL, which cannot be handled, so it kills their
+whole process group instead.
+
+The services are started as scripts, so they import this module after adding
+the `service` directory to `sys.path`.
+"""
+
+import atexit
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore
+from gevent.queue import Empty, Queue
+from gevent.threadpool import ThreadPool
+
+MAX_BATCH_SIZE = 16
+# Seconds to wait for more requests once the first one of a batch arrived.
+MAX_WAIT = 0.01
+MAX_QUEUE_SIZE = 1024
+# Seconds clients are asked to wait before retrying a rejected request.
+RETRY_AFTER = 1
+
+# Batchers that started worker processes, stopped on exit.
+_batchers = []
+
+
+class QueueFull(Exception):
+    """Raised when a batcher has more waiting items than it accepts."""
+
+
+class MicroBatcher:
+    """Runs `handler` on batches of the submitted items.
+
+    `handler` takes a list of items and returns one result per item, in order.
+    With worker processes it is called in those processes, so it has to be a
+    module level function that loads its model on first use. Handlers should
+    report errors of single items in their results; an exception fails every
+    item of the batch.
+    """
+
+    def __init__(
+        self,
+        name,
+        handler,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait=MAX_WAIT,
+        max_queue_size=MAX_QUEUE_SIZE,
+        workers=0,
+    ):
+        self.name = name
+        self.handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self.max_queue_size = max_queue_size
+        self.workers = max(0, workers)
+
+        self.queue = Queue()
+        # One batch runs per worker, the batch after that is collected while
+        # they are busy, so it grows with the load.
+        self.slots = BoundedSemaphore(max(1, self.workers))
+        self.threads = ThreadPool(max(1, self.workers))
+        self.process_pool = None
+        self.collector = None
+
+        self.batches = 0
+        self.items = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+    @classmethod
+    def from_env(
+        cls,
+        name,
+        handler,
+        prefix,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait=MAX_WAIT,
+        max_queue_size=MAX_QUEUE_SIZE,
+        workers=0,
+    ):
+        """Creates a batcher configured by `<prefix>_MAX_BATCH_SIZE`,
+        `<prefix>_MAX_WAIT_MS`, `<prefix>_MAX_QUEUE_SIZE` and `<prefix>_WORKERS`,
+        falling back to the given values."""
+
+        env = os.environ
+
+        return cls(
+            name,
+            handler,
+            max_batch_size=int(env.get(prefix + "_MAX_BATCH_SIZE", max_batch_size)),
+            max_wait=float(env.get(prefix + "_MAX_WAIT_MS", max_wait * 1000)) / 1000,
+            max_queue_size=int(env.get(prefix + "_MAX_QUEUE_SIZE", max_queue_size)),
+            workers=int(env.get(prefix + "_WORKERS", workers)),
+        )
+
+    def submit(self, item):
+        """Waits for the result of a single item."""
+
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items):
+        """Queues all items at once and waits for their results. They are batched
+        together with the items of concurrent requests."""
+
+        items = list(items)
+        queued = self.queue.qsize()
+
+        # An idle batcher takes any request, however large.
+        if queued and queued + len(items) > self.max_queue_size:
+            self.rejected += len(items)
+            raise QueueFull("{} has {} queued items".format(self.name, queued))
+
+        if self.collector is None or self.collector.dead:
+            self.collector = gevent.spawn(self._collect)
+
+        results = []
+
+        for item in items:
+            result = AsyncResult()
+            self.queue.put((item, result))
+            results.append(result)
+
+        return [result.get() for result in results]
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "in_flight": self.in_flight,
+            "batches": self.batches,
+            "items": self.items,
+            "rejected": self.rejected,
+            "workers": self.workers,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "max_queue_size": self.max_queue_size,
+        }
+
+    def _collect(self):
+        while True:
+            self.slots.acquire()
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(
+                        self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    )
+                except Empty:
+                    break
+
+            gevent.spawn(self._process, batch)
+
+    def shutdown(self):
+        """Stops the worker processes, cancelling the batches still waiting for
+        one. Batches in progress are not waited for."""
+
+        pool, self.process_pool = self.process_pool, None
+
+        if pool is None:
+            return
+
+        # The executor only stops idle workers, busy ones are killed.
+        processes = list(
+            (pool._processes or {}).values()  # pylint: disable=protected-access
+        )
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        for process in processes:
+            process.kill()
+
+    def restart_workers(self):
+        """Replaces the worker processes, so that handlers load their models
+        again, e.g. after a model was exported. Batches already submitted finish
+        on the old workers."""
+
+        pool, self.process_pool = self.process_pool, None
+
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def _process(self, batch):
+        items = [item for item, _ in batch]
+        self.in_flight += len(items)
+
+        try:
+            if self.workers:
+                # Submitted on the loop, so the pool is not replaced in between.
+                pool = self._get_process_pool()
+                outputs = self.threads.spawn(
+                    self._wait, pool, self._submit(pool, items)
+                ).get()
+            else:
+                outputs = self.threads.spawn(self.handler, items).get()
+
+            if len(outputs) != len(items):
+                raise ValueError(
+                    "{} returned {} results for {} items".format(
+                        self.name, len(outputs), len(items)
+                    )
+                )
+        except Exception as e:  # pylint: disable=broad-except
+            for _, result in batch:
+                result.set_exception(e)
+        else:
+            for (_, result), output in zip(batch, outputs):
+                result.set(output)
+        finally:
+            self.in_flight -= len(items)
+            self.batches += 1
+            self.items += len(items)
+            self.slots.release()
+
+    def _get_process_pool(self):
+        if self.process_pool is None:
+            # Spawned rather than forked, the parent already runs threads.
+            self.process_pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+            if not _batchers:
+                atexit.register(_shutdown_batchers)
+                gevent.signal_handler(signal.SIGTERM, _terminate, signal.SIGTERM)
+
+            if self not in _batchers:
+                _batchers.append(self)
+
+        return self.process_pool
+
+    def _forget_broken_pool(self, pool):
+        # A worker died, e.g. out of memory. The next batch starts new ones.
+        if self.process_pool is pool:
+            self.process_pool = None
+
+    def _submit(self, pool, items):
+        try:
+            return pool.submit(self.handler, items)
+        except BrokenProcessPool:
+            self._forget_broken_pool(pool)
+            raise
+
+    def _wait(self, pool, future):
+        # Runs on a native thread, so waiting here does not block the loop.
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self._forget_broken_pool(pool)
+            raise
+
+
+def _shutdown_batchers():
+    for batcher in _batchers:
+        batcher.shutdown()
+
+
+def _terminate(signum):
+    # Stops the workers, then exits the way the signal would have.
+    _shutdown_batchers()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def busy(error):
+    """Returns the 503 response to a request rejected with `QueueFull`."""
+
+    return {"error": str(error)}, 503, {"Retry-After": str(RETRY_AFTER)}
@@ -1,20 +1,103 @@
+import os
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import gevent
+import PIL
 from flask import Flask, request
 from gevent.pywsgi import WSGIServer
-from places365.places365 import Places365
+from places365.places365 import BATCH_SIZE, Places365
+
+# The services are started as scripts, the shared modules are one level up.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_server import (  # noqa: E402 pylint: disable=import-error
+    MicroBatcher,
+    QueueFull,
+    busy,
+)
 
 app = Flask(__name__)
 
 places365_instance = None
 last_request_time = None
 
+# Threads decoding and resizing images while the model runs.
+LOADERS = int(os.environ.get("TAGS_LOADERS", 4))
+# The model looks at 224x224 pixels, so larger images are decoded at a reduced size.
+DRAFT_SIZE = (448, 448)
+
+loader_pool = None
+
 
 def log(message):
     print("tags: {}".format(message))
 
 
+def get_places365():
+    global places365_instance
+
+    if places365_instance is None:
+        places365_instance = Places365()
+
+    if not places365_instance.labels_and_model_are_load:
+        places365_instance.load()
+
+    return places365_instance
+
+
+def get_loader_pool():
+    global loader_pool
+
+    if loader_pool is None:
+        loader_pool = ThreadPoolExecutor(max_workers=LOADERS)
+
+    return loader_pool
+
+
+def load_image(source):
+    try:
+        image = PIL.Image.open(source)
+        image.draft("RGB", DRAFT_SIZE)
+
+        return source, get_places365().preprocess(image), None
+    except Exception as e:
+        return source, None, str(e)
+
+
+def tag_images(items):
+    """Tags a batch of (image path, confidence) items, returning a (tags, error)
+    pair per item. Images are decoded and resized concurrently and run through
+    the model together."""
+
+    results = [None] * len(items)
+    loaded = []
+
+    for row, (source, tensor, error) in enumerate(
+        get_loader_pool().map(load_image, [path for path, _ in items])
+    ):
+        if error:
+            results[row] = (None, error)
+        else:
+            loaded.append((row, tensor))
+
+    if loaded:
+        tags = get_places365().inference_places365_batch(
+            [tensor for _, tensor in loaded], [items[row][1] for row, _ in loaded]
+        )
+
+        for (row, _), result in zip(loaded, tags):
+            results[row] = (result, None)
+
+    return results
+
+
+# Requests of concurrent clients are tagged together, configured with
+# TAGS_MAX_BATCH_SIZE, TAGS_MAX_WAIT_MS, TAGS_MAX_QUEUE_SIZE and TAGS_WORKERS.
+batcher = MicroBatcher.from_env("tags", tag_images, "TAGS", max_batch_size=BATCH_SIZE)
+
+
 @app.route("/generate-tags", methods=["POST"])
 def generate_tags():
     global last_request_time
@@ -29,16 +112,76 @@ def generate_tags():
         print(str(e))
         return "", 400
 
+    try:
+        tags, error = batcher.submit((image_path, confidence))
+    except QueueFull as e:
+        return busy(e)
+
+    if error:
+        log(f"could not tag {image_path}: {error}")
+        return {"error": error}, 500
+
+    return {"tags": tags}, 201
+
+
+@app.route("/generate-tags-batch", methods=["POST"])
+def generate_tags_batch():
+    """Tags many images, batched together with the requests of other clients."""
+
+    global last_request_time
+    # Update last request time
+    last_request_time = time.time()
+
+    try:
+        data = request.get_json()
+        image_paths = list(data["image_paths"])
+        confidence = data["confidence"]
+    except Exception as e:
+        print(str(e))
+        return "", 400
+
+    try:
+        results = batcher.submit_many((path, confidence) for path in image_paths)
+    except QueueFull as e:
+        return busy(e)
+
+    tags = {}
+    errors = {}
+
+    for source, (result, error) in zip(image_paths, results):
+        if error:
+            errors[source] = error
+        else:
+            tags[source] = result
+
+    log(f"tagged {len(tags)} images, {len(errors)} failed")
+    return {"tags": tags, "errors": errors}, 201
+
+
+@app.route("/export-onnx", methods=["POST"])
+def export_onnx():
+    """Exports the model for the ONNX Runtime backends. Passing
+    `calibration_images` also writes the int8 model."""
+
     global places365_instance
 
-    if places365_instance is None:
-        places365_instance = Places365()
-    return {"tags": places365_instance.inference_places365(image_path, confidence)}, 201
+    data = request.get_json(silent=True) or {}
+    # Tracing and calibrating take minutes, so they run on a native thread
+    # while the loop keeps serving requests.
+    paths = gevent.get_hub().threadpool.apply(
+        lambda: get_places365().export_onnx(data.get("calibration_images", []))
+    )
+    # Loads the exported model with the next request if it is configured, in
+    # this process and in new worker processes.
+    places365_instance = None
+    batcher.restart_workers()
+
+    return {"paths": paths}, 200
 
 
 @app.route("/health", methods=["GET"])
 def health():
-    return {"last_request_time": last_request_time}, 200
+    return {"last_request_time": last_request_time, "batching": batcher.stats()}, 200
 
 
 if __name__ == "__main__":
@@ -4,19 +4,54 @@
 import os
 
 import numpy as np
-import places365.wideresnet as wideresnet
-import torch
 from PIL import Image
-from torch.autograd import Variable as V
-from torch.nn import functional as F
-from torchvision import transforms as trn
 
 # import warnings
 
-torch.nn.Module.dump_patches = True
 dir_places365_model = os.path.join(
     "/", "protected_media", "data_models", "places365", "model"
 )
+onnx_model_path = os.path.join(dir_places365_model, "wideresnet18_places365.onnx")
+onnx_int8_model_path = os.path.join(
+    dir_places365_model, "wideresnet18_places365_int8.onnx"
+)
+
+# Inference backends. The ONNX Runtime backends never import torch, which keeps
+# it out of the resident memory of the service. "onnx-int8" runs the statically
+# quantized model.
+TORCH = "torch"
+ONNX = "onnx"
+ONNX_INT8 = "onnx-int8"
+BACKENDS = (TORCH, ONNX, ONNX_INT8)
+BACKEND = os.environ.get("TAGS_BACKEND", TORCH)
+
+# Images per forward pass, and threads used by torch or ONNX Runtime (0 leaves
+# their default).
+BATCH_SIZE = int(os.environ.get("TAGS_BATCH_SIZE", 32))
+THREADS = int(os.environ.get("TAGS_THREADS", 0))
+
+INPUT_SIZE = (224, 224)
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)[:, None, None]
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)[:, None, None]
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class CalibrationImages:
+    """Feeds preprocessed images to the int8 quantization calibration, one batch
+    at a time."""
+
+    def __init__(self, batches):
+        self.batches = iter(batches)
+
+    def get_next(self):
+        batch = next(self.batches, None)
+
+        return None if batch is None else {"image": batch}
 
 
 class Places365:
@@ -24,27 +59,54 @@ class Places365:
 
     def unload(self):
         del self.model
+        del self.session
         del self.classes
         del self.W_attribute
         del self.labels_IO
         del self.labels_attribute
+        del self.weight_softmax
         del self.labels_and_model_are_load
         self.model = None
+        self.session = None
         self.classes = None
         self.W_attribute = None
         self.labels_IO = None
         self.labels_attribute = None
+        self.weight_softmax = None
         self.labels_and_model_are_load = False
 
-    def load(self):
-        self.load_model()
+    def load(self, backend=BACKEND):
+        self.model = None
+        self.session = None
+        self.backend = backend
+
+        if backend in (ONNX, ONNX_INT8):
+            path = onnx_int8_model_path if backend == ONNX_INT8 else onnx_model_path
+
+            if os.path.exists(path):
+                self.load_onnx_model(path)
+            else:
+                print("tags: {} is missing, using torch".format(path))
+                self.backend = TORCH
+
+        if self.backend == TORCH:
+            self.load_model()
+
         self.load_labels()
         self.labels_and_model_are_load = True
 
     def load_model(self):
+        import places365.wideresnet as wideresnet
+        import torch
+
+        torch.nn.Module.dump_patches = True
+
+        if THREADS > 0:
+            torch.set_num_threads(THREADS)
+
         # this model has a last conv feature map as 14x14
         def hook_feature(module, input, output):
-            self.features_blobs.append(np.squeeze(output.data.cpu().numpy()))
+            self.features_blobs.append(output.detach().flatten(1).numpy())
 
         model_file = os.path.join(dir_places365_model, "wideresnet18_places365.pth.tar")
         self.model = wideresnet.resnet18(num_classes=365)
@@ -55,13 +117,30 @@ class Places365:
         }
         self.model.load_state_dict(state_dict)
         self.model.eval()
-        # hook the feature extractor
-        features_names = [
-            "layer4",
-            "avgpool",
-        ]  # this is the last conv layer of the resnet
-        for name in features_names:
-            self.model._modules.get(name).register_forward_hook(hook_feature)
+
+        # get the softmax weight
+        # Clipping the numpy view zeroes the negative weights of the classifier
+        # itself. Predictions have always been made with these weights, so this is
+        # done once here instead of before every forward pass.
+        params = list(self.model.parameters())
+        self.weight_softmax = params[-2].data.numpy()
+        self.weight_softmax[self.weight_softmax < 0] = 0
+
+        # hook the feature extractor, only the pooled features of the last conv
+        # layer are used for the scene attributes
+        self.model._modules.get("avgpool").register_forward_hook(hook_feature)
+
+    def load_onnx_model(self, path):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+
+        if THREADS > 0:
+            options.intra_op_num_threads = THREADS
+
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
 
     def load_labels(self):
         # prepare all the labels
@@ -101,9 +180,11 @@ class Places365:
 
     def returnTF(self):
         # load the image transformer
+        from torchvision import transforms as trn
+
         tf = trn.Compose(
             [
-                trn.Resize((224, 224)),
+                trn.Resize(INPUT_SIZE),
                 trn.ToTensor(),
                 trn.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
             ]
@@ -113,81 +194,192 @@ class Places365:
     def remove_nonspace_separators(self, text):
         return " ".join(" ".join(" ".join(text.split("_")).split("/")).split("-"))
 
-    def inference_places365(self, img_path, confidence):
+    def describe(self, probs, idx, responses_attribute, confidence):
+        """Turns the sorted class probabilities and the attribute responses of one
+        image into its tags."""
+
+        res = {}
+
+        # output the IO prediction
+        # labels_IO[idx[:10]] returns a list of 0's and 1's: 0 -> inside, 1 -> outside
+        # Determine the mean to reach a consensus
+        io_image = np.mean(self.labels_IO[idx[:10]])
+        if io_image < 0.5:
+            res["environment"] = "indoor"
+        else:
+            res["environment"] = "outdoor"
+
+        # output the prediction of scene category
+        # idx[i] returns a index number for which class it corresponds to
+        # classes[idx[i]], thus returns the class name
+        # idx is sorted together with probs, with highest probabilities first
+        res["categories"] = []
+        for i in range(0, 5):
+            if probs[i] > confidence:
+                res["categories"].append(
+                    self.remove_nonspace_separators(self.classes[idx[i]])
+                )
+            else:
+                break
+        # TODO Should be replaced with more meaningful tags in the future
+        # output the scene attributes
+        # The responses are the dot product of the W_attribute model and the
+        # pooled features, the last elements of idx_a are the attributes we have
+        # the most confidence in.
+        # Can't seem to get any confidence values, also all the attributes it detect are not really meaningful i.m.o.
+        idx_a = np.argsort(responses_attribute)
+        res["attributes"] = []
+        for i in range(-1, -10, -1):
+            res["attributes"].append(
+                self.remove_nonspace_separators(self.labels_attribute[idx_a[i]])
+            )
+
+        return res
+
+    def preprocess(self, img):
+        """Converts a PIL image into a normalized (3, 224, 224) float32 array, like
+        `returnTF` but without torch. Thread safe, so images can be prepared
+        concurrently."""
+
+        img = img.convert("RGB").resize(INPUT_SIZE, Image.BILINEAR)
+        pixels = np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255
+
+        return (pixels - MEAN) / STD
+
+    def forward(self, batch):
+        """Returns the class logits and the pooled features of a batch."""
+
+        if self.session is not None:
+            return self.session.run(["logits", "features"], {"image": batch})
+
+        import torch
+
+        self.features_blobs = []
+
+        # forward pass
+        with torch.inference_mode():
+            logit = self.model.forward(torch.from_numpy(batch))
+
+        return logit.numpy(), self.features_blobs[0]
+
+    def inference_places365_batch(self, inputs, confidence):
         """
-        @param img_path: path to the image to generate labels from
-        @param confidence: minimum confidence before an category is selected
-        @return: {'environment': 'indoor'/'outdoor', 'categories': [...], 'attributes': [...]}
+        @param inputs: arrays returned by preprocess
+        @param confidence: minimum confidence before an category is selected, for
+            all inputs or one per input
+        @return: one {'environment', 'categories', 'attributes'} dict per input
         """
         try:
             if not self.labels_and_model_are_load:
                 self.load()
 
-            # load the model
-            self.features_blobs = []
-
-            # load the transformer
-            tf = self.returnTF()  # image transformer
-
-            # get the softmax weight
-            params = list(self.model.parameters())
-            weight_softmax = params[-2].data.numpy()
-            weight_softmax[weight_softmax < 0] = 0
-
-            # load the test image
-            # img_url = 'http://places2.csail.mit.edu/imgs/3.jpg'
-            # os.system('wget %s -q -O test.jpg' % img_url)
-            img = Image.open(img_path)
-            # Normalize the image for processing
-            input_img = V(tf(img).unsqueeze(0))
-
-            # forward pass
-            logit = self.model.forward(input_img)
-            h_x = F.softmax(logit, 1).data.squeeze()
-            probs, idx = h_x.sort(0, True)
-            probs = probs.numpy()
-            idx = idx.numpy()
-
-            res = {}
-
-            # output the IO prediction
-            # labels_IO[idx[:10]] returns a list of 0's and 1's: 0 -> inside, 1 -> outside
-            # Determine the mean to reach a consensus
-            io_image = np.mean(self.labels_IO[idx[:10]])
-            if io_image < 0.5:
-                res["environment"] = "indoor"
-            else:
-                res["environment"] = "outdoor"
-
-            # output the prediction of scene category
-            # idx[i] returns a index number for which class it corresponds to
-            # classes[idx[i]], thus returns the class name
-            # idx is sorted together with probs, with highest probabilities first
-            res["categories"] = []
-            for i in range(0, 5):
-                if probs[i] > confidence:
-                    res["categories"].append(
-                        self.remove_nonspace_separators(self.classes[idx[i]])
+            confidences = np.broadcast_to(confidence, len(inputs))
+            results = []
+
+            for start in range(0, len(inputs), BATCH_SIZE):
+                logit, features = self.forward(
+                    np.stack(inputs[start : start + BATCH_SIZE])
+                )
+                probs = softmax(logit)
+                idx = np.argsort(-probs, axis=1, kind="stable")
+                probs = np.take_along_axis(probs, idx, axis=1)
+                responses_attribute = features @ self.W_attribute.T
+
+                results.extend(
+                    self.describe(
+                        probs[row],
+                        idx[row],
+                        responses_attribute[row],
+                        confidences[start + row],
                     )
-                else:
-                    break
-            # TODO Should be replaced with more meaningful tags in the future
-            # output the scene attributes
-            # This is something I don't quiet grasp yet
-            # Probs is not usable here anymore, we're not processing our input_image
-            # Take the dot product of out W_attribute model and the feature blobs
-            # And sort it along the -1 axis
-            # This results in idx_a, with the last elements the index numbers of attributes, we have the most confidence in
-            # Can't seem to get any confidence values, also all the attributes it detect are not really meaningful i.m.o.
-            responses_attribute = self.W_attribute.dot(self.features_blobs[1])
-            idx_a = np.argsort(responses_attribute)
-            res["attributes"] = []
-            for i in range(-1, -10, -1):
-                res["attributes"].append(
-                    self.remove_nonspace_separators(self.labels_attribute[idx_a[i]])
+                    for row in range(len(probs))
                 )
 
-            return res
+            return results
         except Exception as e:
             print("tags: {}".format("Error in Places365 inference"))
             raise e
+
+    def inference_places365(self, img_path, confidence):
+        """
+        @param img_path: path to the image to generate labels from
+        @param confidence: minimum confidence before an category is selected
+        @return: {'environment': 'indoor'/'outdoor', 'categories': [...], 'attributes': [...]}
+        """
+        img = Image.open(img_path)
+
+        return self.inference_places365_batch([self.preprocess(img)], confidence)[0]
+
+    def export_onnx(self, calibration_images=()):
+        """Exports the torch model to ONNX, returning the logits and the pooled
+        features of a batch of any size.
+
+        With calibration images, typically a few hundred thumbnails, an int8
+        model is also written with static quantization. Convolutions dominate
+        this network, and dynamic quantization does not cover them.
+        """
+        import torch
+        from onnxruntime.quantization import (
+            QuantFormat,
+            QuantType,
+            quant_pre_process,
+            quantize_static,
+        )
+
+        if self.model is None:
+            self.load(TORCH)
+
+        class WithFeatures(torch.nn.Module):
+            # Mirrors WideResNet.forward, also returning the pooled features the
+            # attributes are computed from.
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, x):
+                m = self.model
+                x = m.relu(m.bn1(m.conv1(x)))
+                x = m.layer4(m.layer3(m.layer2(m.layer1(x))))
+                features = m.avgpool(x).flatten(1)
+
+                return m.fc(features), features
+
+        # The feature hook also runs while the model is traced.
+        self.features_blobs = []
+
+        with torch.no_grad():
+            torch.onnx.export(
+                WithFeatures(self.model).eval(),
+                torch.zeros(1, 3, *INPUT_SIZE),
+                onnx_model_path,
+                input_names=["image"],
+                output_names=["logits", "features"],
+                dynamic_axes={
+                    "image": {0: "batch"},
+                    "logits": {0: "batch"},
+                    "features": {0: "batch"},
+                },
+                opset_version=17,
+            )
+
+        if not calibration_images:
+            return [onnx_model_path]
+
+        pre_processed_path = onnx_model_path.replace(".onnx", "_pre_process.onnx")
+        quant_pre_process(onnx_model_path, pre_processed_path)
+        inputs = [self.preprocess(Image.open(path)) for path in calibration_images]
+        quantize_static(
+            pre_processed_path,
+            onnx_int8_model_path,
+            CalibrationImages(
+                np.stack(inputs[start : start + BATCH_SIZE])
+                for start in range(0, len(inputs), BATCH_SIZE)
+            ),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+        os.remove(pre_processed_path)
+
+        return [onnx_model_path, onnx_int8_model_path]
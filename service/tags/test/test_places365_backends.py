@@ -0,0 +1,165 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import places365.places365 as places365_module  # noqa: E402
+from places365.places365 import (  # noqa: E402
+    ONNX,
+    ONNX_INT8,
+    TORCH,
+    Places365,
+    onnx_int8_model_path,
+    onnx_model_path,
+)
+
+samples_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "samples")
+samples = [
+    os.path.join(samples_dir, f)
+    for f in os.listdir(samples_dir)
+    if f not in [".gitkeep", "README.md"]
+]
+
+# Share of samples whose best category has to survive int8 quantization.
+INT8_TOP1_AGREEMENT = 0.9
+
+CATEGORIES = 365
+ATTRIBUTES = 102
+FEATURES = 512
+
+
+def tag(backend):
+    places365 = Places365()
+    places365.load(backend)
+    assert places365.backend == backend
+
+    inputs = [places365.preprocess(Image.open(sample)) for sample in samples]
+
+    return places365.inference_places365_batch(inputs, 0.0)
+
+
+@pytest.fixture(scope="module")
+def torch_tags():
+    if not samples:
+        pytest.skip("no sample images")
+
+    pytest.importorskip("torch")
+
+    return tag(TORCH)
+
+
+def test_onnx_matches_torch(torch_tags):
+    pytest.importorskip("onnxruntime")
+
+    if not os.path.exists(onnx_model_path):
+        pytest.skip("ONNX model was not exported")
+
+    for expected, result in zip(torch_tags, tag(ONNX)):
+        assert result["categories"] == expected["categories"]
+        assert result["environment"] == expected["environment"]
+
+
+def test_onnx_int8_keeps_top_category(torch_tags):
+    pytest.importorskip("onnxruntime")
+
+    if not os.path.exists(onnx_int8_model_path):
+        pytest.skip("int8 ONNX model was not exported")
+
+    agreeing = sum(
+        result["categories"][:1] == expected["categories"][:1]
+        for expected, result in zip(torch_tags, tag(ONNX_INT8))
+    )
+
+    assert agreeing >= INT8_TOP1_AGREEMENT * len(samples)
+
+
+@pytest.fixture(scope="module")
+def synthetic_model_dir(tmp_path_factory):
+    """Writes a randomly initialised model with the layout of the downloaded
+    one, so the backends can be compared without it."""
+
+    torch = pytest.importorskip("torch")
+    import places365.wideresnet as wideresnet
+
+    model_dir = tmp_path_factory.mktemp("places365")
+    torch.manual_seed(0)
+    model = wideresnet.resnet18(num_classes=CATEGORIES)
+    torch.save(
+        {"state_dict": model.state_dict()},
+        model_dir / "wideresnet18_places365.pth.tar",
+    )
+    (model_dir / "categories_places365.txt").write_text(
+        "".join(f"/c/category_{i} {i}\n" for i in range(CATEGORIES))
+    )
+    (model_dir / "IO_places365.txt").write_text(
+        "".join(f"/c/category_{i} {1 + i % 2}\n" for i in range(CATEGORIES))
+    )
+    (model_dir / "labels_sunattribute.txt").write_text(
+        "".join(f"attribute_{i}\n" for i in range(ATTRIBUTES))
+    )
+    np.save(
+        model_dir / "W_sceneattribute_wideresnet18.npy",
+        np.random.default_rng(0).normal(size=(ATTRIBUTES, FEATURES)),
+    )
+
+    return model_dir
+
+
+@pytest.fixture()
+def synthetic_model(synthetic_model_dir, monkeypatch):
+    monkeypatch.setattr(
+        places365_module, "dir_places365_model", str(synthetic_model_dir)
+    )
+    monkeypatch.setattr(
+        places365_module,
+        "onnx_model_path",
+        str(synthetic_model_dir / "wideresnet18_places365.onnx"),
+    )
+    monkeypatch.setattr(
+        places365_module,
+        "onnx_int8_model_path",
+        str(synthetic_model_dir / "wideresnet18_places365_int8.onnx"),
+    )
+
+    return synthetic_model_dir
+
+
+def test_preprocess_matches_torchvision():
+    pytest.importorskip("torchvision")
+
+    pixels = np.random.default_rng(0).integers(0, 256, (300, 400, 3), np.uint8)
+    image = Image.fromarray(pixels)
+    places365 = Places365()
+
+    np.testing.assert_allclose(
+        places365.preprocess(image),
+        places365.returnTF()(image).numpy(),
+        atol=1e-5,
+    )
+
+
+def test_synthetic_onnx_matches_torch(synthetic_model):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+
+    torch_model = Places365()
+    torch_model.load(TORCH)
+    torch_model.export_onnx()
+    onnx_model = Places365()
+    onnx_model.load(ONNX)
+    assert onnx_model.backend == ONNX
+
+    batch = np.random.default_rng(1).normal(size=(3, 3, 224, 224))
+    batch = batch.astype(np.float32)
+
+    for expected, result in zip(torch_model.forward(batch), onnx_model.forward(batch)):
+        np.testing.assert_allclose(result, expected, rtol=1e-3, atol=1e-4)
+
+    inputs = list(batch)
+    assert onnx_model.inference_places365_batch(
+        inputs, 0.0
+    ) == torch_model.inference_places365_batch(inputs, 0.0)